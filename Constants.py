@@ -42,3 +42,28 @@ catToNum = {
 maxRegions = 256
 iouLowerBound = 0.45
 iouUpperBound = 0.6
+
+# ============================
+# Preprocessing cache
+
+# Directory for cached voxels and labels. See preprocess_cache.py
+cache_dir = 'preprocess_cache'
+
+# Directory for the packed per scene point clouds. See point_shards.py
+shard_dir = 'point_shards'
+
+# Directory for the ground truth annotation index of each dataset. See annotation_index.py
+annotation_dir = 'annotation_index'
+
+# Number of processes used to preprocess samples for training. See parallel_preprocessing.py
+preprocessWorkers = 8
+
+# ============================
+# Precision
+
+# Keras mixed precision policy of the model: 'float32', 'mixed_bfloat16' or 'mixed_float16'.
+# Batch normalization statistics and the output layers stay float32 either way. See model_training.setPrecisionPolicy
+precisionPolicy = 'float32'
+
+# dtype the voxel features and regression labels are cached in and fed to the model as. 'float16' halves them.
+storageDtype = 'float32'
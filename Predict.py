@@ -1,45 +1,52 @@
 from lyft_dataset_sdk.lyftdataset import LyftDataset
-from tensorflow.keras.models import load_model
-from tensorflow import SparseTensor, sparse
-from model_training import RepeatLayer, MaxPoolingVFELayer, combine_lidar_data, VFE_preprocessing
+from model_training import loadCurrentModel, getSampleVoxels, voxelsToDense, stackVoxelBatch
+from model_export import InferenceModel
+from model_quantization import QuantizedModel
 import numpy as np
 import Constants
 
 
 def predictMain(samples, outPath, level5Data, model):
 	import time
-	# Set constants
-	dataDir = 'E:\\CS539 Machine Learning\\3d-object-detection-for-autonomous-vehicles'
 	# os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+	# model can also be the directory of a model exported by model_export.exportInferenceModel, or a .tflite file
+	# from model_quantization.quantizeModel
+	if isinstance(model, str):
+		model = QuantizedModel(model) if model.endswith('.tflite') else InferenceModel(model)
+	# models from createSparseModel take [features, coords] instead of the dense voxel grid
+	if isinstance(model, (InferenceModel, QuantizedModel)):
+		sparseInput = model.sparseInput
+	else:
+		sparseInput = len(model.inputs) == 2
 
-	points = []
 	# for sample in samples:
 	for i in range(len(samples)):
-		# pre-process data
-		sampleLidarPoints = combine_lidar_data(samples[i], dataDir, level5Data)
+		# pre-process data. Voxels come from the preprocessing cache if this sample was used before.
 		startTime = time.time()
-		trainVFEPoints = VFE_preprocessing(sampleLidarPoints,
-										   Constants.voxelx,
-										   Constants.voxely,
-										   Constants.voxelz,
-										   Constants.maxPoints,
-										   Constants.nx // 2,
-										   Constants.ny // 2,
-										   Constants.nz)
-		trainVFEPoints = sparse.reshape(trainVFEPoints, (1,) + trainVFEPoints.shape)
-		testVFEPointsDense = sparse.to_dense(trainVFEPoints, default_value=0., validate_indices=False)
-		# points.append(testVFEPointsDense)
+		voxels = getSampleVoxels(samples[i], level5Data)
+		if sparseInput:
+			modelInput = list(stackVoxelBatch([voxels]))
+		else:
+			# Turn into 6 rank tensor because keras won't take sparse tensors
+			modelInput = voxelsToDense(*voxels)[None]
 		endTime = time.time()
 		print(endTime - startTime)
 		print('finished ' + str(i))
-		# Turn into 6 rank tensor, then convert it to dense because keras is stupid
-		# testVFEPoints = sparse.reshape(testVFEPoints, (1,) + testVFEPoints.shape)
-		# testVFEPointsDense = sparse.to_dense(testVFEPoints, default_value=0., validate_indices=False)
-		prob, regress = model.predict(testVFEPointsDense)
+		prob, regress = model.predict(modelInput)
 		np.save(outPath + '\\sample' + str(i) + '_label.npy', prob)
 		np.save(outPath + '\\sample' + str(i) + '_regress.npy', regress)
 
 
+def loadPredictions(outPath, count):
+	'''
+	Reads back the outputs predictMain saved for the first count samples.
+	:return: prob of (count, 100, 200, 2) and regress of (count, 100, 200, 14), ready for rpnToRegion.rpnToRegions
+	'''
+	prob = np.concatenate([np.load(outPath + '\\sample' + str(i) + '_label.npy') for i in range(count)])
+	regress = np.concatenate([np.load(outPath + '\\sample' + str(i) + '_regress.npy') for i in range(count)])
+	return prob, regress
+
+
 if __name__ == '__main__':
 	# load dataset
 	level5Data = LyftDataset(
@@ -48,8 +55,7 @@ if __name__ == '__main__':
 		verbose=True
 	)
 
-	model = load_model('fixedTheta\\15SampleEpoch0_fixed.h5',
-					   custom_objects={'RepeatLayer': RepeatLayer, 'MaxPoolingVFELayer': MaxPoolingVFELayer})
+	model = loadCurrentModel('fixedTheta\\15SampleEpoch0_fixed.h5')
 
 	# load data, then call predict
 	samples = []
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import Constants
+import preprocess_cache
+from transforms import applyTransform, getTransformCache, quaternionYaw
+
+# Ground truth boxes of a whole dataset as columns, grouped by sample so a sample's boxes are one slice.
+#   <dataset key>_boxes.npy      float64 n,7 x, y, z, length, width, height, yaw of every annotation in the car's frame
+#   <dataset key>_categories.npy int8 n Constants.catToNum id of every annotation, -1 for other categories
+#   <dataset key>.json           maps each sample token to the [offset, count] of its annotations
+# Built once per dataset with buildAnnotationIndex, read with getAnnotationIndex.
+
+annotationNames = ['boxes', 'categories']
+
+# (dataset, loaded AnnotationIndex) of each dataset, by id. The dataset is kept so its id can't be reused by another one.
+annotationIndexes = {}
+
+
+# Names a dataset's index files. Made from the dataset's contents, so the train and test sets don't share an index.
+def datasetKey(level5Data):
+	first = level5Data.sample[0]['token'] if len(level5Data.sample) > 0 else ''
+	values = [first, len(level5Data.sample), len(level5Data.sample_annotation)]
+	return hashlib.sha1(json.dumps(values).encode('utf-8')).hexdigest()[:16]
+
+
+def indexPath(key, indexDir):
+	return os.path.join(indexDir, key + '.json')
+
+
+def sampleAnnotations(sample, level5Data):
+	'''
+	Reads the annotations of a sample from the Level 5 Dataset tables.
+	:return: array of n,7 where each row is the x, y, z, length, width, height, yaw of an annotation in the car's frame,
+		and array of n with the category id of each
+	'''
+	anns = [level5Data.get('sample_annotation', token) for token in sample['anns']]
+	if len(anns) == 0:
+		return np.zeros((0, 7)), np.zeros(0, dtype=np.int8)
+	categories = [level5Data.get('category', level5Data.get('instance', ann['instance_token'])['category_token'])['name']
+				  for ann in anns]
+
+	# do a inverse transpose to get the annotation data from global coords to local, for every annotation at once
+	globalToEgo = getTransformCache(level5Data).sampleGlobalToEgo(sample)
+	translations = applyTransform(globalToEgo, np.array([ann['translation'] for ann in anns], dtype=np.float64))
+	sizes = np.array([ann['size'] for ann in anns], dtype=np.float64)
+	yaws = quaternionYaw([ann['rotation'] for ann in anns])
+	boxes = np.concatenate((translations, sizes, yaws[:, None]), axis=1)
+	return boxes, np.array([Constants.catToNum.get(category, -1) for category in categories], dtype=np.int8)
+
+
+def buildAnnotationIndex(level5Data, indexDir=Constants.annotation_dir):
+	'''
+	Converts the annotations of every sample in the dataset and saves them as one index.
+	:param level5Data: The Level 5 Dataset to index.
+	:param indexDir: location to save the index to
+	'''
+	key = datasetKey(level5Data)
+	allBoxes = []
+	allCategories = []
+	index = {}
+	offset = 0
+	for i, sample in enumerate(level5Data.sample):
+		boxes, categories = sampleAnnotations(sample, level5Data)
+		allBoxes.append(boxes)
+		allCategories.append(categories)
+		index[sample['token']] = [offset, len(boxes)]
+		offset += len(boxes)
+		if i % 1000 == 0:
+			print('indexed annotations of sample ' + str(i))
+	# the arrays are saved before the .json, so an index with a .json is always complete
+	preprocess_cache.saveArrays(indexDir, key, annotationNames,
+								[np.concatenate(allBoxes).reshape(-1, 7) if allBoxes else np.zeros((0, 7)),
+								 np.concatenate(allCategories) if allCategories else np.zeros(0, dtype=np.int8)])
+	tempPath = indexPath(key, indexDir) + '.tmp'
+	with open(tempPath, 'w') as f:
+		json.dump(index, f)
+	os.replace(tempPath, indexPath(key, indexDir))
+	annotationIndexes.pop(id(level5Data), None)
+
+
+class AnnotationIndex:
+	'''
+	An index saved by buildAnnotationIndex. The columns are memory mapped, so looking up a sample only reads its slice.
+	'''
+
+	def __init__(self, key, indexDir):
+		with open(indexPath(key, indexDir)) as f:
+			self.index = json.load(f)
+		self.boxes, self.categories = preprocess_cache.loadArrays(indexDir, key, annotationNames, mmap=True)
+
+	def __contains__(self, sampleToken):
+		return sampleToken in self.index
+
+	# Same as sampleAnnotations, for a sample token in the index.
+	def sampleAnnotations(self, sampleToken):
+		offset, count = self.index[sampleToken]
+		return np.array(self.boxes[offset:offset + count]), np.array(self.categories[offset:offset + count])
+
+
+def getAnnotationIndex(level5Data, indexDir=Constants.annotation_dir, build=True):
+	'''
+	Returns the AnnotationIndex of the dataset, so every caller shares one.
+	:param build: build the index if it hasn't been built yet. Otherwise returns None in that case.
+	'''
+	if id(level5Data) not in annotationIndexes:
+		key = datasetKey(level5Data)
+		if not os.path.exists(indexPath(key, indexDir)):
+			if not build:
+				return None
+			buildAnnotationIndex(level5Data, indexDir)
+		annotationIndexes[id(level5Data)] = (level5Data, AnnotationIndex(key, indexDir))
+	return annotationIndexes[id(level5Data)][1]
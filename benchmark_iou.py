@@ -0,0 +1,55 @@
+import time
+
+import numpy as np
+
+import Constants
+from box_iou import iouMatrix
+from serialize_data import calculateIntersection, calculateUnion
+
+
+# Compares box_iou.iouMatrix with the old per pair shapely IoU on random car sized boxes.
+
+def randomBoxes(count, span, rng):
+	return np.column_stack((rng.uniform(-span, span, (count, 2)),
+							rng.uniform(0.5, 2, count),
+							rng.uniform(1.5, 2.2, count),
+							rng.uniform(3.5, 5.5, count),
+							rng.uniform(1.4, 2, count),
+							rng.uniform(-np.pi, np.pi, count)))
+
+
+def shapelyIoUMatrix(boxes1, boxes2):
+	out = np.zeros((len(boxes1), len(boxes2)))
+	for i, box1 in enumerate(boxes1):
+		for j, box2 in enumerate(boxes2):
+			intersect = calculateIntersection(box1, box2)
+			out[i, j] = intersect / calculateUnion(box1, box2, intersect)
+	return out
+
+
+def benchmark(count1, count2, span, rng):
+	boxes1 = randomBoxes(count1, span, rng)
+	boxes2 = randomBoxes(count2, span, rng)
+
+	startTime = time.time()
+	expected = shapelyIoUMatrix(boxes1, boxes2)
+	shapelySeconds = time.time() - startTime
+
+	startTime = time.time()
+	iou = iouMatrix(boxes1, boxes2)
+	numpySeconds = time.time() - startTime
+
+	print(str(count1) + ' x ' + str(count2) + ' boxes in ' + str(2 * span) + ' m:'
+		  + ' shapely ' + '%.3f' % shapelySeconds + 's,'
+		  + ' iouMatrix ' + '%.4f' % numpySeconds + 's,'
+		  + ' speedup ' + '%.0f' % (shapelySeconds / numpySeconds) + 'x,'
+		  + ' max difference ' + '%.2e' % np.abs(iou - expected).max())
+
+
+if __name__ == '__main__':
+	rng = np.random.default_rng(0)
+	# dense boxes where most pairs overlap, like non max suppression on one car
+	benchmark(300, 300, 3, rng)
+	# cars spread over the whole area, like anchors against labels
+	benchmark(2000, 30, Constants.nx * Constants.voxelx / 2, rng)
+	benchmark(300, 300, Constants.nx * Constants.voxelx / 2, rng)
@@ -0,0 +1,72 @@
+import time
+
+import numpy as np
+from tensorflow.keras.layers import Dense, Input, BatchNormalization, Reshape, Activation, Conv3D
+from tensorflow.keras.models import Model
+
+import Constants
+from model_training import PointwiseDenseLayer, copyWeights
+
+
+# Compares PointwiseDenseLayer with the Reshape, Dense, Reshape, BatchNormalization and relu layers addFCN and
+# addConv3DLayer used to build, on a rank 6 VFE input and a rank 5 Conv3D output the size of a slice of the grid.
+
+def reshapeDense(layer, units, act=None):
+	oldShape = layer.shape[1:]
+	combineVoxel = np.prod(np.array(layer.shape[1:-2]))
+	layer = Reshape((combineVoxel,) + tuple(layer.shape[-2:]))(layer)
+	layer = Dense(units, activation=act, use_bias=False)(layer)
+	return Reshape(tuple(oldShape[:-1]) + (units,))(layer)
+
+
+def oldFCN(layer, units):
+	layer = reshapeDense(layer, units)
+	layer = BatchNormalization()(layer)
+	return Activation('relu')(layer)
+
+
+def oldConv3DTail(layer):
+	layer = BatchNormalization()(layer)
+	return reshapeDense(layer, layer.shape[-1], 'relu')
+
+
+def timePredict(model, inputs, repeats):
+	model.predict(inputs, verbose=0)
+	startTime = time.time()
+	for _ in range(repeats):
+		outputs = model.predict(inputs, verbose=0)
+	return (time.time() - startTime) / repeats, outputs
+
+
+def benchmark(name, inputShape, buildOld, buildNew, rng, repeats=5):
+	inLayer = Input(shape=inputShape)
+	oldModel = Model(inLayer, buildOld(inLayer))
+	newModel = Model(inLayer, buildNew(inLayer))
+	# random normalization statistics, so folding them into the kernel is checked too
+	oldModel.set_weights([rng.uniform(0.5, 1.5, weight.shape).astype(np.float32) for weight in oldModel.get_weights()])
+	copyWeights(oldModel, newModel)
+	inputs = rng.standard_normal((1,) + inputShape).astype(np.float32)
+
+	oldSeconds, expected = timePredict(oldModel, inputs, repeats)
+	newSeconds, outputs = timePredict(newModel, inputs, repeats)
+	print(name + ' ' + str(inputShape) + ':'
+		  + ' reshape graph ' + '%.3f' % oldSeconds + 's,'
+		  + ' PointwiseDenseLayer ' + '%.3f' % newSeconds + 's,'
+		  + ' speedup ' + '%.2f' % (oldSeconds / newSeconds) + 'x,'
+		  + ' max difference ' + '%.2e' % (np.abs(outputs - expected).max() / np.abs(expected).max())
+		  + ' of the largest output')
+
+
+if __name__ == '__main__':
+	rng = np.random.default_rng(0)
+	# a quarter of the x and y grid, like the VFE input and its second FCN
+	benchmark('VFE FCN', (Constants.nz, Constants.nx // 4, Constants.ny // 4, Constants.maxPoints, 6),
+			  lambda layer: oldFCN(layer, 16),
+			  lambda layer: PointwiseDenseLayer(16, 'relu', batchNorm='after')(layer), rng)
+	benchmark('VFE FCN', (Constants.nz, Constants.nx // 4, Constants.ny // 4, Constants.maxPoints, 32),
+			  lambda layer: oldFCN(layer, 32),
+			  lambda layer: PointwiseDenseLayer(32, 'relu', batchNorm='after')(layer), rng)
+	benchmark('Conv3D', (Constants.nz, Constants.nx // 4, Constants.ny // 4, 64),
+			  lambda layer: oldConv3DTail(Conv3D(64, kernel_size=3, padding='same')(layer)),
+			  lambda layer: PointwiseDenseLayer(64, 'relu', batchNorm='before')(
+				  Conv3D(64, kernel_size=3, padding='same')(layer)), rng)
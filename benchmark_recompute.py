@@ -0,0 +1,62 @@
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+
+import numpy as np
+
+import Constants
+
+
+# Peak memory of training steps of createModel with and without recomputing the VFE and Conv3D blocks.
+# Every setting runs in a new process so the peaks don't mix. Peak is the GPU's if there is one, else the process' RSS.
+# A setting that runs out of memory kills its process, which is reported instead of the peak, as is any other error.
+
+def peakMemory():
+	import tensorflow as tf
+	if len(tf.config.list_physical_devices('GPU')) > 0:
+		return tf.config.experimental.get_memory_info('GPU:0')['peak']
+	import resource
+	# kilobytes on Linux, bytes on macOS
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def trainSteps(job):
+	nx, ny, recomputeSegment, steps = job
+	from model_training import createModel
+	model = createModel(nx, ny, Constants.nz, Constants.maxPoints, recomputeSegment)
+	model.compile(optimizer='sgd', loss=['mse', 'mse'])
+	rng = np.random.default_rng(0)
+	inputs = rng.standard_normal((1, Constants.nz, nx, ny, Constants.maxPoints, 6)).astype(np.float32)
+	labels = [np.zeros((1, nx // 2, ny // 2, len(Constants.anchors)), dtype=np.float32),
+			  np.zeros((1, nx // 2, ny // 2, len(Constants.anchors) * 7), dtype=np.float32)]
+	# first step builds the graph
+	model.train_on_batch(inputs, labels)
+	startTime = time.time()
+	for _ in range(steps):
+		model.train_on_batch(inputs, labels)
+	return peakMemory(), (time.time() - startTime) / steps
+
+
+def benchmark(nx, ny, recomputeSegments=(0, 1, 3), steps=3):
+	for recomputeSegment in recomputeSegments:
+		setting = str(nx) + ' x ' + str(ny) + ' grid, recomputeSegment ' + str(recomputeSegment) + ':'
+		# a Pool would wait forever on a killed worker, the executor raises instead
+		with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+			try:
+				peak, seconds = executor.submit(trainSteps, (nx, ny, recomputeSegment, steps)).result()
+			except BrokenProcessPool:
+				print(setting + ' out of memory')
+				continue
+			except Exception as e:
+				# TensorFlow can also fail to allocate a tensor without being killed
+				print(setting + ' failed with ' + type(e).__name__)
+				continue
+		print(setting + ' peak memory ' + '%.2f' % (peak / 2 ** 30) + ' GB, ' + '%.2f' % seconds + 's per step')
+
+
+if __name__ == '__main__':
+	# a fifth of the x and y grid (the RPN needs sizes divisible by 8), then the whole grid
+	benchmark(Constants.nx // 5, Constants.ny // 5)
+	benchmark(Constants.nx, Constants.ny)
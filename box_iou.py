@@ -0,0 +1,197 @@
+import numpy as np
+
+# Rotated box IoU on arrays of boxes, so many pairs can be compared at once instead of building shapely polygons
+# pair by pair. Boxes are rows of x, y, z, l, w, h, yaw like the annotations. By default gives the same values as
+# serialize_data.calculateIoU, including its z overlap (h is treated as half the height there), which is what the
+# anchor labels are made with. halfHeight=False gives the true 3D IoU (z from z - h / 2 to z + h / 2), which is what
+# detections are scored with.
+
+
+# Corners of every box in an array of (..., 7) as (..., 4, 2). Same corners and order as boxToShapely (clockwise).
+def boxCorners(boxes):
+	x = boxes[..., 0]
+	y = boxes[..., 1]
+	halfLength = boxes[..., 3] / 2
+	halfWidth = boxes[..., 4] / 2
+	cos = np.cos(boxes[..., 6])
+	sin = np.sin(boxes[..., 6])
+	rightX, rightY = x + cos * halfWidth, y - sin * halfWidth
+	leftX, leftY = x - cos * halfWidth, y + sin * halfWidth
+	cornersX = np.stack((rightX + sin * halfLength, rightX - sin * halfLength,
+						 leftX - sin * halfLength, leftX + sin * halfLength), axis=-1)
+	cornersY = np.stack((rightY + cos * halfLength, rightY - cos * halfLength,
+						 leftY - cos * halfLength, leftY + cos * halfLength), axis=-1)
+	return np.stack((cornersX, cornersY), axis=-1)
+
+
+def cross(a, b):
+	return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+
+# Mask of the points (p, k, 2) that are inside (or on the edge of) the clockwise quads (p, 4, 2).
+def pointsInside(points, corners, eps=1e-9):
+	edges = np.roll(corners, -1, axis=1) - corners
+	toPoints = points[:, :, None, :] - corners[:, None, :, :]
+	return np.all(cross(edges[:, None, :, :], toPoints) <= eps, axis=2)
+
+
+def intersectionArea(corners1, corners2):
+	'''
+	Area of the intersection of pairs of convex quads.
+	The intersection is the convex polygon made of the corners of each quad that are inside the other one and the
+	points where their edges cross. Those points are put in order by angle around their mean, then the area is found
+	with the shoelace formula.
+	:param corners1: array of p,4,2 from boxCorners
+	:param corners2: array of p,4,2 from boxCorners
+	:return: array of p areas
+	'''
+	pairs = len(corners1)
+	edges1 = np.roll(corners1, -1, axis=1) - corners1
+	edges2 = np.roll(corners2, -1, axis=1) - corners2
+	# every edge of quad 1 against every edge of quad 2, as p,4,4
+	denom = cross(edges1[:, :, None, :], edges2[:, None, :, :])
+	toStart2 = corners2[:, None, :, :] - corners1[:, :, None, :]
+	with np.errstate(divide='ignore', invalid='ignore'):
+		t = cross(toStart2, edges2[:, None, :, :]) / denom
+		u = cross(toStart2, edges1[:, :, None, :]) / denom
+		crossings = corners1[:, :, None, :] + t[..., None] * edges1[:, :, None, :]
+	crossingValid = (denom != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+
+	points = np.concatenate((corners1, corners2, crossings.reshape(pairs, 16, 2)), axis=1)
+	valid = np.concatenate((pointsInside(corners1, corners2), pointsInside(corners2, corners1),
+							crossingValid.reshape(pairs, 16)), axis=1)
+	points = np.where(valid[..., None], points, 0)
+	count = valid.sum(axis=1)
+
+	centers = points.sum(axis=1) / np.maximum(count, 1)[:, None]
+	angles = np.arctan2(points[..., 1] - centers[:, 1:2], points[..., 0] - centers[:, 0:1])
+	angles[~valid] = np.inf
+	order = np.argsort(angles, axis=1)
+	points = np.take_along_axis(points, order[..., None], axis=1)
+	valid = np.take_along_axis(valid, order, axis=1)
+	# unused slots are at the end, repeat the first point there so they add nothing to the area
+	points = np.where(valid[..., None], points, points[:, :1, :])
+
+	nextPoints = np.roll(points, -1, axis=1)
+	area = np.abs(cross(points, nextPoints).sum(axis=1)) / 2
+	area[count < 3] = 0
+	return area
+
+
+def boxIoU(boxes1, boxes2, chunkSize=16384, halfHeight=True):
+	'''
+	IoU of pairs of boxes. Same as calling calculateIoU on each pair.
+	:param boxes1: array of (..., 7) boxes in the form <x, y, z, l, w, h, yaw>
+	:param boxes2: array of boxes that broadcasts with boxes1
+	:param chunkSize: max number of pairs compared at once, to limit memory use
+	:param halfHeight: treat h as half the height like calculateIoU. False gives the true 3D IoU.
+	:return: array of the broadcast shape (without the last axis) with the IoU of each pair
+	'''
+	boxes1, boxes2 = np.broadcast_arrays(np.asarray(boxes1, dtype=np.float64), np.asarray(boxes2, dtype=np.float64))
+	shape = boxes1.shape[:-1]
+	boxes1 = boxes1.reshape(-1, 7)
+	boxes2 = boxes2.reshape(-1, 7)
+	out = np.zeros(len(boxes1))
+	for start in range(0, len(boxes1), chunkSize):
+		out[start:start + chunkSize] = pairIoU(boxes1[start:start + chunkSize], boxes2[start:start + chunkSize],
+											   halfHeight)
+	return out.reshape(shape)
+
+
+def pairIoU(boxes1, boxes2, halfHeight=True):
+	area = intersectionArea(boxCorners(boxes1), boxCorners(boxes2))
+	# find greatest lower bound of z and lowest upper bound, then multiply.
+	zReach1 = boxes1[:, 5] if halfHeight else boxes1[:, 5] / 2
+	zReach2 = boxes2[:, 5] if halfHeight else boxes2[:, 5] / 2
+	botZ = np.maximum(boxes1[:, 2] - zReach1, boxes2[:, 2] - zReach2)
+	topZ = np.minimum(boxes1[:, 2] + zReach1, boxes2[:, 2] + zReach2)
+	if halfHeight:
+		intersect = (topZ - botZ) * area
+	else:
+		# boxes that don't overlap in z don't intersect at all
+		intersect = np.maximum(topZ - botZ, 0) * area
+	union = boxes1[:, 3] * boxes1[:, 4] * boxes1[:, 5] + boxes2[:, 3] * boxes2[:, 4] * boxes2[:, 5] - intersect
+	with np.errstate(divide='ignore', invalid='ignore'):
+		return intersect / union
+
+
+def iouMatrix(boxes1, boxes2, halfHeight=True):
+	'''
+	IoU of every box in boxes1 with every box in boxes2.
+	Pairs whose footprint circles don't touch are 0 without clipping their polygons.
+	:param boxes1: array of n,7 boxes
+	:param boxes2: array of m,7 boxes
+	:param halfHeight: treat h as half the height like calculateIoU. False gives the true 3D IoU.
+	:return: array of n,m
+	'''
+	boxes1 = np.asarray(boxes1, dtype=np.float64).reshape(-1, 7)
+	boxes2 = np.asarray(boxes2, dtype=np.float64).reshape(-1, 7)
+	out = np.zeros((len(boxes1), len(boxes2)))
+	distance = np.hypot(boxes1[:, None, 0] - boxes2[None, :, 0], boxes1[:, None, 1] - boxes2[None, :, 1])
+	reach = footprintRadius(boxes1)[:, None] + footprintRadius(boxes2)[None, :]
+	rows, cols = np.nonzero(distance <= reach * (1 + 1e-9) + 1e-9)
+	out[rows, cols] = boxIoU(boxes1[rows], boxes2[cols], halfHeight=halfHeight)
+	return out
+
+
+# Radius of the circle around the footprint of each box in an array of n,7.
+def footprintRadius(boxes):
+	return np.hypot(boxes[:, 3], boxes[:, 4]) / 2
+
+
+class BoxGridIndex:
+	'''
+	Uniform grid hash over the bird's eye view footprints of a set of boxes. Each box is put in the cell of its
+	center, and the cells are big enough that a box's footprint can only reach boxes in the cells next to its own.
+	Used to find the few pairs of boxes that can overlap without comparing every pair.
+	'''
+
+	def __init__(self, boxes, cellSize=None):
+		self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 7)
+		self.radius = footprintRadius(self.boxes)
+		self.maxRadius = self.radius.max() if len(self.boxes) > 0 else 0.
+		self.cellSize = cellSize if cellSize is not None else max(2 * self.maxRadius, 1e-3)
+		keys = self.cellKeys(*self.cells(self.boxes))
+		self.order = np.argsort(keys, kind='stable')
+		self.sortedKeys = keys[self.order]
+
+	def cells(self, boxes):
+		return np.floor(boxes[:, 0] / self.cellSize).astype(np.int64), np.floor(boxes[:, 1] / self.cellSize).astype(np.int64)
+
+	@staticmethod
+	def cellKeys(cellX, cellY):
+		return cellX * (1 << 32) + cellY
+
+	def query(self, boxes):
+		'''
+		Finds the pairs of a box in boxes and a box in the index whose footprints can overlap (their circles touch).
+		Pairs that aren't returned have an IoU of 0.
+		:param boxes: array of n,7 boxes
+		:return: rows (into boxes) and cols (into the indexed boxes) of each pair, sorted by row then col
+		'''
+		boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 7)
+		if len(boxes) == 0 or len(self.boxes) == 0:
+			return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+		radius = footprintRadius(boxes)
+		cellX, cellY = self.cells(boxes)
+		span = int(np.ceil((radius.max() + self.maxRadius) / self.cellSize))
+		rows = []
+		cols = []
+		for offsetX in range(-span, span + 1):
+			for offsetY in range(-span, span + 1):
+				keys = self.cellKeys(cellX + offsetX, cellY + offsetY)
+				starts = np.searchsorted(self.sortedKeys, keys, 'left')
+				counts = np.searchsorted(self.sortedKeys, keys, 'right') - starts
+				found = np.repeat(np.arange(len(boxes)), counts)
+				# position of every found box in sortedKeys
+				positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + starts[found]
+				rows.append(found)
+				cols.append(self.order[positions])
+		rows = np.concatenate(rows)
+		cols = np.concatenate(cols)
+		distance = np.hypot(boxes[rows, 0] - self.boxes[cols, 0], boxes[rows, 1] - self.boxes[cols, 1])
+		near = distance <= (radius[rows] + self.radius[cols]) * (1 + 1e-9) + 1e-9
+		rows = rows[near]
+		cols = cols[near]
+		order = np.lexsort((cols, rows))
+		return rows[order], cols[order]
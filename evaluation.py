@@ -0,0 +1,171 @@
+import time
+from collections import deque
+
+import numpy as np
+
+import Constants
+import parallel_preprocessing
+from box_iou import iouMatrix
+from serialize_data import getLabelsInRange
+
+# Detection metrics over a whole dataset. Predictions are matched to the ground truth of the same class, one sample
+# per job so the samples are spread over worker processes, then precision, recall and average precision are found
+# from the matches of every sample together.
+
+# IoU thresholds of the Lyft 3D object detection challenge, mAP is the mean over these
+lyftThresholds = np.arange(0.5, 0.96, 0.05)
+
+
+def regionsToCarFrame(boxes):
+	'''
+	Undoes what preprocessLabels does to the labels for boxes from rpnToRegion, so they are in the car's frame. The
+	anchor map starts at 0 and the labels behind the car wrap around to its far end, and x, y, l and w are scaled to
+	the anchor map (see fixBoxScaling).
+	'''
+	boxes = np.array(boxes, dtype=np.float64).reshape(-1, 7)
+	outX, outY = Constants.nx // 2, Constants.ny // 2
+	for position, size, outSize, fullSize, voxelSize in [(0, 3, outX, Constants.nx, Constants.voxelx),
+														  (1, 4, outY, Constants.ny, Constants.voxely)]:
+		span = outSize * voxelSize * 2
+		boxes[boxes[:, position] > span / 2, position] -= span
+		boxes[:, [position, size]] *= fullSize / outSize
+	return boxes
+
+
+def greedyMatch(iou, thresholds):
+	'''
+	Matches each prediction, from most to least probable, to the unmatched ground truth box it overlaps most.
+	:param iou: array of n,m with the IoU of each prediction (sorted by probability, highest first) with each box
+	:param thresholds: array of t IoU thresholds
+	:return: array of t,n that is True where the prediction was matched at that threshold
+	'''
+	truePositives = np.zeros((len(thresholds), len(iou)), dtype=bool)
+	for t, threshold in enumerate(thresholds):
+		matched = np.zeros(iou.shape[1], dtype=bool)
+		for i in range(len(iou)):
+			candidates = np.where(matched, -1., iou[i])
+			if len(candidates) == 0:
+				break
+			best = np.argmax(candidates)
+			if candidates[best] >= threshold:
+				matched[best] = True
+				truePositives[t, i] = True
+	return truePositives
+
+
+# A job of parallel_preprocessing.mapJobs: the predictions and ground truth of one sample, and what to score them on.
+def evaluateJob(job):
+	sampleToken, predBoxes, predProbs, predClasses, gtBoxes, gtClasses, classes, thresholds = job
+	iouSeconds = 0.
+	matchSeconds = 0.
+	matches = {}
+	for classId in classes:
+		isPred = predClasses == classId
+		# most probable first, ties go to the earlier prediction
+		order = np.argsort(-predProbs[isPred], kind='stable')
+		boxes = predBoxes[isPred][order]
+		probs = predProbs[isPred][order]
+		gt = gtBoxes[gtClasses == classId]
+
+		iouStart = time.time()
+		# true 3D IoU, not the one the anchor labels are made with
+		iou = iouMatrix(boxes, gt, halfHeight=False)
+		# a NaN IoU never counts as a match
+		iou[np.isnan(iou)] = 0
+		matchStart = time.time()
+		truePositives = greedyMatch(iou, thresholds)
+		iouSeconds += matchStart - iouStart
+		matchSeconds += time.time() - matchStart
+		matches[classId] = (probs, truePositives, len(gt))
+	timing = {'token': sampleToken, 'iouSeconds': iouSeconds, 'matchSeconds': matchSeconds}
+	return matches, timing
+
+
+def averagePrecision(probs, truePositives, gtCount):
+	'''
+	All point interpolated average precision, with the precision and recall of every prediction counted.
+	:param probs: array of n probabilities of the predictions of every sample
+	:param truePositives: array of t,n from greedyMatch
+	:param gtCount: number of ground truth boxes in every sample
+	:return: arrays of t with the average precision, precision and recall at each threshold
+	'''
+	thresholdCount = len(truePositives)
+	if len(probs) == 0 or gtCount == 0:
+		return np.zeros(thresholdCount), np.zeros(thresholdCount), np.zeros(thresholdCount)
+	order = np.argsort(-probs, kind='stable')
+	truePositives = truePositives[:, order]
+	tpCount = np.cumsum(truePositives, axis=1)
+	fpCount = np.cumsum(~truePositives, axis=1)
+	recall = tpCount / gtCount
+	precision = tpCount / (tpCount + fpCount)
+	# highest precision at this recall or any higher one
+	envelope = np.maximum.accumulate(precision[:, ::-1], axis=1)[:, ::-1]
+	recallSteps = np.diff(np.concatenate((np.zeros((thresholdCount, 1)), recall), axis=1), axis=1)
+	return (recallSteps * envelope).sum(axis=1), precision[:, -1], recall[:, -1]
+
+
+def evaluate(samples, predictions, level5Data, classes=('car',), thresholds=lyftThresholds,
+			 workers=Constants.preprocessWorkers, chunksize=4):
+	'''
+	Scores predictions of many samples against their ground truth.
+	:param samples: List of samples that were predicted
+	:param predictions: iterable of (boxes, probs) or (boxes, probs, classes) for each sample, in the same order as
+		samples. boxes are n,7 in the car's frame (see regionsToCarFrame), classes are Constants.catToNum ids and are
+		all car if left out. Can be a generator, like rpnToRegions over a split.
+	:param level5Data: The Level 5 Dataset the samples are from.
+	:param classes: names of the categories to score
+	:param thresholds: IoU thresholds a prediction has to reach to match a ground truth box
+	:param workers: number of worker processes
+	:param chunksize: number of samples a worker takes at a time
+	:return: dict with 'mAP' (mean of the average precision over classes and thresholds), 'thresholds', 'classes'
+		with the 'ap', 'precision' and 'recall' at each threshold and the 'gtCount' of each class name, and
+		'sampleTimes' with the 'token', 'groundTruthSeconds', 'iouSeconds', 'matchSeconds' and 'totalSeconds' of
+		each sample
+	'''
+	thresholds = np.asarray(thresholds, dtype=np.float64)
+	classIds = [Constants.catToNum[name] for name in classes]
+
+	# ground truth time of each sample handed out, in sample order like the results
+	groundTruthSeconds = deque()
+
+	def jobs():
+		for sample, prediction in zip(samples, predictions):
+			startTime = time.time()
+			gtBoxes, gtClasses = getLabelsInRange(sample, level5Data)
+			groundTruthSeconds.append(time.time() - startTime)
+			predBoxes = np.asarray(prediction[0], dtype=np.float64).reshape(-1, 7)
+			predProbs = np.asarray(prediction[1], dtype=np.float64).reshape(-1)
+			if len(prediction) > 2:
+				predClasses = np.asarray(prediction[2]).reshape(-1)
+			else:
+				predClasses = np.full(len(predBoxes), Constants.catToNum['car'])
+			yield sample['token'], predBoxes, predProbs, predClasses, gtBoxes, gtClasses, classIds, thresholds
+
+	allProbs = {classId: [] for classId in classIds}
+	allTruePositives = {classId: [] for classId in classIds}
+	gtCounts = {classId: 0 for classId in classIds}
+	sampleTimes = []
+	for i, ((matches, timing), seconds) in enumerate(parallel_preprocessing.mapJobs(evaluateJob, jobs(), workers,
+																					 chunksize)):
+		for classId, (probs, truePositives, gtCount) in matches.items():
+			allProbs[classId].append(probs)
+			allTruePositives[classId].append(truePositives)
+			gtCounts[classId] += gtCount
+		timing['totalSeconds'] = seconds
+		timing['groundTruthSeconds'] = groundTruthSeconds.popleft()
+		sampleTimes.append(timing)
+		if i % 100 == 0:
+			print('evaluated sample ' + str(i))
+
+	results = {'thresholds': thresholds, 'classes': {}, 'sampleTimes': sampleTimes}
+	for name, classId in zip(classes, classIds):
+		probs = np.concatenate(allProbs[classId]) if allProbs[classId] else np.zeros(0)
+		truePositives = np.concatenate(allTruePositives[classId], axis=1) if allTruePositives[classId] \
+			else np.zeros((len(thresholds), 0), dtype=bool)
+		ap, precision, recall = averagePrecision(probs, truePositives, gtCounts[classId])
+		results['classes'][name] = {'ap': ap, 'precision': precision, 'recall': recall,
+									'gtCount': gtCounts[classId]}
+	# classes without any ground truth don't count towards the mean
+	scored = [result['ap'].mean() for result in results['classes'].values() if result['gtCount'] > 0]
+	results['mAP'] = float(np.mean(scored)) if scored else 0.
+	return results
@@ -0,0 +1,159 @@
+import inspect
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import BatchNormalization, Conv2D, Conv2DTranspose, Layer
+from tensorflow.keras.models import load_model
+
+import Constants
+from model_training import customLayers, loadCurrentModel
+
+# Exports a trained model as a SavedModel made for inference: batch normalization folded into the convolutions,
+# a fixed input signature, and an XLA compiled serving function. Load it with InferenceModel, which predictMain
+# takes in place of a Keras model.
+
+# tf.function's argument for XLA, renamed in newer TensorFlow versions
+compileArgument = 'jit_compile' if 'jit_compile' in inspect.signature(tf.function).parameters \
+	else 'experimental_compile'
+
+
+# Stands in for a BatchNormalization folded into the Conv2D before it. Passes its input on, and takes the other
+# arguments the BatchNormalization was called with (Keras 3 calls it with a mask) so the model can be cloned.
+class FoldedNormalization(Layer):
+	def call(self, inputs, **kwargs):
+		return inputs
+
+
+def foldBatchNorm(model):
+	'''
+	Copy of a model for inference, with each BatchNormalization that directly follows a Conv2D folded into the
+	Conv2D's kernel and bias using its moving averages. The folded BatchNormalization layers are replaced by
+	FoldedNormalization layers so the copy has the same layers. PointwiseDenseLayer already folds its own normalization when not
+	training.
+	'''
+	# layer making each single tensor output, to find what each BatchNormalization is called on
+	producers = {id(layer.output): layer for layer in model.layers if not isinstance(layer.output, (list, tuple))}
+	# name of the Conv2D before each BatchNormalization that can be folded
+	convOfNorm = {}
+	for layer in model.layers:
+		if not isinstance(layer, BatchNormalization):
+			continue
+		inbound = producers.get(id(layer.input))
+		if isinstance(inbound, Conv2D) and not isinstance(inbound, Conv2DTranspose) and inbound.use_bias:
+			convOfNorm[layer.name] = inbound.name
+	normOfConv = {conv: norm for norm, conv in convOfNorm.items()}
+
+	def cloneLayer(layer):
+		if layer.name in convOfNorm:
+			return FoldedNormalization(name=layer.name)
+		return layer.__class__.from_config(layer.get_config())
+
+	with tf.keras.utils.custom_object_scope(customLayers):
+		folded = tf.keras.models.clone_model(model, clone_function=cloneLayer)
+	for layer in model.layers:
+		if layer.name in convOfNorm:
+			continue
+		weights = layer.get_weights()
+		if layer.name in normOfConv:
+			norm = model.get_layer(normOfConv[layer.name])
+			gamma, beta, mean, variance = norm.get_weights()
+			scale = gamma / np.sqrt(variance + norm.epsilon)
+			kernel, bias = weights
+			weights = [kernel * scale, (bias - mean) * scale + beta]
+		folded.get_layer(layer.name).set_weights(weights)
+	return folded
+
+
+def inputSignature(sparse_input):
+	features = Constants.storageDtype
+	if sparse_input:
+		return [tf.TensorSpec((None, None, Constants.maxPoints, 6), features, name='features'),
+				tf.TensorSpec((None, None, 3), tf.int32, name='coords')]
+	return [tf.TensorSpec((None, Constants.nz, Constants.nx, Constants.ny, Constants.maxPoints, 6), features,
+						  name='voxels')]
+
+
+def exportInferenceModel(model_path, export_path, sparse_input=False, precision=Constants.precisionPolicy, jit=None):
+	'''
+	Exports the model saved at model_path for inference.
+	:param model_path: location of the .h5 file, loaded with loadCurrentModel so older models work too
+	:param export_path: directory to save the SavedModel to
+	:param sparse_input: export the sparse input model from createSparseModel instead of the dense one
+	:param precision: precision policy of the exported model, see setPrecisionPolicy
+	:param jit: compile the serving function with XLA. Defaults to the dense model only, the sparse model's voxel
+		count changes every sample and its scatter drops the padding with a dynamic shape.
+	'''
+	jit = not sparse_input if jit is None else jit
+	model = foldBatchNorm(loadCurrentModel(model_path, sparse_input, 0, precision))
+
+	@tf.function(input_signature=inputSignature(sparse_input), **{compileArgument: jit})
+	def serve(*inputs):
+		probability, regression = model(list(inputs) if sparse_input else inputs[0], training=False)
+		return {'probability': probability, 'regression': regression}
+
+	module = tf.Module()
+	# only the variables the serving function needs, not the Keras model, so loading doesn't restore every layer's
+	# functions and config
+	module.weights = list(model.variables)
+	module.serve = serve
+	module.sparseInput = tf.Variable(sparse_input, trainable=False)
+	tf.saved_model.save(module, export_path, signatures={'serving_default': serve})
+
+
+class InferenceModel:
+	'''
+	A model exported by exportInferenceModel. predict works like the Keras model's for a single batch.
+	'''
+
+	def __init__(self, export_path):
+		self.module = tf.saved_model.load(export_path)
+		self.sparseInput = bool(self.module.sparseInput.numpy())
+
+	def predict(self, modelInput):
+		'''
+		:param modelInput: [features, coords] for a sparse model, the dense voxel grid batch otherwise
+		:return: probability and regression maps as numpy arrays
+		'''
+		inputs = modelInput if self.sparseInput else [modelInput]
+		outputs = self.module.serve(*[tf.convert_to_tensor(array) for array in inputs])
+		return outputs['probability'].numpy(), outputs['regression'].numpy()
+
+
+# Times loading and predicting with the .h5 model and model.predict against the exported model, on random dense input.
+def compareWithKeras(model_path, export_path, repeats=5):
+	startTime = time.time()
+	kerasModel = load_model(model_path, custom_objects=customLayers, compile=False)
+	kerasLoadSeconds = time.time() - startTime
+	startTime = time.time()
+	inferenceModel = InferenceModel(export_path)
+	exportLoadSeconds = time.time() - startTime
+
+	rng = np.random.default_rng(0)
+	modelInput = rng.standard_normal((1, Constants.nz, Constants.nx, Constants.ny, Constants.maxPoints, 6)) \
+		.astype(Constants.storageDtype)
+	# first calls build the graphs, and compile the exported one with XLA
+	startTime = time.time()
+	expected = kerasModel.predict(modelInput, verbose=0)
+	kerasFirstSeconds = time.time() - startTime
+	startTime = time.time()
+	inferenceModel.predict(modelInput)
+	exportFirstSeconds = time.time() - startTime
+	startTime = time.time()
+	for _ in range(repeats):
+		kerasModel.predict(modelInput, verbose=0)
+	kerasSeconds = (time.time() - startTime) / repeats
+	startTime = time.time()
+	for _ in range(repeats):
+		outputs = inferenceModel.predict(modelInput)
+	exportSeconds = (time.time() - startTime) / repeats
+	print('load: h5 ' + '%.2f' % kerasLoadSeconds + 's, exported ' + '%.2f' % exportLoadSeconds + 's')
+	print('first sample: model.predict ' + '%.2f' % kerasFirstSeconds + 's, exported ' + '%.2f' % exportFirstSeconds
+		  + 's')
+	print('per sample: model.predict ' + '%.3f' % kerasSeconds + 's, exported ' + '%.3f' % exportSeconds + 's,'
+		  + ' max difference ' + '%.2e' % max(np.abs(output - value).max() for output, value in zip(outputs, expected)))
+
+
+if __name__ == '__main__':
+	exportInferenceModel('fixedTheta\\15SampleEpoch0_fixed.h5', 'fixedTheta\\15SampleEpoch0_inference')
+	compareWithKeras('fixedTheta\\15SampleEpoch0_fixed.h5', 'fixedTheta\\15SampleEpoch0_inference')
@@ -0,0 +1,137 @@
+import numpy as np
+import tensorflow as tf
+
+import Constants
+from evaluation import regionsToCarFrame
+from model_export import foldBatchNorm
+from model_training import loadCurrentModel, getSampleVoxels, voxelsToDense
+from rpnToRegion import rpnToRegion, calcIoUAll
+
+# Post-training int8 quantization of the dense model for CPU inference with TensorFlow Lite. The ranges of the
+# activations are calibrated on a few real samples. Ops TensorFlow Lite can't run in int8 stay float, and ops it
+# doesn't have at all run as TensorFlow ops. The input and outputs stay float.
+
+
+# Dense model inputs of the samples, one batch of 1 at a time, the way predictMain makes them.
+def calibrationInputs(samples, level5Data):
+	for sample in samples:
+		yield [voxelsToDense(*getSampleVoxels(sample, level5Data))[None]]
+
+
+def quantizeModel(model_path, quantized_path, samples, level5Data):
+	'''
+	Makes an int8 TensorFlow Lite model of the dense model saved at model_path.
+	:param model_path: location of the .h5 file, loaded with loadCurrentModel so older models work too
+	:param quantized_path: location to save the .tflite file to
+	:param samples: a handful of samples to calibrate the activation ranges on
+	:param level5Data: The Level 5 Dataset the samples are from.
+	'''
+	# batch normalization is folded first so it isn't quantized on its own
+	model = foldBatchNorm(loadCurrentModel(model_path, False, 0, 'float32'))
+	converter = tf.lite.TFLiteConverter.from_keras_model(model)
+	converter.optimizations = [tf.lite.Optimize.DEFAULT]
+	converter.representative_dataset = lambda: calibrationInputs(samples, level5Data)
+	converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8, tf.lite.OpsSet.TFLITE_BUILTINS,
+										   tf.lite.OpsSet.SELECT_TF_OPS]
+	with open(quantized_path, 'wb') as f:
+		f.write(converter.convert())
+
+
+class QuantizedModel:
+	'''
+	A model made by quantizeModel. predict works like the Keras model's for a single sample.
+	'''
+
+	sparseInput = False
+
+	def __init__(self, quantized_path, threads=None):
+		self.interpreter = tf.lite.Interpreter(model_path=quantized_path, num_threads=threads)
+		self.interpreter.allocate_tensors()
+		self.input = self.interpreter.get_input_details()[0]
+		# tell the outputs apart by their channel count, their order isn't fixed
+		outputs = {details['shape'][-1]: details for details in self.interpreter.get_output_details()}
+		self.probability = outputs[len(Constants.anchors)]
+		self.regression = outputs[len(Constants.anchors) * 7]
+
+	def opDtypes(self):
+		'''
+		Counts the ops of the model by their name and the dtype of their first input, to see which ones run in int8.
+		The interpreter only lists its ops through a private method, so if it doesn't have that the tensors are counted
+		by their dtype instead, with 'tensor' as the op name.
+		:return: dict of (op name, dtype name) to count
+		'''
+		tensors = {details['index']: details for details in self.interpreter.get_tensor_details()}
+		counts = {}
+		getOps = getattr(self.interpreter, '_get_ops_details', None)
+		if getOps is None:
+			for details in tensors.values():
+				key = ('tensor', np.dtype(details['dtype']).name)
+				counts[key] = counts.get(key, 0) + 1
+			return counts
+		for op in getOps():
+			inputs = [index for index in op['inputs'] if index >= 0]
+			key = (op['op_name'], np.dtype(tensors[inputs[0]]['dtype']).name if inputs else 'none')
+			counts[key] = counts.get(key, 0) + 1
+		return counts
+
+	def predict(self, modelInput):
+		'''
+		:param modelInput: the dense voxel grid of one sample, with a batch axis of 1
+		:return: probability and regression maps as numpy arrays
+		'''
+		self.interpreter.set_tensor(self.input['index'], np.asarray(modelInput, dtype=self.input['dtype']))
+		self.interpreter.invoke()
+		return self.interpreter.get_tensor(self.probability['index']), \
+			self.interpreter.get_tensor(self.regression['index'])
+
+
+def compareWithFloat(model_path, quantized_path, samples, level5Data):
+	'''
+	Reports the dtypes the quantized model's ops run in, and how much its output differs from the float model's on
+	samples: the mean and max absolute error of the class and regression maps, and calcIoUAll of the boxes each one
+	finds with the ground truth.
+	:return: list of a dict of those values for each sample
+	'''
+	floatModel = loadCurrentModel(model_path, False, 0, 'float32')
+	quantizedModel = QuantizedModel(quantized_path)
+	for (opName, dtype), count in sorted(quantizedModel.opDtypes().items()):
+		print(opName + ' ' + dtype + ': ' + str(count))
+	results = []
+	for sample, (modelInput,) in zip(samples, calibrationInputs(samples, level5Data)):
+		floatOutputs = floatModel.predict(modelInput)
+		quantizedOutputs = quantizedModel.predict(modelInput)
+		result = {'token': sample['token']}
+		for name, floatOutput, quantizedOutput in zip(['class', 'regress'], floatOutputs, quantizedOutputs):
+			error = np.abs(quantizedOutput - floatOutput)
+			result[name + 'MeanError'] = float(error.mean())
+			result[name + 'MaxError'] = float(error.max())
+		for name, (prob, regress) in zip(['float', 'quantized'], [floatOutputs, quantizedOutputs]):
+			boxes = regionsToCarFrame(rpnToRegion(prob[0], regress[0])[0])
+			try:
+				result[name + 'IoU'] = calcIoUAll(boxes, sample, level5Data)
+			except ZeroDivisionError:
+				# no predicted or ground truth boxes at all
+				result[name + 'IoU'] = float('nan')
+		print('sample ' + sample['token'] + ': class map error mean ' + '%.2e' % result['classMeanError']
+			  + ' max ' + '%.2e' % result['classMaxError'] + ', regression map error mean '
+			  + '%.2e' % result['regressMeanError'] + ' max ' + '%.2e' % result['regressMaxError']
+			  + ', IoU float ' + '%.3f' % result['floatIoU'] + ' quantized ' + '%.3f' % result['quantizedIoU'])
+		results.append(result)
+	return results
+
+
+if __name__ == '__main__':
+	from lyft_dataset_sdk.lyftdataset import LyftDataset
+
+	# load dataset
+	level5Data = LyftDataset(
+		data_path=Constants.lyft_data_dir,
+		json_path=Constants.lyft_data_dir + '\\train_data',
+		verbose=True
+	)
+	samples = [level5Data.get('sample', scene['first_sample_token']) for scene in level5Data.scene]
+	# calibrate on a few samples, then compare on others
+	quantizeModel('fixedTheta\\15SampleEpoch0_fixed.h5', 'fixedTheta\\15SampleEpoch0_int8.tflite', samples[:8],
+				  level5Data)
+	compareWithFloat('fixedTheta\\15SampleEpoch0_fixed.h5', 'fixedTheta\\15SampleEpoch0_int8.tflite', samples[8:12],
+					 level5Data)
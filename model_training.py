@@ -3,32 +3,29 @@ import matplotlib
 matplotlib.use('agg')
 from lyft_dataset_sdk.lyftdataset import LyftDataset
 from tensorflow.keras.models import Model, load_model
-from tensorflow.keras.layers import Dense, Input, BatchNormalization, Layer, Concatenate, Conv3D, ZeroPadding3D, \
+from tensorflow.keras.layers import Input, BatchNormalization, Layer, Concatenate, Conv3D, ZeroPadding3D, \
 	Reshape, Permute, ZeroPadding2D, Conv2D, Conv2DTranspose, Activation
-from tensorflow.keras.utils import plot_model
 import tensorflow.keras.backend as tf_backend
 import tensorflow as tf
 from tensorflow.keras import optimizers
 
 import numpy as np
-from pyquaternion import Quaternion
-from matplotlib import pyplot as plt
 from math import floor
 import os
-from tensorflow import SparseTensor, sparse
-import math
-import time
-from shapely.geometry import Polygon
+from tensorflow import SparseTensor
 
 import Constants
+import parallel_preprocessing
+import point_shards
+import preprocess_cache
+import serialize_data
+from point_cloud import voxelizePoints, getLidarSensorFrames, combineLidarFiles
 
-from tensorflow.python.framework.ops import disable_eager_execution
-
-# disable_eager_execution()
 print('Eager execution on?:', tf.executing_eagerly())
 
 
 # helper layer that transforms the (None, 250, 500, 10, 1, 6) into (None, 250, 500, 10, 35, 6) for concat
+# Only in models saved before VFEBlockLayer, kept so they still load.
 class RepeatLayer(Layer):
 	def __init__(self, **kwargs):
 		super(RepeatLayer, self).__init__(**kwargs)
@@ -61,41 +58,300 @@ class MaxPoolingVFELayer(Layer):
 		return baseConfig
 
 
-# Uses quaternions to rotate all points in a scene to match the location of the lidar sensor on the car.
-def rotate_points(points, rotation, inverse=False):
-	quaternion = Quaternion(rotation)
-	if inverse:
-		quaternion = quaternion.inverse
-	return np.dot(quaternion.rotation_matrix, points.T).T
+# Dense layer without bias applied to the last axis of a tensor of any rank, so rank 5 and 6 tensors don't need to be
+# reshaped around it. Can also do the batch normalization next to the Dense layer it replaces, 'before' or 'after' the
+# linear part, and its activation. When not training the batch normalization is folded into the kernel, so the
+# activations are only gone over once.
+# With a reduced precision policy the kernel is used in the compute dtype, but the batch normalization is done in
+# float32, so the weights aren't autocast and the layer does its own casts.
+# Also takes the [pooled, pointwise] output of VFEBlockLayer in place of their concatenation. The kernel rows of the
+# pooled features are then applied to the (..., 1, channels) pooled tensor and broadcast onto the pointwise part, so
+# the concatenation is never built.
+# Has the same weights as the Dense and BatchNormalization layers it replaces, see copyWeights.
+class PointwiseDenseLayer(Layer):
+	def __init__(self, units, activation=None, batchNorm=None, momentum=0.99, epsilon=1e-3, **kwargs):
+		super(PointwiseDenseLayer, self).__init__(autocast=False, **kwargs)
+		self.units = units
+		self.activation = tf.keras.activations.get(activation)
+		self.batchNorm = batchNorm
+		self.momentum = momentum
+		self.epsilon = epsilon
+
+	def build(self, inputShape):
+		if isinstance(inputShape, (list, tuple)) and not isinstance(inputShape[0], (int, type(None))):
+			if self.batchNorm == 'before':
+				raise ValueError('PointwiseDenseLayer can only normalize [pooled, pointwise] inputs after the linear part')
+			channels = sum(int(shape[-1]) for shape in inputShape)
+		else:
+			channels = int(inputShape[-1])
+		normChannels = channels if self.batchNorm == 'before' else self.units
+		if self.batchNorm == 'before':
+			self.addNormWeights(normChannels)
+		self.kernel = self.add_weight(name='kernel', shape=(channels, self.units), initializer='glorot_uniform',
+									  trainable=True)
+		if self.batchNorm == 'after':
+			self.addNormWeights(normChannels)
+		if self.batchNorm is not None:
+			self.movingMean = self.add_weight(name='moving_mean', shape=(normChannels,), initializer='zeros',
+											  trainable=False)
+			self.movingVariance = self.add_weight(name='moving_variance', shape=(normChannels,), initializer='ones',
+												  trainable=False)
+		super(PointwiseDenseLayer, self).build(inputShape)
+
+	def addNormWeights(self, channels):
+		self.gamma = self.add_weight(name='gamma', shape=(channels,), initializer='ones', trainable=True)
+		self.beta = self.add_weight(name='beta', shape=(channels,), initializer='zeros', trainable=True)
 
+	def compute_output_shape(self, inputShape):
+		if isinstance(inputShape, (list, tuple)) and not isinstance(inputShape[0], (int, type(None))):
+			inputShape = inputShape[-1]
+		return tuple(inputShape[:-1]) + (self.units,)
+
+	# inputs times kernel, with the rows of the kernel split between the pooled and pointwise parts of a VFEBlockLayer
+	# output
+	def linear(self, inputs, kernel):
+		kernel = tf.cast(kernel, self.compute_dtype)
+		if not isinstance(inputs, (list, tuple)):
+			return tf.tensordot(inputs, kernel, axes=1)
+		pooling, layer = inputs
+		poolChannels = pooling.shape[-1]
+		return tf.tensordot(layer, kernel[poolChannels:], axes=1) + tf.tensordot(pooling, kernel[:poolChannels], axes=1)
+
+	# batch normalization with the batch's statistics, and moves the moving averages towards them unless
+	# updateMovingAverages is False. With a voxelMask, only the voxels where it is True count towards the statistics.
+	def normalizeBatch(self, inputs, updateMovingAverages=True, voxelMask=None):
+		axes = list(range(len(inputs.shape) - 1))
+		normalized = tf.cast(inputs, tf.float32)
+		if voxelMask is None:
+			mean, variance = tf.nn.moments(normalized, axes)
+		else:
+			# (None, voxels) mask broadcast over the point and channel axes
+			weights = tf.cast(voxelMask, tf.float32)
+			for _ in range(len(inputs.shape) - len(voxelMask.shape)):
+				weights = weights[..., None]
+			mean, variance = tf.nn.weighted_moments(normalized, axes, weights)
+		gamma, beta, movingMean, movingVariance = self.normWeights()
+		updates = []
+		if updateMovingAverages:
+			updates = [self.movingMean.assign(movingMean * self.momentum + mean * (1 - self.momentum)),
+					   self.movingVariance.assign(movingVariance * self.momentum + variance * (1 - self.momentum))]
+		with tf.control_dependencies(updates):
+			normalized = tf.nn.batch_normalization(normalized, mean, variance, beta, gamma, self.epsilon)
+		return tf.cast(normalized, self.compute_dtype)
+
+	# gamma, beta, moving mean and moving variance as float32. Read inside a layer that autocasts, like VFEBlockLayer or
+	# RecomputeLayer under a mixed policy, they would come in the compute dtype even though this layer doesn't autocast.
+	def normWeights(self):
+		return [tf.cast(weight, tf.float32) for weight in [self.gamma, self.beta, self.movingMean, self.movingVariance]]
+
+	def trainingCall(self, inputs, updateMovingAverages=True, voxelMask=None):
+		if self.batchNorm == 'before':
+			inputs = self.normalizeBatch(inputs, updateMovingAverages, voxelMask)
+		layer = self.linear(inputs, self.kernel)
+		if self.batchNorm == 'after':
+			layer = self.normalizeBatch(layer, updateMovingAverages, voxelMask)
+		return self.activation(layer)
+
+	def inferenceCall(self, inputs):
+		if self.batchNorm is None:
+			return self.activation(self.linear(inputs, self.kernel))
+		# normalizing is x * scale + shift with the moving averages
+		gamma, beta, movingMean, movingVariance = self.normWeights()
+		scale = gamma * tf.math.rsqrt(movingVariance + self.epsilon)
+		shift = beta - movingMean * scale
+		kernel = tf.cast(self.kernel, tf.float32)
+		if self.batchNorm == 'before':
+			bias = tf.tensordot(shift, kernel, axes=1)
+			kernel = scale[:, None] * kernel
+		else:
+			kernel = kernel * scale
+			bias = shift
+		layer = self.linear(inputs, kernel)
+		return self.activation(layer + tf.cast(bias, self.compute_dtype))
+
+	# updateMovingAverages is False when RecomputeLayer computes the layer again for the backward pass, so the moving
+	# averages are only moved once per step.
+	# voxelMask is (None, voxels) and False for the padding voxels of the sparse model, see VoxelMaskLayer.
+	def call(self, inputs, training=None, updateMovingAverages=True, voxelMask=None, **kwargs):
+		if isinstance(inputs, (list, tuple)):
+			inputs = [tf.cast(part, self.compute_dtype) for part in inputs]
+		else:
+			inputs = tf.cast(inputs, self.compute_dtype)
+		if self.batchNorm is None or not training:
+			return self.inferenceCall(inputs)
+		return self.trainingCall(inputs, updateMovingAverages, voxelMask)
 
-# Takes the sample dict and returns an array of n,3 with every point in the sample.
-def combine_lidar_data(sample, dataDir, level5Data):
-	sensorTypes = ['LIDAR_TOP', 'LIDAR_FRONT_RIGHT', 'LIDAR_FRONT_LEFT']
-	# Account for not all samples having all liar data for some reason
-	actualSensorTypes = []
-	for sensorType in sensorTypes:
-		if sensorType in sample['data']:
-			actualSensorTypes.append(sensorType)
+	def get_config(self):
+		baseConfig = super(PointwiseDenseLayer, self).get_config()
+		baseConfig['units'] = self.units
+		baseConfig['activation'] = tf.keras.activations.serialize(self.activation)
+		baseConfig['batchNorm'] = self.batchNorm
+		baseConfig['momentum'] = self.momentum
+		baseConfig['epsilon'] = self.epsilon
+		return baseConfig
+
+
+# Whole VFE block as one layer: pointwise FCN (linear, batch normalize, then relu) and max pooling over the points of
+# each voxel. The output is [pooled, pointwise], the two halves of the old concatenation of the pooled features in
+# front of every point's features. The pooled half keeps its point axis of 1, and the PointwiseDenseLayer after the
+# block broadcasts it after its linear part, so the features are never repeated for every point like RepeatLayer did.
+# The linear part works on any rank (see PointwiseDenseLayer) so the rank 6 dense input doesn't need Reshape layers
+# either.
+# Has the same weights as the Dense and BatchNormalization layers it replaces, see copyWeights.
+class VFEBlockLayer(Layer):
+	def __init__(self, units, **kwargs):
+		super(VFEBlockLayer, self).__init__(**kwargs)
+		self.units = units
+		self.fcn = PointwiseDenseLayer(units, 'relu', batchNorm='after')
+
+	def build(self, inputShape):
+		self.fcn.build(inputShape)
+		super(VFEBlockLayer, self).build(inputShape)
+
+	def compute_output_shape(self, inputShape):
+		outputShape = self.fcn.compute_output_shape(inputShape)
+		pooledShape = outputShape[:Constants.pointIndex] + (1,) + outputShape[Constants.pointIndex + 1:]
+		return [pooledShape, outputShape]
+
+	def call(self, inputs, training=None, updateMovingAverages=True, voxelMask=None, **kwargs):
+		layer = self.fcn(inputs, training=training, updateMovingAverages=updateMovingAverages, voxelMask=voxelMask)
+		pooling = tf_backend.max(layer, axis=Constants.pointIndex, keepdims=True)
+		return [pooling, layer]
+
+	def get_config(self):
+		baseConfig = super(VFEBlockLayer, self).get_config()
+		baseConfig['units'] = self.units
+		return baseConfig
+
+
+# Runs a list of layers in order like a small Sequential model. While training, the activations inside are not kept
+# for the backward pass but computed again from the input (tf.recompute_grad), so only the input and output of the
+# whole segment are stored. Used for the VFE and Conv3D blocks, see addBlocks.
+# Batch normalization moving averages are only updated by the forward pass, not again when the segment is recomputed.
+class RecomputeLayer(Layer):
+	def __init__(self, layers, **kwargs):
+		super(RecomputeLayer, self).__init__(**kwargs)
+		self.segmentLayers = list(layers)
+
+	def compute_output_shape(self, inputShape):
+		for layer in self.segmentLayers:
+			inputShape = layer.compute_output_shape(inputShape)
+		return inputShape
+
+	def runLayers(self, inputs, training=None, updateMovingAverages=True, voxelMask=None):
+		for layer in self.segmentLayers:
+			if isinstance(layer, (PointwiseDenseLayer, VFEBlockLayer)):
+				inputs = layer(inputs, training=training, updateMovingAverages=updateMovingAverages,
+							   voxelMask=voxelMask)
+			else:
+				inputs = layer(inputs, training=training)
+		return inputs
+
+	def call(self, inputs, training=None, voxelMask=None, **kwargs):
+		if not training:
+			return self.runLayers(inputs, training, voxelMask=voxelMask)
+		# tf.recompute_grad runs the segment once for the forward pass, then again for each gradient (or each trace of
+		# it in a graph), and only the first run moves the moving averages
+		runs = []
+
+		def segment(*layers):
+			runs.append(True)
+			# the [pooled, pointwise] output of a VFEBlockLayer is passed as separate tensors
+			return self.runLayers(list(layers) if len(layers) > 1 else layers[0], True, len(runs) == 1, voxelMask)
+
+		if isinstance(inputs, (list, tuple)):
+			return tf.recompute_grad(segment)(*inputs)
+		return tf.recompute_grad(segment)(inputs)
+
+	def get_config(self):
+		baseConfig = super(RecomputeLayer, self).get_config()
+		baseConfig['layers'] = [tf.keras.layers.serialize(layer) for layer in self.segmentLayers]
+		return baseConfig
+
+	@classmethod
+	def from_config(cls, config):
+		config = dict(config)
+		layers = [tf.keras.layers.deserialize(layer, custom_objects=customLayers) for layer in config.pop('layers')]
+		return cls(layers, **config)
+
+
+# helper layer for the sparse model that adds an all 0 voxel to the end of every sample's voxel list.
+# After the VFE layers this voxel holds the features of an empty voxel, which ScatterVoxelLayer uses as background.
+class EmptyVoxelLayer(Layer):
+	def __init__(self, **kwargs):
+		super(EmptyVoxelLayer, self).__init__(**kwargs)
+
+	def compute_output_shape(self, inputShape):
+		numVoxels = None if inputShape[1] is None else inputShape[1] + 1
+		return inputShape[:1] + (numVoxels,) + inputShape[2:]
+
+	def call(self, inputs, **kwargs):
+		return tf.concat([inputs, tf.zeros_like(inputs[:, :1])], axis=1)
+
+
+# Mask of the real voxels of the sparse model, (None, voxels + 1) from the (None, voxels, 3) coords. Padding voxels
+# (coordinates of -1) and the voxel added by EmptyVoxelLayer are False, so they are left out of the batch
+# normalization statistics of the VFE layers and don't change with how much padding a batch has.
+class VoxelMaskLayer(Layer):
+	def __init__(self, **kwargs):
+		super(VoxelMaskLayer, self).__init__(**kwargs)
+
+	def compute_output_shape(self, inputShape):
+		numVoxels = None if inputShape[1] is None else inputShape[1] + 1
+		return inputShape[:1] + (numVoxels,)
+
+	def call(self, inputs, **kwargs):
+		valid = inputs[:, :, 0] >= 0
+		return tf.concat([valid, tf.zeros_like(valid[:, :1])], axis=1)
+
+
+# Scatters the (None, voxels + 1, 64) VFE output of the sparse model into the (None, 8, 200, 400, 64) grid
+# the Conv3D layers expect. Voxels with coordinates of -1 are padding and are dropped.
+class ScatterVoxelLayer(Layer):
+	def __init__(self, gridShape, **kwargs):
+		super(ScatterVoxelLayer, self).__init__(**kwargs)
+		self.gridShape = tuple(gridShape)
+
+	def compute_output_shape(self, inputShape):
+		return inputShape[0][:1] + self.gridShape + inputShape[0][-1:]
 
-	sensorFrameMetadata = [level5Data.get('sample_data', sample['data'][x]) for x in actualSensorTypes]
-	allPoints = []
-	for sensorFrame in sensorFrameMetadata:
-		sensor = level5Data.get('calibrated_sensor', sensorFrame['calibrated_sensor_token'])
-		# get points
-		filePath = sensorFrame['filename'].replace('/', '\\')
-		rawPoints = np.fromfile(os.path.join(dataDir, filePath), dtype=np.float32)
+	def call(self, inputs, **kwargs):
+		features, coords = inputs
+		channels = features.shape[-1]
+		# last voxel is the one added by EmptyVoxelLayer
+		background = features[:, -1:]
+		features = features[:, :-1] - background
+		batchSize = tf.shape(coords)[0]
+		batchIdx = tf.tile(tf.range(batchSize)[:, None, None], [1, tf.shape(coords)[1], 1])
+		indices = tf.concat([batchIdx, tf.cast(coords, tf.int32)], axis=-1)
+		valid = coords[:, :, 0] >= 0
+		grid = tf.scatter_nd(tf.boolean_mask(indices, valid), tf.boolean_mask(features, valid),
+							 tf.concat([[batchSize], self.gridShape, [channels]], axis=0))
+		grid = tf.reshape(grid, (-1,) + self.gridShape + (channels,))
+		return grid + background[:, :, None, None, :]
+
+	def get_config(self):
+		baseConfig = super(ScatterVoxelLayer, self).get_config()
+		baseConfig['gridShape'] = self.gridShape
+		return baseConfig
 
-		# need to translate points to correct place.
-		rawPoints = rawPoints.reshape(-1, 5)[:, :3]
 
-		# need to rotate points per sensor, then translate to position of sensor before combining
-		points = rotate_points(rawPoints, sensor['rotation'])
-		points = points + np.array(sensor['translation'])
-		allPoints.append(points)
-	allPoints = np.concatenate(allPoints)
+# custom layers needed to load any of the models in this file
+customLayers = {
+	'RepeatLayer': RepeatLayer,
+	'MaxPoolingVFELayer': MaxPoolingVFELayer,
+	'PointwiseDenseLayer': PointwiseDenseLayer,
+	'VFEBlockLayer': VFEBlockLayer,
+	'RecomputeLayer': RecomputeLayer,
+	'EmptyVoxelLayer': EmptyVoxelLayer,
+	'VoxelMaskLayer': VoxelMaskLayer,
+	'ScatterVoxelLayer': ScatterVoxelLayer
+}
 
-	return allPoints
+
+# Takes the sample dict and returns an array of n,3 with every point in the sample.
+def combine_lidar_data(sample, dataDir, level5Data):
+	return combineLidarFiles(getLidarSensorFrames(sample, level5Data), dataDir)
 
 
 # given a x,y,z, find coordinate of voxel it woul be in.
@@ -108,92 +364,76 @@ def get_voxel(point, xSize, ySize, zSize):
 
 
 # takes an array of size n,3 (every lidar point in sample) and returns array of points to pass into VFE
-# Returns array of size n,6
+# Returns a SparseTensor of size z, x, y, sampleSize, 6
 def VFE_preprocessing(points, xSize, ySize, zSize, sampleSize, maxVoxelX, maxVoxelY, maxVoxelZ):
-	clusteredPoints = {}
-	# Iterate through points and add them to voxels
-	for idx, point in enumerate(points):
-		# expecting n to be around 200,000. Could be bad. Average time on local machine is about ~15 sec
-		key = get_voxel(point, xSize, ySize, zSize)
-		if -maxVoxelX < key[0] and key[0] < maxVoxelX \
-				and -maxVoxelY < key[1] and key[1] < maxVoxelY \
-				and 0 < key[2] and key[2] < maxVoxelZ:
-			# remove negatives.
-			fixedKey = (key[0] + maxVoxelX, key[1] + maxVoxelY, key[2])
-			if fixedKey in clusteredPoints:
-				clusteredPoints[fixedKey].append(idx)
-			else:
-				clusteredPoints[fixedKey] = [idx]
-	# Sample points and fil the rest of the voxel if not full
-	appendedPoints = {}
-	for voxel in clusteredPoints:
-		# sample points, then find center
-		s = sampleSize if len(clusteredPoints[voxel]) > sampleSize else len(clusteredPoints[voxel])
-		sampleIdx = np.random.choice(clusteredPoints[voxel], size=s, replace=False)
-		# get points for this voxel
-		currPoints = points[sampleIdx]
-		centroid = np.mean(currPoints, axis=0)
-		# subtract constant x, y, z values of centroid from each column. Use 0:1 to keep it as a 2D array
-		centroidX = currPoints[:, 0:1] - centroid[0]
-		centroidY = currPoints[:, 1:2] - centroid[1]
-		centroidZ = currPoints[:, 2:3] - centroid[2]
-		concat = np.hstack((currPoints, centroidX, centroidY, centroidZ))
-		buffer = np.vstack((concat, np.zeros((sampleSize - s, 6))))
-		appendedPoints[voxel] = buffer
-	indices = []
-	values = []
-	for voxel in appendedPoints:
-		for i in range(len(appendedPoints[voxel])):
-			for j in range(len(appendedPoints[voxel][i])):
-				indices.append((voxel[2],) + voxel[:2] + (i, j))
-				values.append(appendedPoints[voxel][i][j])
+	features, coords = voxelizePoints(points, xSize, ySize, zSize, sampleSize, maxVoxelX, maxVoxelY, maxVoxelZ)
+	# every (point, column) slot of every non-empty voxel, in the same order as features.reshape(-1)
+	slots = np.stack(np.meshgrid(np.arange(sampleSize), np.arange(6), indexing='ij'), axis=-1).reshape(-1, 2)
+	indices = np.concatenate((np.repeat(coords, len(slots), axis=0), np.tile(slots, (len(coords), 1))), axis=1)
+	values = features.reshape(-1).astype(np.float32)
 	# return as z, x, y
 	return SparseTensor(indices=indices, values=values,
 						dense_shape=[maxVoxelZ, maxVoxelX * 2, maxVoxelY * 2, sampleSize, 6])
 
 
+# The VFE and Conv3D blocks are made as lists of layers, so addBlocks can put several blocks in one RecomputeLayer.
+def vfeLayers(startNum, endNum):
+	# FCN, max pooling and concat in one layer, see VFEBlockLayer
+	return [VFEBlockLayer(endNum // 2)]
+
+
+def fcnLayers(startNum, endNum):
+	# linear, batch normalize, then relu
+	return [PointwiseDenseLayer(endNum, 'relu', batchNorm='after')]
+
+
+# Convolution middle layers.
+# k = kernel size, s = stride size, p = padding to add.
+def conv3DLayers(cin, cout, k, s, p):
+	return [ZeroPadding3D(padding=p),
+			Conv3D(cout, kernel_size=k, strides=s, padding='valid'),
+			# batch normalize, then the dense relu layer
+			PointwiseDenseLayer(cout, 'relu', batchNorm='before')]
+
+
+# kwargs are passed to every layer, like the voxelMask of the VFE layers
+def applyLayers(layer, layers, **kwargs):
+	for nextLayer in layers:
+		layer = nextLayer(layer, **kwargs)
+	return layer
+
+
+def addBlocks(layer, blocks, recomputeSegment=0, **kwargs):
+	'''
+	Adds blocks of layers to the model.
+	:param blocks: list of the layer lists of each block
+	:param recomputeSegment: number of blocks in each RecomputeLayer, so their activations are computed again during
+		the backward pass instead of kept. 0 keeps every activation.
+	:param kwargs: passed to every layer when it is called
+	'''
+	if recomputeSegment <= 0:
+		return applyLayers(layer, [nextLayer for block in blocks for nextLayer in block], **kwargs)
+	for start in range(0, len(blocks), recomputeSegment):
+		layer = RecomputeLayer([nextLayer for block in blocks[start:start + recomputeSegment] for nextLayer in block])(
+			layer, **kwargs)
+	return layer
+
+
 def addVFELayer(layer, startNum, endNum):
-	# FCN is linear, batch normalize, then relu
-	actualEndNum = endNum // 2
-	layer = addFCN(layer, startNum, actualEndNum)
-	# now do the max pooling per
-	pooling = MaxPoolingVFELayer()(layer)
-	pooling = RepeatLayer()(pooling)
-	# Copy the layer list to prevent error cycle in concat.
-	# https://github.com/tensorflow/tensorflow/issues/30355
-	concatLayers = [pooling, layer]
-	out = Concatenate()(concatLayers[:])
-	return out
+	return applyLayers(layer, vfeLayers(startNum, endNum))
 
 
 def addFCN(layer, startNum, endNum):
-	layer = addDenseLayer(layer, endNum)
-	layer = BatchNormalization()(layer)
-	# layer = addDenseLayer(layer, endNum, 'relu')
-	layer = Activation('relu')(layer)
-	return layer
+	return applyLayers(layer, fcnLayers(startNum, endNum))
 
 
-# keras dense layers don't support tensor with rank 5 and above, so we need to temporarily reshape
+# keras dense layers don't support tensor with rank 5 and above, PointwiseDenseLayer works on any rank
 def addDenseLayer(layer, units, act=None):
-	oldShape = layer.shape[1:]
-	pointShape = layer.shape[-2:]
-	combineVoxel = np.prod(np.array(layer.shape[1:-2]))
-	shape = (combineVoxel,) + pointShape
-	layer = Reshape(shape)(layer)
-	layer = Dense(units, input_shape=(layer.shape[1:]), activation=act, use_bias=False)(layer)
-	layer = Reshape(oldShape[:-1] + (units,))(layer)
-	return layer
+	return PointwiseDenseLayer(units, act)(layer)
 
 
-# Convolution middle layers.
-# k = kernel size, s = stride size, p = padding to add.
 def addConv3DLayer(layer, cin, cout, k, s, p):
-	layer = ZeroPadding3D(padding=p)(layer)
-	layer = Conv3D(cout, kernel_size=k, strides=s, padding='valid')(layer)
-	layer = BatchNormalization()(layer)
-	layer = addDenseLayer(layer, layer.shape[-1], 'relu')
-	return layer
+	return applyLayers(layer, conv3DLayers(cin, cout, k, s, p))
 
 
 # Convolution2D layers for RPN
@@ -219,23 +459,23 @@ def getRPNInputShape(layerShape):
 	return layerShape[1:-2] + (layerShape[-2] * layerShape[-1],)
 
 
-def createModel(nx, ny, nz, maxPoints):
-	# Keras time
-	os.environ[
-		"PATH"] += os.pathsep + 'C:\\Program Files\\Graphviz\\bin'
+# VFE layers. Takes the points of every voxel and returns a single feature vector per voxel.
+# recomputeSegment is the number of blocks recomputed together during training, see addBlocks.
+# voxelMask is the (None, voxels) mask of the voxels the batch normalization statistics are taken over, see
+# VoxelMaskLayer. None takes them over every voxel, like the dense model does.
+def addVFEStack(layer, recomputeSegment=0, voxelMask=None):
+	kwargs = {} if voxelMask is None else {'voxelMask': voxelMask}
+	layer = addBlocks(layer, [vfeLayers(6, 32), vfeLayers(32, 64), fcnLayers(64, 64)], recomputeSegment, **kwargs)
+	return MaxPoolingVFELayer(combine=True)(layer)
 
-	# Input is a tensor that separates each voxel. Empty voxels are all 0.
-	# VFE layers
-	inputShape = (nz, nx, ny, maxPoints, 6)
-	inLayer = Input(shape=inputShape, name='InputVoxel')
-	outLayer = addVFELayer(inLayer, 6, 32)
-	outLayer = addVFELayer(outLayer, 32, 64)
-	outLayer = addFCN(outLayer, 64, 64)
+
+# Convolution middle layers and RPN. Takes the (None, nz, nx, ny, 64) voxel feature grid and returns the
+# classification and regression maps.
+def addDetectionLayers(outLayer, recomputeSegment=0):
 	# Convolution layers. Just use default convolution algorithm.
-	outLayer = MaxPoolingVFELayer(combine=True)(outLayer)
-	outLayer = addConv3DLayer(outLayer, 64, 64, 3, (2, 1, 1), (1, 1, 1))
-	outLayer = addConv3DLayer(outLayer, 64, 64, 3, (1, 1, 1), (0, 1, 1))
-	outLayer = addConv3DLayer(outLayer, 64, 64, 3, (2, 1, 1), (1, 1, 1))
+	outLayer = addBlocks(outLayer, [conv3DLayers(64, 64, 3, (2, 1, 1), (1, 1, 1)),
+									conv3DLayers(64, 64, 3, (1, 1, 1), (0, 1, 1)),
+									conv3DLayers(64, 64, 3, (2, 1, 1), (1, 1, 1))], recomputeSegment)
 	# RPN layer time
 	# format data so we can run RPN on it and treat it like a 2D image.
 	# after each rpbConvLayer, decompose and save for concat at end.
@@ -251,99 +491,271 @@ def createModel(nx, ny, nz, maxPoints):
 	rpnConv = addRPNConvLayer(rpnConv, 128, 256, 5)
 	rpnConv3Out = Conv2DTranspose(256, strides=4, kernel_size=4, padding='same')(rpnConv)
 	outLayer = Concatenate()([rpnConv1Out, rpnConv2Out, rpnConv3Out])
-	probabilityLayer = Conv2D(2, kernel_size=1, strides=1, padding='same', name='ClassificationLayer')(outLayer)
-	regressionMap = Conv2D(14, kernel_size=1, strides=1, padding='same', name='RegressionLayer')(outLayer)
+	# the outputs, and so the loss, stay float32 with any precision policy
+	probabilityLayer = Conv2D(2, kernel_size=1, strides=1, padding='same', name='ClassificationLayer',
+							  dtype='float32')(outLayer)
+	regressionMap = Conv2D(14, kernel_size=1, strides=1, padding='same', name='RegressionLayer',
+						   dtype='float32')(outLayer)
+	return probabilityLayer, regressionMap
+
+
+# Sets the Keras precision policy layers made from now on use, 'float32', 'mixed_bfloat16' or 'mixed_float16'.
+# Under the mixed policies weights stay float32 and activations are in the narrow type, except for batch
+# normalization statistics and the output layers. Model.compile adds loss scaling for 'mixed_float16'.
+def setPrecisionPolicy(policy=Constants.precisionPolicy):
+	mixedPrecision = tf.keras.mixed_precision
+	if hasattr(mixedPrecision, 'set_global_policy'):
+		mixedPrecision.set_global_policy(policy)
+	else:
+		mixedPrecision.experimental.set_policy(policy)
+
+
+# recomputeSegment is the number of VFE or Conv3D blocks whose activations are recomputed together during the backward
+# pass instead of kept, see addBlocks. 0 keeps every activation. Doesn't change the weights.
+# precision is the policy the model is made with, see setPrecisionPolicy. Doesn't change the weights either.
+def createModel(nx, ny, nz, maxPoints, recomputeSegment=0, precision=Constants.precisionPolicy):
+	setPrecisionPolicy(precision)
+	# Keras time
+	os.environ[
+		"PATH"] += os.pathsep + 'C:\\Program Files\\Graphviz\\bin'
+
+	# Input is a tensor that separates each voxel. Empty voxels are all 0.
+	# VFE layers
+	inputShape = (nz, nx, ny, maxPoints, 6)
+	inLayer = Input(shape=inputShape, dtype=Constants.storageDtype, name='InputVoxel')
+	outLayer = addVFEStack(inLayer, recomputeSegment)
+	probabilityLayer, regressionMap = addDetectionLayers(outLayer, recomputeSegment)
 	model = Model(inputs=inLayer, outputs=[probabilityLayer, regressionMap])
 	return model
 
 
-def train(samples, level5Data, save_path):
-	# os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
-	labels_dir = 'labels3'
-
-	points = []
-	# for sample in samples:
-	for i in range(len(samples)):
-		# pre-process data
-		sampleLidarPoints = combine_lidar_data(samples[i], Constants.lyft_data_dir, level5Data)
-		startTime = time.time()
-		vfe_points = VFE_preprocessing(sampleLidarPoints,
-										   Constants.voxelx,
-										   Constants.voxely,
-										   Constants.voxelz,
-										   Constants.maxPoints,
-										   Constants.nx // 2,
-										   Constants.ny // 2,
-										   Constants.nz)
-		# Need to convert to dense tensors because keras doesn't allow for sparse tensors.
-		vfe_points_dense = sparse.to_dense(vfe_points, default_value=0., validate_indices=False)
-		points.append(vfe_points_dense)
-		endTime = time.time()
-		print(endTime - startTime)
-		print('finished ' + str(i))
-	# Stack into 6 rank tensor
-	trainPoints = tf.stack(points, axis=0)
-
-	print('loading labels')
-	# get labels from file 
-	outClass = np.load(labels_dir + '\\labelsClass.npy', allow_pickle=True)
-	outRegress = np.load(labels_dir + '\\regressClass.npy', allow_pickle=True)
+def createSparseModel(nx, ny, nz, maxPoints, recomputeSegment=0, precision=Constants.precisionPolicy):
+	'''
+	Same network as createModel, but the input is only the non-empty voxels of each sample, so memory scales with the
+	number of occupied voxels instead of the grid size. Has the same weights in the same order as createModel.
+	:return: model taking [features of size (None, voxels, maxPoints, 6), coords of size (None, voxels, 3)]
+		where coords are the z, x, y index of each voxel (-1 for padding, see stackVoxelBatch)
+	'''
+	setPrecisionPolicy(precision)
+	inFeatures = Input(shape=(None, maxPoints, 6), dtype=Constants.storageDtype, name='InputVoxelFeatures')
+	inCoords = Input(shape=(None, 3), dtype='int32', name='InputVoxelCoords')
+	outLayer = EmptyVoxelLayer()(inFeatures)
+	outLayer = addVFEStack(outLayer, recomputeSegment, VoxelMaskLayer()(inCoords))
+	outLayer = ScatterVoxelLayer((nz, nx, ny))([outLayer, inCoords])
+	probabilityLayer, regressionMap = addDetectionLayers(outLayer, recomputeSegment)
+	model = Model(inputs=[inFeatures, inCoords], outputs=[probabilityLayer, regressionMap])
+	return model
 
-	# create model
-	model = createModel(Constants.nx, Constants.ny, Constants.nz, Constants.maxPoints)
-	# plot_model(model, show_shapes=True)
-	sgd = optimizers.SGD(lr=0.01, decay=1e-6, momentum=0.9, nesterov=True)
+
+def loadCurrentModel(model_path, sparse_input=False, recompute_segment=0, precision=Constants.precisionPolicy):
+	'''
+	Loads the weights of a saved model into a model built by this version of createModel (or createSparseModel).
+	Older saved models, like the fixedTheta checkpoints, have separate Dense, BatchNormalization, Reshape and
+	RepeatLayer layers where the current model has PointwiseDenseLayer and VFEBlockLayer, but the same weights.
+	:param model_path: location of the .h5 file
+	:param sparse_input: load into the sparse input model from createSparseModel instead of the dense one
+	:param recompute_segment: recomputeSegment of the new model, see createModel
+	:param precision: precision policy of the new model, see setPrecisionPolicy
+	'''
+	# only the weights are needed, so the optimizer and loss it was trained with aren't loaded
+	savedModel = load_model(model_path, custom_objects=customLayers, compile=False)
+	if sparse_input:
+		model = createSparseModel(Constants.nx, Constants.ny, Constants.nz, Constants.maxPoints, recompute_segment,
+								  precision)
+	else:
+		model = createModel(Constants.nx, Constants.ny, Constants.nz, Constants.maxPoints, recompute_segment, precision)
+	copyWeights(savedModel, model)
+	return model
+
+
+# kernel, bias, gamma, beta, moving_mean or moving_variance
+def weightKind(weight):
+	return weight.name.split('/')[-1].split(':')[0]
+
+
+# Layers of a model in order, with the layers inside each RecomputeLayer in place of it.
+def weightLayers(model):
+	layers = []
+	for layer in model.layers:
+		layers += layer.segmentLayers if isinstance(layer, RecomputeLayer) else [layer]
+	return layers
+
+
+def copyWeights(savedModel, model):
+	'''
+	Copies the weights of savedModel into model, when model has the same weights in the same layer order but some of
+	them combined into one layer. Each layer lists its trainable weights first, so a PointwiseDenseLayer that
+	normalizes 'before' has them in a different order than the BatchNormalization and Dense layers it replaces.
+	Weights are matched by kind within each layer. Either model can have RecomputeLayers.
+	'''
+	savedWeights = [(weightKind(weight), value) for layer in weightLayers(savedModel)
+					for weight, value in zip(layer.weights, layer.get_weights())]
+	position = 0
+	for layer in weightLayers(model):
+		if len(layer.weights) == 0:
+			continue
+		kinds = dict(savedWeights[position:position + len(layer.weights)])
+		layer.set_weights([kinds[weightKind(weight)] for weight in layer.weights])
+		position += len(layer.weights)
+
+
+def loadSparseModel(model_path):
+	'''
+	Loads a model saved from createModel (or createSparseModel) as a sparse input model.
+	:param model_path: location of the .h5 file
+	'''
+	return loadCurrentModel(model_path, sparse_input=True)
+
+
+# Pads the (features, coords) of several samples to the same number of voxels so they can be batched.
+# Padded voxels get coordinates of -1 and are ignored by the sparse model.
+def stackVoxelBatch(voxels):
+	maxVoxels = max(len(coords) for features, coords in voxels)
+	featureBatch = np.zeros((len(voxels), maxVoxels) + voxels[0][0].shape[1:], dtype=Constants.storageDtype)
+	coordBatch = np.full((len(voxels), maxVoxels, 3), -1, dtype=np.int32)
+	for i, (features, coords) in enumerate(voxels):
+		featureBatch[i, :len(features)] = features
+		coordBatch[i, :len(coords)] = coords
+	return featureBatch, coordBatch
+
+
+# Returns the compact (features, coords) voxels of a sample from voxelizePoints.
+# Reuses the preprocessing cache if the sample was already voxelized with the current voxel settings.
+def getSampleVoxels(sample, level5Data):
+	voxels = preprocess_cache.loadVoxels(sample['token'])
+	if voxels is None:
+		voxels = parallel_preprocessing.voxelize(point_shards.loadSamplePoints(sample, level5Data))
+		preprocess_cache.saveVoxels(sample['token'], *voxels)
+	return voxels
+
+
+# Fills the dense z, x, y, point, 6 grid that createModel takes from the compact voxels.
+# Same as converting VFE_preprocessing to dense.
+def voxelsToDense(features, coords):
+	dense = np.zeros((Constants.nz, Constants.nx, Constants.ny, Constants.maxPoints, 6), dtype=Constants.storageDtype)
+	dense[coords[:, 0], coords[:, 1], coords[:, 2]] = features
+	return dense
+
+
+# Voxels and compact labels (see preprocess_cache.compactLabels) of each sample, in the order of samples. Worker
+# processes make them while they are read, and samples that are already in the preprocessing cache are read from it.
+def trainingSamples(samples, level5Data, workers):
+	voxels = parallel_preprocessing.runJobs(samples, level5Data, workers, True)
+	labels = serialize_data.runLabelJobs(samples, level5Data, workers, True)
+	for (features, coords), (anchors, classes, regress) in zip(voxels, labels):
+		yield features, coords.astype(np.int32), anchors, classes, regress
+
+
+# Turns a sample from trainingSamples into the model input and the outClass and outRegress maps.
+def expandTrainingSample(features, coords, anchors, classes, regress, sparse_input):
+	labels = preprocess_cache.expandLabels(anchors, classes, regress)
+	if sparse_input:
+		return (features, coords) + labels
+	return (voxelsToDense(features, coords),) + labels
+
+
+def createTrainingDataset(samples, level5Data, sparse_input=False, batch_size=1, shuffle_buffer=64,
+						  workers=Constants.preprocessWorkers):
+	'''
+	Creates a tf.data pipeline of (model input, [outClass, outRegress]) batches for model.fit.
+	The samples are voxelized and labelled by worker processes while the model trains on the ones before them, and
+	every epoch after the first reads them from the preprocessing cache. Samples are kept as compact voxels and labels
+	until they are batched, so memory doesn't grow with the number of samples.
+	:param sparse_input: give [features, coords] inputs for createSparseModel instead of the dense grid.
+		Batches are padded the same way as stackVoxelBatch.
+	:param shuffle_buffer: number of samples to shuffle over, held in memory in their compact form. 0 keeps the samples
+		in order.
+	:param workers: number of processes used to voxelize the samples, and as many to make their labels.
+	'''
+	storageDtype = tf.as_dtype(Constants.storageDtype)
+	compactSignature = (tf.TensorSpec((None, Constants.maxPoints, 6), storageDtype), tf.TensorSpec((None, 3), tf.int32),
+						tf.TensorSpec((None,), tf.int32), tf.TensorSpec((None,), tf.uint8),
+						tf.TensorSpec((None, 7), storageDtype))
+	labelShapes = ((Constants.nx // 2, Constants.ny // 2, len(Constants.anchors)),
+				   (Constants.nx // 2, Constants.ny // 2, len(Constants.anchors) * 7))
+	if sparse_input:
+		outTypes = (storageDtype, tf.int32, tf.float32, tf.float32)
+		outShapes = ((None, Constants.maxPoints, 6), (None, 3)) + labelShapes
+	else:
+		outTypes = (storageDtype, tf.float32, tf.float32)
+		outShapes = ((Constants.nz, Constants.nx, Constants.ny, Constants.maxPoints, 6),) + labelShapes
+
+	def expand(*compact):
+		arrays = tf.numpy_function(lambda *arrays: expandTrainingSample(*arrays, sparse_input), compact, outTypes)
+		for array, shape in zip(arrays, outShapes):
+			array.set_shape(shape)
+		return tuple(arrays)
+
+	# tf.data pulls from the generator in a background thread, so preprocessing overlaps with training
+	dataset = tf.data.Dataset.from_generator(lambda: trainingSamples(samples, level5Data, workers),
+											 output_signature=compactSignature)
+	if shuffle_buffer > 0:
+		dataset = dataset.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+	dataset = dataset.map(expand, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+	if sparse_input:
+		dataset = dataset.padded_batch(batch_size, padded_shapes=outShapes,
+									   padding_values=(tf.constant(0, storageDtype), -1, 0., 0.))
+		dataset = dataset.map(lambda features, coords, outClass, outRegress:
+							  ((features, coords), (outClass, outRegress)))
+	else:
+		dataset = dataset.batch(batch_size)
+		dataset = dataset.map(lambda points, outClass, outRegress: (points, (outClass, outRegress)))
+	return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def fitModel(model, dataset, save_path, epochs=1):
+	# learning rate of 0.01 / (1 + 1e-6 * step), like the decay argument SGD used to take
+	learningRate = optimizers.schedules.InverseTimeDecay(0.01, decay_steps=1, decay_rate=1e-6)
+	sgd = optimizers.SGD(learning_rate=learningRate, momentum=0.9, nesterov=True)
 	model.compile(optimizer=sgd, loss=['mse', 'mse'])
 
 	# fit model
-	history = model.fit(x=trainPoints, y=[outClass, outRegress], batch_size=1, verbose=1, epochs=1, steps_per_epoch=180)
+	history = model.fit(dataset, verbose=1, epochs=epochs)
 
 	print(history.history)
 	model.save(save_path)
 
 
-def train_with_model(samples, level5Data, model_path, save_path):
-	labels_dir = 'labels3'
-
-	points = []
-	# for sample in samples:
-	for i in range(len(samples)):
-		# pre-process data
-		sampleLidarPoints = combine_lidar_data(samples[i], Constants.lyft_data_dir, level5Data)
-		startTime = time.time()
-		vfe_points = VFE_preprocessing(sampleLidarPoints,
-									   Constants.voxelx,
-									   Constants.voxely,
-									   Constants.voxelz,
-									   Constants.maxPoints,
-									   Constants.nx // 2,
-									   Constants.ny // 2,
-									   Constants.nz)
-		# Convert to dense here because keras won't take sparse tensors
-		vfe_points_dense = sparse.to_dense(vfe_points, default_value=0., validate_indices=False)
-		points.append(vfe_points_dense)
-		endTime = time.time()
-		print(endTime - startTime)
-		print('finished ' + str(i))
-	# Turn into 6 rank tensor, then convert it to dense because keras is stupid
-	trainPoints = tf.stack(points, axis=0)
-
-	print('loading labels')
-	# get labels from file
-	outClass = np.load(labels_dir + '\\labelsClass.npy', allow_pickle=True)
-	outRegress = np.load(labels_dir + '\\regressClass.npy', allow_pickle=True)
+def train(samples, level5Data, save_path, sparse_input=False, batch_size=1, workers=Constants.preprocessWorkers,
+		  shuffle_buffer=64, epochs=1, recompute_segment=0, precision=Constants.precisionPolicy):
+	'''
+	Creates a new model and trains it on the samples.
+	:param sparse_input: train the sparse input model from createSparseModel instead of the dense one.
+		Only the non-empty voxels are kept in memory, so batch_size can be more than 1.
+	:param workers: number of processes used to preprocess the samples.
+	:param shuffle_buffer: number of samples shuffled over by the input pipeline, see createTrainingDataset.
+	:param recompute_segment: number of VFE or Conv3D blocks whose activations are recomputed together during the
+		backward pass instead of kept, see createModel. Uses less memory for some extra compute. 0 keeps them all.
+	:param precision: precision policy of the model, 'mixed_bfloat16' or 'mixed_float16' for reduced precision
+		activations. See setPrecisionPolicy. The input type is Constants.storageDtype.
+	'''
+	# os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+	# voxels and labels come from the preprocessing cache, see preprocess_cache.py
+	dataset = createTrainingDataset(samples, level5Data, sparse_input, batch_size, shuffle_buffer, workers)
 
-	# load model
-	model = load_model(model_path,
-					   custom_objects={'RepeatLayer': RepeatLayer, 'MaxPoolingVFELayer': MaxPoolingVFELayer})
-	sgd = optimizers.SGD(lr=0.01, decay=1e-6, momentum=0.9, nesterov=True)
-	model.compile(optimizer=sgd, loss=['mse', 'mse'])
+	# create model
+	if sparse_input:
+		model = createSparseModel(Constants.nx, Constants.ny, Constants.nz, Constants.maxPoints, recompute_segment,
+								  precision)
+	else:
+		model = createModel(Constants.nx, Constants.ny, Constants.nz, Constants.maxPoints, recompute_segment, precision)
+	# plot_model(model, show_shapes=True)
+	fitModel(model, dataset, save_path, epochs)
 
-	# fit model
-	history = model.fit(x=trainPoints, y=[outClass, outRegress], batch_size=1, verbose=1, epochs=1, steps_per_epoch=180)
 
-	print(history.history)
-	model.save(save_path)
+def train_with_model(samples, level5Data, model_path, save_path, sparse_input=False, batch_size=1,
+					 workers=Constants.preprocessWorkers, shuffle_buffer=64, epochs=1, recompute_segment=0,
+					 precision=Constants.precisionPolicy):
+	'''
+	Same as train, but continues training the model saved at model_path.
+	The saved weights are loaded into the current model, see loadCurrentModel. With sparse_input into the sparse input
+	model.
+	'''
+	dataset = createTrainingDataset(samples, level5Data, sparse_input, batch_size, shuffle_buffer, workers)
+
+	# load model
+	model = loadCurrentModel(model_path, sparse_input, recompute_segment, precision)
+	fitModel(model, dataset, save_path, epochs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,178 @@
+import os
+import time
+from collections import namedtuple
+from multiprocessing import Pool, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+import Constants
+import point_shards
+import preprocess_cache
+from point_cloud import getLidarSensorFrames, combineLidarFiles, voxelizePoints
+
+# Windows frees shared memory as soon as the worker closes it, so arrays are sent back the normal way there.
+useSharedMemory = os.name != 'nt'
+
+# An array a worker put in shared memory, see toSharedMemory.
+SharedArray = namedtuple('SharedArray', ['name', 'shape', 'dtype'])
+
+
+# Copies an array into a new shared memory block. The block is left for the parent process to unlink.
+def toSharedMemory(array):
+	if not useSharedMemory:
+		return array
+	block = SharedMemory(create=True, size=max(array.nbytes, 1))
+	np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+	# the parent owns the block from here on, don't let this process' tracker clean it up
+	resource_tracker.unregister(block._name, 'shared_memory')
+	block.close()
+	return SharedArray(block.name, array.shape, array.dtype.str)
+
+
+# Copies an array out of a block made by toSharedMemory and frees the block.
+def fromSharedMemory(sharedArray):
+	if not useSharedMemory:
+		return sharedArray
+	block = SharedMemory(name=sharedArray.name)
+	array = np.ndarray(sharedArray.shape, dtype=sharedArray.dtype, buffer=block.buf).copy()
+	block.close()
+	block.unlink()
+	return array
+
+
+# Puts every numpy array in a result of lists, tuples and dicts into shared memory, or takes them back out.
+def shareArrays(result):
+	if isinstance(result, np.ndarray):
+		return toSharedMemory(result)
+	if isinstance(result, (list, tuple)):
+		return type(result)(shareArrays(item) for item in result)
+	if isinstance(result, dict):
+		return {key: shareArrays(value) for key, value in result.items()}
+	return result
+
+
+def unshareArrays(result):
+	if isinstance(result, SharedArray):
+		return fromSharedMemory(result)
+	if isinstance(result, (list, tuple)):
+		return type(result)(unshareArrays(item) for item in result)
+	if isinstance(result, dict):
+		return {key: unshareArrays(value) for key, value in result.items()}
+	return result
+
+
+# Forked workers start with the parent's numpy random state, so each is reseeded or they'd all shuffle the points of
+# their voxels the same way.
+def seedWorker():
+	np.random.seed(os.getpid())
+
+
+# Runs in the worker processes. Times the job and sends the arrays of its result back through shared memory.
+def runTimedJob(functionAndJob):
+	function, job = functionAndJob
+	startTime = time.time()
+	result = shareArrays(function(job))
+	return result, time.time() - startTime
+
+
+def mapJobs(function, jobs, workers, chunksize=1):
+	'''
+	Runs function on every job in a pool of worker processes. A job holds everything the function needs, so the
+	workers never need the Level 5 Dataset.
+	:param function: module level function that takes one job
+	:param jobs: iterable of jobs. Can be a generator, so the jobs are made while the workers run.
+	:param workers: number of worker processes
+	:param chunksize: number of jobs a worker takes at a time
+	:return: generator of the (result, seconds) of each job, in the order of jobs. Numpy arrays in the results (in
+		lists, tuples and dicts) come back through shared memory instead of being pickled.
+	'''
+	with Pool(workers, initializer=seedWorker) as pool:
+		# imap hands out chunksize jobs at a time to whichever worker is free, and returns them in job order
+		for result, seconds in pool.imap(runTimedJob, ((function, job) for job in jobs), chunksize):
+			yield unshareArrays(result), seconds
+
+
+# Voxels of a sample's points from voxelizePoints with the Constants grid, in the types they are cached in.
+def voxelize(points):
+	voxels = voxelizePoints(points,
+							Constants.voxelx,
+							Constants.voxely,
+							Constants.voxelz,
+							Constants.maxPoints,
+							Constants.nx // 2,
+							Constants.ny // 2,
+							Constants.nz)
+	return preprocess_cache.narrowVoxels(*voxels)
+
+
+# A job of mapJobs: the scene token, the (sample token, sensor frames) of each sample of a scene and the shard
+# directory, or None if the scene has no shard. The samples that aren't cached yet are read from the shard with one read of the scene.
+# Returns the voxels of each sample, or empty tuples if returnVoxels is False.
+def voxelizeJob(job):
+	sceneToken, sampleJobs, dataDir, shardDir, returnVoxels = job
+	# memory mapped, so only the cached voxels that are sent back are read
+	cached = {sampleToken: preprocess_cache.loadVoxels(sampleToken, mmap=True) for sampleToken, _ in sampleJobs}
+	missing = [sampleToken for sampleToken, voxels in cached.items() if voxels is None]
+	scenePoints = {}
+	if shardDir is not None and len(missing) > 0:
+		scenePoints = point_shards.readScene(sceneToken, shardDir, sampleTokens=missing)
+	results = []
+	for sampleToken, sensorFrames in sampleJobs:
+		voxels = cached[sampleToken]
+		if voxels is None:
+			if sampleToken in scenePoints:
+				sampleLidarPoints = scenePoints.pop(sampleToken)
+			else:
+				sampleLidarPoints = combineLidarFiles(sensorFrames, dataDir)
+			voxels = voxelize(sampleLidarPoints)
+			preprocess_cache.saveVoxels(sampleToken, *voxels)
+		results.append(tuple(voxels) if returnVoxels else ())
+	return results
+
+
+# Groups the samples by scene, so each scene's shard is read once by one worker.
+# Returns the scene tokens in order of their first sample, and the indexes of the samples of each.
+def groupByScene(samples):
+	scenes = {}
+	for i, sample in enumerate(samples):
+		scenes.setdefault(sample['scene_token'], []).append(i)
+	return list(scenes.keys()), list(scenes.values())
+
+
+def runJobs(samples, level5Data, workers, returnVoxels, shardDir=Constants.shard_dir):
+	sceneTokens, sceneIndexes = groupByScene(samples)
+	jobs = [(sceneToken, [(samples[i]['token'], getLidarSensorFrames(samples[i], level5Data)) for i in indexes],
+			 Constants.lyft_data_dir, shardDir if point_shards.loadShardIndex(sceneToken, shardDir) is not None else None,
+			 returnVoxels) for sceneToken, indexes in zip(sceneTokens, sceneIndexes)]
+	# samples finished out of order, until the ones before them are done
+	finished = {}
+	nextIndex = 0
+	for sceneToken, indexes, (results, seconds) in zip(sceneTokens, sceneIndexes, mapJobs(voxelizeJob, jobs, workers)):
+		print('scene ' + sceneToken + ' (' + str(len(indexes)) + ' samples) finished in ' + '%.2f' % seconds + 's')
+		finished.update(zip(indexes, results))
+		while nextIndex in finished:
+			yield finished.pop(nextIndex)
+			nextIndex += 1
+
+
+def preprocessSamples(samples, level5Data, workers=Constants.preprocessWorkers):
+	'''
+	Voxelizes samples in parallel. Same as calling getSampleVoxels on every sample.
+	The Level 5 Dataset is only used in this process to look up the lidar files, the workers just get the file names
+	and sensor calibrations. Samples are handed out a scene at a time, and a worker reads the samples of a scene that
+	has a point shard with one read of the shard.
+	:param samples: List of samples to voxelize
+	:param level5Data: The Level 5 Dataset the samples are from.
+	:param workers: number of worker processes
+	:return: list of (features, coords) in the same order as samples
+	'''
+	return list(runJobs(samples, level5Data, workers, True))
+
+
+def cacheSamples(samples, level5Data, workers=Constants.preprocessWorkers):
+	'''
+	Same as preprocessSamples, but only fills the preprocessing cache and doesn't keep the voxels in memory.
+	'''
+	for _ in runJobs(samples, level5Data, workers, False):
+		pass
@@ -0,0 +1,123 @@
+import os
+
+import numpy as np
+
+import Constants
+from transforms import applyTransform, getTransformCache, rotationMatrix
+
+sensorTypes = ['LIDAR_TOP', 'LIDAR_FRONT_RIGHT', 'LIDAR_FRONT_LEFT']
+
+
+# Uses quaternions to rotate all points in a scene to match the location of the lidar sensor on the car.
+def rotate_points(points, rotation, inverse=False):
+	return np.dot(rotationMatrix(tuple(rotation), inverse), points.T).T
+
+
+# Looks up the lidar files of a sample and the calibration of the sensor that made them.
+# Returns a list of dicts with the filename and the 4x4 sensor to car transform of each sensor, so the files can be
+# read without the Level 5 Dataset (for example in another process).
+def getLidarSensorFrames(sample, level5Data):
+	transformCache = getTransformCache(level5Data)
+	sensorFrames = []
+	# Account for not all samples having all liar data for some reason
+	for sensorType in sensorTypes:
+		if sensorType not in sample['data']:
+			continue
+		sensorFrame = level5Data.get('sample_data', sample['data'][sensorType])
+		sensorFrames.append({
+			'filename': sensorFrame['filename'],
+			'transform': transformCache.sensorToEgo(sensorFrame['calibrated_sensor_token'])
+		})
+	return sensorFrames
+
+
+# Memory maps a lidar .bin file as an array of n,5. Columns are x, y, z, intensity and ring index.
+# Nothing is read from disk until the points are used.
+def readLidarFile(path):
+	if os.path.getsize(path) == 0:
+		return np.zeros((0, 5), dtype=np.float32)
+	return np.memmap(path, dtype=np.float32, mode='r').reshape(-1, 5)
+
+
+# Reads the lidar files from getLidarSensorFrames and returns an array of n,3 with every point in the sample.
+# With cropToRoi set, only the points that fall in the voxel grid are returned (see roiMask).
+def combineLidarFiles(sensorFrames, dataDir, cropToRoi=True):
+	rawPoints = [readLidarFile(os.path.join(dataDir, os.path.normpath(sensorFrame['filename'])))
+				 for sensorFrame in sensorFrames]
+	# one buffer for every sensor's points, so nothing needs to be concatenated after
+	allPoints = np.empty((sum(len(points) for points in rawPoints), 3), dtype=np.float32)
+	offset = 0
+	for sensorFrame, points in zip(sensorFrames, rawPoints):
+		# need to rotate points per sensor, then translate to position of sensor before combining.
+		# Only the x, y, z columns are read, and the result goes straight into the output buffer.
+		sensorPoints = applyTransform(sensorFrame['transform'], points, out=allPoints[offset:offset + len(points)])
+		if cropToRoi:
+			# drop the points outside the grid by moving the ones inside to the front of this sensor's part
+			inRoi = sensorPoints[roiMask(sensorPoints)]
+			allPoints[offset:offset + len(inRoi)] = inRoi
+			offset += len(inRoi)
+		else:
+			offset += len(points)
+
+	return allPoints[:offset]
+
+
+# Mask of the points that end up in a voxel of the grid from Constants. Same test voxelizePoints does.
+def roiMask(points):
+	keys = voxelKeys(points, Constants.voxelx, Constants.voxely, Constants.voxelz)
+	return inVoxelGrid(keys, Constants.nx // 2, Constants.ny // 2, Constants.nz)
+
+
+# Finds the voxel key (x, y, z) of every point at once. Same floor rule as get_voxel.
+def voxelKeys(points, xSize, ySize, zSize):
+	return np.floor(points[:, :3] / np.array([xSize, ySize, zSize])).astype(np.int64)
+
+
+# Mask of the points whose voxel is inside the grid. Same bounds VFE_preprocessing has always used,
+# note that the x and y edge voxels and the z = 0 layer are excluded.
+def inVoxelGrid(keys, maxVoxelX, maxVoxelY, maxVoxelZ):
+	return (-maxVoxelX < keys[:, 0]) & (keys[:, 0] < maxVoxelX) \
+		& (-maxVoxelY < keys[:, 1]) & (keys[:, 1] < maxVoxelY) \
+		& (0 < keys[:, 2]) & (keys[:, 2] < maxVoxelZ)
+
+
+def voxelizePoints(points, xSize, ySize, zSize, sampleSize, maxVoxelX, maxVoxelY, maxVoxelZ):
+	'''
+	Vectorized version of the voxel grouping in VFE_preprocessing.
+	:param points: array of size n,3 (every lidar point in sample)
+	:param sampleSize: max number of points kept per voxel. Extra points are dropped at random.
+	:return: features of size (v, sampleSize, 6) with x, y, z and the offset from the voxel centroid for every point
+		(empty point slots are 0), and coords of size (v, 3) with the z, x, y index of each non-empty voxel.
+	'''
+	keys = voxelKeys(points, xSize, ySize, zSize)
+	inGrid = inVoxelGrid(keys, maxVoxelX, maxVoxelY, maxVoxelZ)
+	points = points[inGrid, :3]
+	keys = keys[inGrid]
+
+	# linearize the (z, x, y) key with negatives removed so each voxel is a single int
+	gridX = maxVoxelX * 2
+	gridY = maxVoxelY * 2
+	linear = (keys[:, 2] * gridX + keys[:, 0] + maxVoxelX) * gridY + keys[:, 1] + maxVoxelY
+
+	# shuffle before the stable sort so the first sampleSize points of a voxel are a random sample of it
+	shuffle = np.random.permutation(len(linear))
+	order = shuffle[np.argsort(linear[shuffle], kind='stable')]
+	voxels, starts, counts = np.unique(linear[order], return_index=True, return_counts=True)
+
+	# position of every sorted point inside its voxel, then cap at sampleSize
+	voxelOfPoint = np.repeat(np.arange(len(voxels)), counts)
+	slot = np.arange(len(order)) - starts[voxelOfPoint]
+	keep = slot < sampleSize
+	order = order[keep]
+	slot = slot[keep]
+	voxelOfPoint = voxelOfPoint[keep]
+	kept = np.minimum(counts, sampleSize)
+
+	features = np.zeros((len(voxels), sampleSize, 6), dtype=points.dtype)
+	features[voxelOfPoint, slot, :3] = points[order]
+	# padding is 0 so the sum over every slot is the sum over the sampled points
+	centroids = features[:, :, :3].sum(axis=1) / kept[:, None]
+	features[voxelOfPoint, slot, 3:] = points[order] - centroids[voxelOfPoint]
+
+	coords = np.stack((voxels // (gridX * gridY), (voxels // gridY) % gridX, voxels % gridY), axis=1)
+	return features, coords
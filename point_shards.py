@@ -0,0 +1,132 @@
+import json
+import os
+
+import numpy as np
+
+import Constants
+from point_cloud import getLidarSensorFrames, combineLidarFiles, roiMask
+
+# Packed point clouds, one shard per scene so a scene is a single file instead of 3 files per sample.
+#   <scene token>.bin  float32 x, y, z of every sample in the scene back to back, already moved into the car's frame
+#   <scene token>.json maps each sample token to the [offset, count] of its points in the .bin file
+# Shards keep every point (not cropped to the voxel grid) so they don't depend on the grid settings.
+
+# loaded .json indexes, by path
+shardIndexes = {}
+
+
+def shardPaths(sceneToken, shardDir):
+	return os.path.join(shardDir, sceneToken + '.bin'), os.path.join(shardDir, sceneToken + '.json')
+
+
+# Every sample of the scene in order.
+def sceneSamples(scene, level5Data):
+	samples = []
+	token = scene['first_sample_token']
+	while token != '':
+		sample = level5Data.get('sample', token)
+		samples.append(sample)
+		token = sample['next']
+	return samples
+
+
+def writeSceneShard(scene, level5Data, dataDir=Constants.lyft_data_dir, shardDir=Constants.shard_dir):
+	'''
+	Packs the lidar points of every sample in a scene into one shard.
+	:param scene: The scene JSON to pack
+	:param level5Data: The Level 5 Dataset the scene is from.
+	:param dataDir: location of the Lyft dataset
+	:param shardDir: location to save the shard to
+	'''
+	os.makedirs(shardDir, exist_ok=True)
+	binPath, indexPath = shardPaths(scene['token'], shardDir)
+	index = {}
+	offset = 0
+	# write to temp files so a half written shard is never used
+	with open(binPath + '.tmp', 'wb') as f:
+		for sample in sceneSamples(scene, level5Data):
+			points = combineLidarFiles(getLidarSensorFrames(sample, level5Data), dataDir, cropToRoi=False)
+			points.tofile(f)
+			index[sample['token']] = [offset, len(points)]
+			offset += len(points)
+	with open(indexPath + '.tmp', 'w') as f:
+		json.dump(index, f)
+	os.replace(binPath + '.tmp', binPath)
+	os.replace(indexPath + '.tmp', indexPath)
+	shardIndexes.pop(indexPath, None)
+
+
+def writeShards(level5Data, scenes=None, dataDir=Constants.lyft_data_dir, shardDir=Constants.shard_dir):
+	'''
+	Packs every scene (or the given scenes) into shards. Scenes that already have a shard are skipped.
+	'''
+	scenes = level5Data.scene if scenes is None else scenes
+	for i, scene in enumerate(scenes):
+		if os.path.exists(shardPaths(scene['token'], shardDir)[1]):
+			continue
+		writeSceneShard(scene, level5Data, dataDir, shardDir)
+		print('packed scene ' + str(i))
+
+
+def loadShardIndex(sceneToken, shardDir):
+	indexPath = shardPaths(sceneToken, shardDir)[1]
+	if indexPath not in shardIndexes:
+		if not os.path.exists(indexPath):
+			return None
+		with open(indexPath) as f:
+			shardIndexes[indexPath] = json.load(f)
+	return shardIndexes[indexPath]
+
+
+# Returns (shard path, offset, count) of the sample's points, or None if its scene has no shard.
+def findSample(sample, shardDir=Constants.shard_dir):
+	index = loadShardIndex(sample['scene_token'], shardDir)
+	if index is None or sample['token'] not in index:
+		return None
+	offset, count = index[sample['token']]
+	return shardPaths(sample['scene_token'], shardDir)[0], offset, count
+
+
+# Reads the points at a location from findSample with a single read. Crops them to the voxel grid like
+# combineLidarFiles does unless cropToRoi is False.
+def readShardPoints(location, cropToRoi=True):
+	binPath, offset, count = location
+	points = np.fromfile(binPath, dtype=np.float32, count=count * 3, offset=offset * 3 * 4).reshape(-1, 3)
+	return points[roiMask(points)] if cropToRoi else points
+
+
+def readScene(sceneToken, shardDir=Constants.shard_dir, cropToRoi=True, sampleTokens=None):
+	'''
+	Reads a whole scene, or just some of its samples, with one sequential read of its shard.
+	:param sampleTokens: samples to read, every sample in the shard if None. The read covers the points from the first
+		to the last of them.
+	:return: dict of sample token to the n,3 points of the sample, for the samples that are in the shard
+	'''
+	index = loadShardIndex(sceneToken, shardDir)
+	if index is None:
+		return {}
+	if sampleTokens is not None:
+		index = {token: index[token] for token in sampleTokens if token in index}
+	if len(index) == 0:
+		return {}
+	start = min(offset for offset, count in index.values())
+	end = max(offset + count for offset, count in index.values())
+	allPoints = np.fromfile(shardPaths(sceneToken, shardDir)[0], dtype=np.float32, count=(end - start) * 3,
+							offset=start * 3 * 4).reshape(-1, 3)
+	scenePoints = {}
+	for sampleToken, (offset, count) in index.items():
+		points = allPoints[offset - start:offset - start + count]
+		# cropping copies the points, so the whole read isn't kept alive by the samples
+		scenePoints[sampleToken] = points[roiMask(points)] if cropToRoi else points
+	return scenePoints
+
+
+def loadSamplePoints(sample, level5Data, dataDir=Constants.lyft_data_dir, shardDir=Constants.shard_dir):
+	'''
+	Same as combine_lidar_data, but reads the points from the scene's shard if there is one.
+	:return: array of n,3 with every point in the sample that is inside the voxel grid
+	'''
+	location = findSample(sample, shardDir)
+	if location is None:
+		return combineLidarFiles(getLidarSensorFrames(sample, level5Data), dataDir)
+	return readShardPoints(location)
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import Constants
+
+# Constants that change the output of VFE preprocessing and of label generation.
+# The cache directory for each is named after a hash of these, so changing any of them starts a new cache.
+voxelSettings = ['voxelx', 'voxely', 'voxelz', 'nx', 'ny', 'nz', 'maxPoints', 'storageDtype']
+labelSettings = voxelSettings + ['anchors', 'iouLowerBound', 'iouUpperBound', 'maxRegions']
+
+
+def settingsHash(settings):
+	values = {name: getattr(Constants, name) for name in settings}
+	return hashlib.sha1(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def cacheDir(kind, settings):
+	return os.path.join(Constants.cache_dir, kind + '_' + settingsHash(settings))
+
+
+def voxelCacheDir():
+	return cacheDir('voxels', voxelSettings)
+
+
+def labelCacheDir():
+	return cacheDir('compact_labels', labelSettings)
+
+
+# Writes to a temp file first so a crash or another process never sees a half written array.
+def saveArray(path, array):
+	tempPath = path + '.' + str(os.getpid()) + '.tmp'
+	with open(tempPath, 'wb') as f:
+		np.save(f, array)
+	os.replace(tempPath, path)
+
+
+# Loads every named array of a sample, or returns None if any of them is not cached.
+def loadArrays(directory, token, names, mmap=False):
+	paths = [os.path.join(directory, token + '_' + name + '.npy') for name in names]
+	if not all(os.path.exists(path) for path in paths):
+		return None
+	return tuple(np.load(path, mmap_mode='r' if mmap else None) for path in paths)
+
+
+def saveArrays(directory, token, names, arrays):
+	os.makedirs(directory, exist_ok=True)
+	for name, array in zip(names, arrays):
+		saveArray(os.path.join(directory, token + '_' + name + '.npy'), array)
+
+
+def loadVoxels(sampleToken, mmap=False):
+	'''
+	:return: (features, coords) from voxelizePoints for the sample, or None if not cached for the current Constants.
+	'''
+	return loadArrays(voxelCacheDir(), sampleToken, ['features', 'coords'], mmap)
+
+
+# Voxels from voxelizePoints in the types they are cached in: features as Constants.storageDtype, and coords as int16
+# (the largest index is the grid size).
+def narrowVoxels(features, coords):
+	return features.astype(Constants.storageDtype), coords.astype(np.int16)
+
+
+def saveVoxels(sampleToken, features, coords):
+	saveArrays(voxelCacheDir(), sampleToken, ['features', 'coords'], [features, coords])
+
+
+# Labels are saved in the compact form from compactLabels
+labelNames = ['anchors', 'class', 'regress']
+
+
+def loadLabels(sampleToken, mmap=False):
+	'''
+	:return: (anchors, class, regress) from compactLabels for the sample, or None if not cached for the current
+		Constants.
+	'''
+	return loadArrays(labelCacheDir(), sampleToken, labelNames, mmap)
+
+
+def saveLabels(sampleToken, anchors, classes, regress):
+	saveArrays(labelCacheDir(), sampleToken, labelNames, [anchors, classes, regress])
+
+
+# x, y, anchor shape of the outClass label map
+def labelShape():
+	return Constants.nx // 2, Constants.ny // 2, len(Constants.anchors)
+
+
+def compactLabels(outClass, outRegress):
+	'''
+	Keeps only the anchors of the label maps from imageToRPN that have a class or regression value. Almost every anchor
+	in the maps is 0, at most around maxRegions aren't.
+	:return: anchors (k) int32 index of each kept anchor in the flattened x, y, anchor map,
+		class (k) uint8 outClass value of each, and regress (k, 7) Constants.storageDtype outRegress values of each
+	'''
+	regressRows = outRegress.reshape(-1, 7)
+	anchors = np.flatnonzero((outClass.reshape(-1) != 0) | (regressRows != 0).any(axis=1)).astype(np.int32)
+	return anchors, outClass.reshape(-1)[anchors].astype(np.uint8), regressRows[anchors].astype(Constants.storageDtype)
+
+
+def expandLabels(anchors, classes, regress):
+	'''
+	Turns labels from compactLabels back into the float32 outClass and outRegress maps the model is trained on.
+	'''
+	shape = labelShape()
+	outClass = np.zeros(shape, dtype=np.float32)
+	outRegress = np.zeros(shape + (7,), dtype=np.float32)
+	outClass.reshape(-1)[anchors] = classes
+	outRegress.reshape(-1, 7)[anchors] = regress
+	return outClass, outRegress.reshape(shape[0], shape[1], shape[2] * 7)
+
+
+# Tokens listed in a directory's manifest, in the order they were finished. Empty if there is no manifest.
+def readManifest(directory):
+	path = os.path.join(directory, 'manifest.txt')
+	if not os.path.exists(path):
+		return []
+	with open(path) as f:
+		return [line.strip() for line in f if line.strip() != '']
+
+
+# Marks a token as finished. Call only after all of its arrays are saved.
+def appendManifest(directory, token):
+	os.makedirs(directory, exist_ok=True)
+	with open(os.path.join(directory, 'manifest.txt'), 'a') as f:
+		f.write(token + '\n')
+
+
+class StackedLabels:
+	'''
+	The compact labels saved for a list of tokens, read as if they were outClass and outRegress maps stacked along a
+	new first axis. Nothing is stacked in memory, indexing a token memory maps just its files and expands them.
+	'''
+
+	def __init__(self, directory, tokens):
+		self.directory = directory
+		self.tokens = list(tokens)
+		shape = labelShape()
+		self.classShape = (len(self.tokens),) + shape
+		self.regressShape = (len(self.tokens), shape[0], shape[1], shape[2] * 7)
+
+	def __len__(self):
+		return len(self.tokens)
+
+	# (anchors, class, regress) of one token, memory mapped
+	def compact(self, index):
+		return loadArrays(self.directory, self.tokens[index], labelNames, mmap=True)
+
+	def __getitem__(self, index):
+		'''
+		:return: (outClass, outRegress) of one token for an int index, or stacked for a slice or list of indexes
+		'''
+		if isinstance(index, (int, np.integer)):
+			return expandLabels(*self.compact(index))
+		labels = [self[i] for i in np.arange(len(self))[index]]
+		return np.stack([outClass for outClass, _ in labels]), np.stack([outRegress for _, outRegress in labels])
+
+
+def stackedLabels(sampleTokens):
+	'''
+	:return: StackedLabels of the samples from the label cache
+	'''
+	return StackedLabels(labelCacheDir(), sampleTokens)
@@ -1,22 +1,23 @@
 import matplotlib
 
 import math
+from functools import lru_cache
 from lyft_dataset_sdk.lyftdataset import LyftDataset
 import numpy as np
 import serialize_data as LoadDataModule
-from model_training import combine_lidar_data
+import point_shards
 from pyquaternion import Quaternion
-from shapely.ops import cascaded_union
+from shapely.ops import unary_union
 from shapely.geometry import Polygon
 import Constants
-
-matplotlib.use('TkAgg')
+from box_iou import iouMatrix
 from matplotlib import pyplot as plt
 import matplotlib.patches as patches
 
 
-def nonMaxSuppressionFast(boxInfo, probInfo, overlapThresh=0.9, maxBoxes=300):
+def nonMaxSuppressionFast(boxInfo, probInfo, overlapThresh=0.9, maxBoxes=300, minScore=None, topK=None):
 	# Steps:
+	#	Drop boxes below minScore or out of range and keep only the topK most probable before doing any geometry
 	#	Sort probability information
 	#	Find largest probabiliy, save as 'Last'
 	#	Calculate IoU with 'Last' box and all other boxes in list. If IoU is larger than overlap thresh, delete the box
@@ -25,50 +26,40 @@ def nonMaxSuppressionFast(boxInfo, probInfo, overlapThresh=0.9, maxBoxes=300):
 	if len(probInfo) == 0:
 		return [], []
 
-	xInfo = boxInfo[:, 0]
-	yInfo = boxInfo[:, 1]
-	zInfo = boxInfo[:, 2]
-	lengthInfo = boxInfo[:, 3]
-	widthInfo = boxInfo[:, 4]
-	heightInfo = boxInfo[:, 5]
-	yawInfo = boxInfo[:, 6]
+	# candidate indexes from highest to lowest probability. Ties go to the later box.
+	idxs = np.argsort(probInfo, kind='stable')[::-1]
+	if minScore is not None:
+		idxs = idxs[probInfo[idxs] >= minScore]
+	if len(idxs) == 0:
+		return [], []
+
+	# Every box picked after the first one has to be in range, so reject the rest at once. This comes before topK so
+	# out of range boxes don't take up its places.
+	xInfo = boxInfo[idxs, 0]
+	yInfo = boxInfo[idxs, 1]
+	outOfRange = (xInfo - Constants.anchors[0][0] < 0) \
+		| (xInfo + Constants.anchors[0][0] > 100) \
+		| (yInfo - Constants.anchors[0][1] < 0) \
+		| (yInfo + Constants.anchors[0][1] > 100)
+	outOfRange[0] = False
+	idxs = idxs[~outOfRange]
+	if topK is not None:
+		idxs = idxs[:topK]
+	candidates = boxInfo[idxs, :7]
 
 	# list of picked indexes to return
 	pick = []
-
-	# sort probabilities
-	idxs = np.argsort(probInfo)
-
-	while len(idxs) > 0:
-		print('fast max suppression idx length:', len(idxs), 'picks count:', len(pick))
-		# get the last (highest prob) value
-		last = len(idxs) - 1
-		currI = idxs[last]
-		pick.append(currI)
-
-		# find iou
-		lastBox = [xInfo[currI], yInfo[currI], zInfo[currI],
-				   lengthInfo[currI], widthInfo[currI], heightInfo[currI],
-				   yawInfo[currI]]
-		toDelete = []
-		for subI in idxs[:last]:
-			if xInfo[subI] - Constants.anchors[0][0] < 0 \
-					or xInfo[subI] + Constants.anchors[0][0] > 100 \
-					or yInfo[subI] - Constants.anchors[0][1] < 0 \
-					or yInfo[subI] + Constants.anchors[0][1] > 100:
-				toDelete.append(subI)
-			else:
-				box = [xInfo[subI], yInfo[subI], zInfo[subI],
-					   lengthInfo[subI], widthInfo[subI], heightInfo[subI],
-					   yawInfo[subI]]
-				iou = LoadDataModule.calculateIoU(lastBox, box)
-				if iou > overlapThresh:
-					toDelete.append(subI)
-		idxs = np.delete(idxs, (last,))
-		idxs = np.delete(idxs, toDelete)
-
-		if len(pick) > maxBoxes:
+	suppressed = np.zeros(len(idxs), dtype=bool)
+	for i in range(len(idxs)):
+		if suppressed[i]:
+			continue
+		if len(pick) == maxBoxes:
 			break
+		pick.append(idxs[i])
+		# IoU of 'Last' with every remaining box at once
+		others = i + 1 + np.flatnonzero(~suppressed[i + 1:])
+		iou = iouMatrix(candidates[i:i + 1], candidates[others])[0]
+		suppressed[others[iou > overlapThresh]] = True
 	boxes = boxInfo[pick]
 	probs = probInfo[pick]
 	return boxes, probs
@@ -112,28 +103,14 @@ def applyRegrssionNP(X, regress):
 	return np.stack((box_x, box_y, box_z, box_l, box_w, box_h, box_yaw))
 
 
-# Convert RPN matrices for a single sample into list of regions with cars
-# labelsClass is shape (100, 200, 2),
-# regressClass is shape (100, 200, 14)
-def rpnToRegion(labelsClass, labelsRegress):
-	# ASSUMES THAT OUTPUT OF RPN IS MAP DIVIDED BY 2. Our network does this.
-	# Assumes data input is in cm.
-	outX = Constants.nx // 2
-	outY = Constants.ny // 2
-	voxelXSize = Constants.voxelx * 2
-	voxelYSize = Constants.voxely * 2
-
-	# A is the coordinates for the 2 anchors for every point in the feature map
-	#	Coordinates are x, y, z, l, w, h, yaw
-	A = np.zeros((7,) + labelsClass.shape)
+# A is the coordinates for the anchors for every point in the feature map, shape is (7, outX, outY, anchors)
+#	Coordinates are x, y, z, l, w, h, yaw
+# Built once for each grid and anchor setting, call anchorTensor() to get the one for the current Constants.
+@lru_cache(maxsize=4)
+def buildAnchorTensor(outX, outY, voxelXSize, voxelYSize, anchors):
+	A = np.zeros((7, outX, outY, len(anchors)))
 	X, Y = np.meshgrid(np.arange(outX), np.arange(outY))
-
-	for i in range(len(Constants.anchors)):
-		currAnchor = Constants.anchors[i]
-		currRegress = labelsRegress[:, :, i * 7:i * 7 + 7]
-		currRegress = np.transpose(currRegress, (2, 0, 1))  # move
-
-		# populate A with the 7 coordinates for every anchor
+	for i, currAnchor in enumerate(anchors):
 		A[0, :, :, i] = X.T * voxelXSize + voxelXSize / 2
 		A[1, :, :, i] = Y.T * voxelYSize + voxelYSize / 2
 		A[2, :, :, i] = 1.
@@ -141,58 +118,65 @@ def rpnToRegion(labelsClass, labelsRegress):
 		A[4, :, :, i] = currAnchor[1]  # width of anchor
 		A[5, :, :, i] = currAnchor[2]  # height of anchor
 		A[6, :, :, i] = currAnchor[3]  # yaw of anchor
+	# shared by every caller, so don't let one change it
+	A.setflags(write=False)
+	return A
 
-		# calculae regression
-		A[:, :, :, i] = applyRegrssionNP(A[:, :, :, i], currRegress)
 
-	# becomes 1D array of (100*200 + 100*200,) where i is grouped by anchror
-	probInfo = labelsClass.transpose((2, 0, 1)).reshape((-1))
-	# becomes 2D array where each row is the 7 numbers for the box.
-	boxInfo = np.reshape(A.transpose((0, 3, 1, 2)), (7, -1)).transpose((1, 0))
-
-	lengthInfo = boxInfo[:, 3]
-	widthInfo = boxInfo[:, 4]
-	heightInfo = boxInfo[:, 5]
+def anchorTensor():
+	# ASSUMES THAT OUTPUT OF RPN IS MAP DIVIDED BY 2. Our network does this.
+	return buildAnchorTensor(Constants.nx // 2, Constants.ny // 2, Constants.voxelx * 2, Constants.voxely * 2,
+							 tuple(tuple(anchor) for anchor in Constants.anchors))
+
+
+def decodeBoxes(labelsRegress):
+	'''
+	Applies the regression values of a batch of RPN outputs to the anchors. preprocessLabels adds 1 to every regression
+	value of an anchor with a car, and the model learns that, so the 1 is taken off first.
+	:param labelsRegress: array of (B, 100, 200, 14)
+	:return: array of (7, B, 100, 200, 2) with the x, y, z, l, w, h, yaw of the box at every anchor
+	'''
+	labelsRegress = np.asarray(labelsRegress)
+	# (B, x, y, anchor * 7) to (7, B, x, y, anchor), the same layout as A with a batch axis
+	regress = labelsRegress.reshape(labelsRegress.shape[:3] + (-1, 7)).transpose((4, 0, 1, 2, 3)) - 1
+	return applyRegrssionNP(anchorTensor()[:, None], regress)
+
+
+def rpnToRegions(labelsClass, labelsRegress, minScore=None, topK=1000, batchSize=64):
+	'''
+	Same as calling rpnToRegion on every sample of stacked RPN outputs, but the boxes of batchSize samples are decoded
+	at once.
+	:param labelsClass: array of (B, 100, 200, 2), can be memory mapped
+	:param labelsRegress: array of (B, 100, 200, 14), can be memory mapped
+	:return: list of (boxes, probs) from nonMaxSuppressionFast for each sample
+	'''
+	results = []
+	for start in range(0, len(labelsClass), batchSize):
+		batchClass = np.asarray(labelsClass[start:start + batchSize])
+		A = decodeBoxes(labelsRegress[start:start + batchSize])
+		for b in range(len(batchClass)):
+			# becomes 1D array of (100*200 + 100*200,) where i is grouped by anchror
+			probInfo = batchClass[b].transpose((2, 0, 1)).reshape((-1))
+			# becomes 2D array where each row is the 7 numbers for the box.
+			boxInfo = np.reshape(A[:, b].transpose((0, 3, 1, 2)), (7, -1)).transpose((1, 0))
+
+			# remove illegal boxes
+			legal = (boxInfo[:, 3] >= 0) & (boxInfo[:, 4] >= 0) & (boxInfo[:, 5] >= 0)
+			results.append(nonMaxSuppressionFast(boxInfo[legal], probInfo[legal], maxBoxes=20, overlapThresh=0.,
+												 minScore=minScore, topK=topK))
+	return results
 
-	# remove illegal boxes
-	idxs = np.where((lengthInfo < 0) | (widthInfo < 0) | (heightInfo < 0))
-	if (len(idxs[0]) > 0):
-		boxInfo = np.delete(boxInfo, idxs, 0)
-		probInfo = np.delete(probInfo, idxs, 0)
 
-	result = nonMaxSuppressionFast(boxInfo, probInfo, maxBoxes=20, overlapThresh=0.)
-	return result
+# Convert RPN matrices for a single sample into list of regions with cars
+# labelsClass is shape (100, 200, 2),
+# regressClass is shape (100, 200, 14)
+# Only boxes with a probability of at least minScore, and at most the topK most probable, go through max suppression.
+def rpnToRegion(labelsClass, labelsRegress, minScore=None, topK=1000):
+	return rpnToRegions(labelsClass[None], labelsRegress[None], minScore, topK)[0]
 
 
 def showAnn(sample, plot):
-	annsTokens = sample['anns']
-	my_sample_data = level5Data.get('sample_data', sample['data']['LIDAR_TOP'])
-	ego = level5Data.get('ego_pose', my_sample_data['ego_pose_token'])
-	labels = []
-	for token in annsTokens:
-		ann = level5Data.get('sample_annotation', token)
-
-		# do a inverse transpose to get the annotation data from global coords to local
-		translation = np.array(ann['translation']).reshape((1, -1))
-		translation = translation - np.array(ego['translation'])
-		translation = LoadDataModule.rotate_points(translation, np.array(ego['rotation']), True)
-
-		row = []
-		row += [translation[0, 0]]
-		row += [translation[0, 1]]
-		row += [translation[0, 2]]
-		row += ann['size']
-		quaternion = Quaternion(ann['rotation'])
-		row += [quaternion.yaw_pitch_roll[0]]
-		instance = level5Data.get('instance', ann['instance_token'])
-		category = level5Data.get('category', instance['category_token'])['name']
-		# row += [catToNum[category]]
-		# Only adds cars within our range of -50 to 50 in x and y
-		if category == 'car' \
-				and row[0] >= -50 and row[0] <= 50 \
-				and row[1] >= -50 and row[1] <= 50:
-			labels.append(row)
-	labels = np.array(labels)
+	labels = LoadDataModule.getCarLabels(sample, level5Data)
 	plot.scatter(labels[:,0], labels[:,1],s=4, c='#ff0055')
 	for box in labels:
 		p = patches.Rectangle((box[0] - box[3] / 2, box[1] - box[4] / 2), box[3], box[4], fill=False, color="#ff0055")
@@ -204,12 +188,12 @@ def calcIntersectAll(boxBoxes, annsBoxes):
 	predictPolygons = []
 	for box in boxBoxes:
 		predictPolygons.append(LoadDataModule.boxToShapely(box))
-	predictCombined = cascaded_union(predictPolygons[:])
+	predictCombined = unary_union(predictPolygons[:])
 
 	labelBoxes = []
 	for box in annsBoxes:
 		labelBoxes.append(LoadDataModule.boxToShapely(box))
-	labelCombined = cascaded_union(labelBoxes[:])
+	labelCombined = unary_union(labelBoxes[:])
 	return predictCombined.intersection(labelCombined).area
 
 def calcUnionAll(boxesBoxes, annsBoxes, intersect):
@@ -221,34 +205,9 @@ def calcUnionAll(boxesBoxes, annsBoxes, intersect):
 		predictSum += box[3] * box[4] * box[5]
 	return annsSum + predictSum - intersect
 
-def calcIoUAll(predictBoxes, sample):
-	annsTokens = sample['anns']
-	my_sample_data = level5Data.get('sample_data', sample['data']['LIDAR_TOP'])
-	ego = level5Data.get('ego_pose', my_sample_data['ego_pose_token'])
-	labels = []
-	for token in annsTokens:
-		ann = level5Data.get('sample_annotation', token)
-		# do a inverse transpose to get the annotation data from global coords to local
-		translation = np.array(ann['translation']).reshape((1, -1))
-		translation = translation - np.array(ego['translation'])
-		translation = LoadDataModule.rotate_points(translation, np.array(ego['rotation']), True)
-
-		row = []
-		row += [translation[0, 0]]
-		row += [translation[0, 1]]
-		row += [translation[0, 2]]
-		row += ann['size']
-		quaternion = Quaternion(ann['rotation'])
-		row += [quaternion.yaw_pitch_roll[0]]
-		instance = level5Data.get('instance', ann['instance_token'])
-		category = level5Data.get('category', instance['category_token'])['name']
-		# row += [catToNum[category]]
-		# Only adds cars within our range of -50 to 50 in x and y
-		if category == 'car' \
-				and row[0] >= -50 and row[0] <= 50 \
-				and row[1] >= -50 and row[1] <= 50:
-			labels.append(row)
-	labelsBoxes = np.array(labels)
+# dataset is the Level 5 Dataset of the sample, the one loaded by __main__ if left out
+def calcIoUAll(predictBoxes, sample, dataset=None):
+	labelsBoxes = LoadDataModule.getCarLabels(sample, level5Data if dataset is None else dataset)
 
 	intersect = calcIntersectAll(predictBoxes, labelsBoxes)
 	union = calcUnionAll(predictBoxes, labelsBoxes, intersect)
@@ -256,6 +215,8 @@ def calcIoUAll(predictBoxes, sample):
 
 
 if __name__ == '__main__':
+	# only pick the window backend when run, so importing this works without a display
+	matplotlib.use('TkAgg')
 	# code adapated from 2D RPN to ROI calcultion found at:
 	# https://www.pyimagesearch.com/2015/02/16/faster-non-maximum-suppression-python/
 	# dataDir = 'C:\\Users\\snkim\\Desktop\\poject\\data'
@@ -275,13 +236,12 @@ if __name__ == '__main__':
 
 	boxes, probs = rpnToRegion(predictClass, predictRegress)
 
-	# fix positioning on boxes
-	boxes[:, 0] = boxes[:, 0] - 50
-	boxes[:, 1] = boxes[:, 1] - 50
+	from evaluation import regionsToCarFrame
+	boxes = regionsToCarFrame(boxes)
 
 	# now lets do some checking
 	sample = level5Data.get('sample', level5Data.scene[2]['first_sample_token'])
-	lidarPoints = combine_lidar_data(sample, dataDir, level5Data)
+	lidarPoints = point_shards.loadSamplePoints(sample, level5Data, dataDir)
 	fig = plt.figure(figsize=(12, 12))
 	ax = fig.add_subplot(111)
 	# plt.axis('equal')
@@ -11,7 +11,13 @@ import math
 import tensorflow as tf
 from shapely.geometry import Polygon
 import random
+import time
 import Constants
+import annotation_index
+import parallel_preprocessing
+import preprocess_cache
+from point_cloud import rotate_points
+from box_iou import BoxGridIndex, boxIoU
 
 
 # # constants
@@ -52,14 +58,6 @@ import Constants
 # dataDir = 'E:\\CS539 Machine Learning\\3d-object-detection-for-autonomous-vehicles'
 
 
-# Uses quaternions to rotate all points in a scene to match the location of the lidar sensor on the car.
-def rotate_points(points, rotation, inverse=False):
-	quaternion = Quaternion(rotation)
-	if inverse:
-		quaternion = quaternion.inverse
-	return np.dot(quaternion.rotation_matrix, points.T).T
-
-
 # Takes the sample dict and returns an array of n,3 with every point in the sample.
 def combine_lidar_data(sample, dataDir):
 	sensorTypes = ['LIDAR_TOP', 'LIDAR_FRONT_RIGHT', 'LIDAR_FRONT_LEFT']
@@ -83,60 +81,7 @@ def combine_lidar_data(sample, dataDir):
 	return allPoints
 
 
-# given a x,y,z, find coordinate of voxel it woul be in.
-# Voxels are defined by their lower leftmost point
-def get_voxel(point, xSize, ySize, zSize):
-	x = floor(point[0] / xSize)
-	y = floor(point[1] / ySize)
-	z = floor(point[2] / zSize)
-	return (x, y, z)
-
-
-# takes an array of size n,3 (every lidar point in sample) and returns array of points to pass into VFE
-# Returns array of size n,6
-def VFE_preprocessing(points, xSize, ySize, zSize, sampleSize, maxVoxelX, maxVoxelY, maxVoxelZ):
-	clusteredPoints = {}
-	# Iterate through points and add them to voxels
-	for idx, point in enumerate(points):
-		# expecting n to be around 200,000. Could be bad. Average time on local machine is about ~15 sec
-		key = get_voxel(point, xSize, ySize, zSize)
-		if -maxVoxelX < key[0] and key[0] < maxVoxelX \
-				and -maxVoxelY < key[1] and key[1] < maxVoxelY \
-				and 0 < key[2] and key[2] < maxVoxelZ:
-			# remove negatives.
-			fixedKey = (key[0] + maxVoxelX, key[1] + maxVoxelY, key[2])
-			if fixedKey in clusteredPoints:
-				clusteredPoints[fixedKey].append(idx)
-			else:
-				clusteredPoints[fixedKey] = [idx]
-	# Sample points and fil the rest of the voxel if not full
-	appendedPoints = {}
-	for voxel in clusteredPoints:
-		# sample points, then find center
-		s = sampleSize if len(clusteredPoints[voxel]) > sampleSize else len(clusteredPoints[voxel])
-		sampleIdx = np.random.choice(clusteredPoints[voxel], size=s, replace=False)
-		# get points for this voxel
-		currPoints = points[sampleIdx]
-		centroid = np.mean(currPoints, axis=0)
-		# subtract constant x, y, z values of centroid from each column. Use 0:1 to keep it as a 2D array
-		centroidX = currPoints[:, 0:1] - centroid[0]
-		centroidY = currPoints[:, 1:2] - centroid[1]
-		centroidZ = currPoints[:, 2:3] - centroid[2]
-		concat = np.hstack((currPoints, centroidX, centroidY, centroidZ))
-		buffer = np.vstack((concat, np.zeros((sampleSize - s, 6))))
-		appendedPoints[voxel] = buffer
-	indices = []
-	values = []
-	for voxel in appendedPoints:
-		for i in range(len(appendedPoints[voxel])):
-			for j in range(len(appendedPoints[voxel][i])):
-				indices.append((voxel[2],) + voxel[:2] + (i, j))
-				values.append(appendedPoints[voxel][i][j])
-	# return as z, x, y
-	return SparseTensor(indices=indices, values=values,
-						dense_shape=[maxVoxelZ, maxVoxelX * 2, maxVoxelY * 2, sampleSize, 6])
-
-
+# Shapely version of the intersection in box_iou.boxIoU. Used to check and benchmark it.
 def calculateIntersection(box1, box2):
 	# create shapely polygons and find intersection.
 	box1P = boxToShapely(box1)
@@ -176,9 +121,7 @@ def calculateIoU(box1, box2):
 	:param box2: the annotations row for second box
 	:return: IoU value
 	'''
-	intersect = calculateIntersection(box1, box2)
-	union = calculateUnion(box1, box2, intersect)
-	return intersect / union
+	return float(boxIoU(box1, box2))
 
 
 def fixBoxScaling(dataSize, newX, newY, origX, origY):
@@ -191,6 +134,75 @@ def fixBoxScaling(dataSize, newX, newY, origX, origY):
 	return out.transpose()
 
 
+def anchorGrid(outX, outY, voxelXSize, voxelYSize):
+	'''
+	Finds every anchor box that is within the range of the area we want to look at.
+	:return: array of a,7 with the x, y, z, l, w, h, yaw of each anchor box, and array of a,3 with its location in the
+		output maps as xVoxel, yVoxel, anchor number. Voxels start at -out / 2, so negative ones index from the end.
+	'''
+	centerZ = 1.  # hard set z center of anchors to 1. m dude just trust me.
+	xVoxels = np.arange(int(-outX / 2), int(outX / 2))
+	yVoxels = np.arange(int(-outY / 2), int(outY / 2))
+	# Do calculations in terms of cm now.
+	centersX = voxelXSize * xVoxels + (voxelXSize / 2)
+	centersY = voxelYSize * yVoxels + (voxelYSize / 2)
+	anchorBoxes = []
+	anchorLocs = []
+	for i, anchor in enumerate(Constants.anchors):
+		xInRange = ~((centersX - (anchor[0] / 2) < voxelXSize * int(-outX / 2))
+					 | (centersX + (anchor[0] / 2) > voxelXSize * int(outX / 2)))
+		yInRange = ~((centersY - (anchor[1] / 2) < voxelYSize * int(-outY / 2))
+					 | (centersY + (anchor[1] / 2) > voxelYSize * int(outY / 2)))
+		centerX, centerY = np.meshgrid(centersX[xInRange], centersY[yInRange], indexing='ij')
+		xVoxel, yVoxel = np.meshgrid(xVoxels[xInRange], yVoxels[yInRange], indexing='ij')
+		anchorBoxes.append(np.column_stack((centerX.ravel(), centerY.ravel(), np.full(centerX.size, centerZ),
+											np.tile(anchor, (centerX.size, 1)))))
+		anchorLocs.append(np.column_stack((xVoxel.ravel(), yVoxel.ravel(), np.full(xVoxel.size, i))))
+	return np.concatenate(anchorBoxes).reshape(-1, 7), np.concatenate(anchorLocs).reshape(-1, 3)
+
+
+def regressionTargets(anchorBoxes, boxes):
+	'''
+	Regression values of bounding boxes for their anchor boxes.
+	x,y are the center point of ground-truth bbox
+	xa,ya are the center point of anchor bbox
+	w,h are the width and height of ground-truth bbox
+	wa,ha are the width and height of anchor bboxe
+	tx = (x - xa) / la
+	ty = (y - ya) / wa
+	tz = (y - ya) / za
+	tl = log(l / la)
+	tw = log(w / wa)
+	th = log(h / ha)
+	tyaw = yaw - anchorYaw
+	TODO Add yaw rotation. For now just use raw rotation value.
+	:param anchorBoxes: array of (..., 7) anchor boxes
+	:param boxes: array of (..., 7) bounding boxes, one for each anchor box
+	:return: array of (..., 7) with tx, ty, tz, tl, tw, th, tyaw of each pair
+	'''
+	offsets = (boxes[..., :3] - anchorBoxes[..., :3]) / anchorBoxes[..., 3:6]
+	scales = np.log(boxes[..., 3:6] / anchorBoxes[..., 3:6])
+	yaws = boxes[..., 6:] - anchorBoxes[..., 6:]
+	return np.concatenate((offsets, scales, yaws), axis=-1)
+
+
+def firstBest(groups, values, tolerance=1e-9):
+	'''
+	Finds the first of the highest values in each group, like a loop that only replaces its best on a greater value.
+	Values within tolerance of the highest count as a tie, so round off doesn't change which one is picked.
+	:param groups: array of group numbers, sorted
+	:param values: array of values, in the order they would be looped over within each group
+	:return: each group, and the index of its first best value
+	'''
+	groupNames, starts = np.unique(groups, return_index=True)
+	if len(groupNames) == 0:
+		return groupNames, starts
+	best = np.maximum.reduceat(values, starts)
+	isBest = values >= np.repeat(best, np.diff(np.append(starts, len(values)))) - tolerance
+	# first best index of each group
+	return groupNames, np.minimum.reduceat(np.where(isBest, np.arange(len(values)), len(values)), starts)
+
+
 def preprocessLabels(data):
 	'''
 	Box = the bounding box / ground truth that is contained in data
@@ -209,89 +221,49 @@ def preprocessLabels(data):
 	outValidBox = np.zeros((outX, outY, len(Constants.anchors)))
 	outRpnOverlap = np.zeros((outX, outY, len(Constants.anchors)))
 
-	# save the best IoU for a specific bounding box (the label)
-	bestIouForBox = np.zeros(len(data))
-	bestAnchorForBox = np.ones((len(data), 3)).astype(int) * -1
-	countAnchorsForBox = np.zeros(len(data))
-	bestRegressionForBox = np.zeros((len(data), 7))
-
 	# scale back l and w because we cut the size of the feature space by 2 through our network
 	fixedData = data * fixBoxScaling(data.shape, outX, outY, Constants.nx, Constants.ny)
 
-	# Iterate through anchors and bounding boxes in fixedData and update outRegress and outClass as necessary based on IoU
-	centerZ = 1.  # hard set z center of anchors to 1. m dude just trust me.
-	for i in range(len(Constants.anchors)):
-		for xVoxel in range(int(-outX / 2), int(outX / 2)):
-			# print(xVoxel)
-			# Do calculations in terms of cm now.
-			centerX = voxelXSize * xVoxel + (voxelXSize / 2)
-			if centerX - (Constants.anchors[i][0] / 2) < voxelXSize * int(-outX / 2) \
-					or centerX + (Constants.anchors[i][0] / 2) > voxelXSize * int(outX / 2):
-				continue
-			for yVoxel in range(int(-outY / 2), int(outY / 2)):
-				centerY = voxelYSize * yVoxel + (voxelYSize / 2)
-				if centerY - (Constants.anchors[i][1] / 2) < voxelYSize * int(-outY / 2) \
-						or centerY + (Constants.anchors[i][1] / 2) > voxelYSize * int(outY / 2):
-					continue
-				# if we get here, then the anchor is within the range of the area we want to look at
-				# now look at every bounding box for best IoU
-				# start each anchor as negative, and initialize variables for best found IoU and regression constants
-				# Regression constants have 7 variables for x, y, z, l, w, h, yaw
-				boxType = 'neg'
-				bestIouForLoc = 0
-				bestRegression = (0, 0, 0, 0, 0, 0, 0)
-				for labelBoxNum in range(len(fixedData)):
-					# CenterX, CenterY, CenterZ are the centers of the anchors.
-					# Create anchorbox representation using set anchor sizes (which includes yaw)
-					anchorBox = [centerX, centerY, centerZ] + Constants.anchors[i]
-					iou = calculateIoU(anchorBox, fixedData[labelBoxNum])
-
-					# calculate regression values in case we need them
-					# x,y are the center point of ground-truth bbox
-					# xa,ya are the center point of anchor bbox
-					# w,h are the width and height of ground-truth bbox
-					# wa,ha are the width and height of anchor bboxe
-					# tx = (x - xa) / la
-					# ty = (y - ya) / wa
-					# tz = (y - ya) / za
-					# tl = log(l / la)
-					# tw = log(w / wa)
-					# th = log(h / ha)
-					# tyaw = yaw - anchorYaw
-					# TODO Add yaw rotation. For now just use raw rotation value.
-					tx = (fixedData[labelBoxNum][0] - centerX) / anchorBox[3]
-					ty = (fixedData[labelBoxNum][1] - centerY) / anchorBox[4]
-					tz = (fixedData[labelBoxNum][2] - centerZ) / anchorBox[5]
-					tl = np.log(fixedData[labelBoxNum][3] / anchorBox[3])
-					tw = np.log(fixedData[labelBoxNum][4] / anchorBox[4])
-					th = np.log(fixedData[labelBoxNum][5] / anchorBox[5])
-					tyaw = fixedData[labelBoxNum][6] - anchorBox[6]
-
-					if iou > bestIouForBox[labelBoxNum]:
-						bestIouForBox[labelBoxNum] = iou
-						bestAnchorForBox[labelBoxNum] = (xVoxel, yVoxel, i)
-						bestRegressionForBox[labelBoxNum] = (tx, ty, tz, tl, tw, th, tyaw)
-					if iou >= Constants.iouUpperBound:
-						boxType = 'pos'
-						countAnchorsForBox[labelBoxNum] += 1
-						if iou > bestIouForLoc:
-							bestIouForLoc = iou
-							bestRegression = (tx, ty, tz, tl, tw, th, tyaw)
-					if Constants.iouLowerBound < iou <= Constants.iouUpperBound and boxType != 'pos':
-						boxType = 'neutral'
-
-				if boxType == 'neg':
-					outValidBox[xVoxel, yVoxel, i] = 1
-					outRpnOverlap[xVoxel, yVoxel, i] = 0
-				elif boxType == 'neutral':
-					outValidBox[xVoxel, yVoxel, i] = 0
-					outRpnOverlap[xVoxel, yVoxel, i] = 0
-				elif boxType == 'pos':
-					# print('pos at', xVoxel, yVoxel, i)
-					outValidBox[xVoxel, yVoxel, i] = 1
-					outRpnOverlap[xVoxel, yVoxel, i] = 1
-					# save into first 7 values if anchor 0, save into next  values if anchor 1, and so on.
-					outRegress[xVoxel, yVoxel, i * 7:i * 7 + 7] = bestRegression
+	# Every anchor that is within the range of the area we want to look at, in the order the anchors, x voxels and
+	# y voxels used to be looped over.
+	anchorBoxes, anchorLocs = anchorGrid(outX, outY, voxelXSize, voxelYSize)
+	# IoU is only calculated for the pairs of an anchor and a box that can touch, every other pair is 0.
+	# Pairs are sorted by anchor, then box.
+	anchorOfPair, boxOfPair = BoxGridIndex(fixedData).query(anchorBoxes)
+	iou = boxIoU(anchorBoxes[anchorOfPair], fixedData[boxOfPair])
+	# a box that gives a NaN IoU never counts as a match
+	iou[np.isnan(iou)] = 0
+
+	# pos if any box has IoU >= upper bound, neutral if not but any box is between the bounds, else neg
+	isPosPair = iou >= Constants.iouUpperBound
+	isPos = np.zeros(len(anchorBoxes), dtype=bool)
+	isPos[anchorOfPair[isPosPair]] = True
+	isNeutral = np.zeros(len(anchorBoxes), dtype=bool)
+	isNeutral[anchorOfPair[(Constants.iouLowerBound < iou) & (iou <= Constants.iouUpperBound)]] = True
+	isNeutral &= ~isPos
+	isNeg = ~isPos & ~isNeutral
+
+	xVoxel, yVoxel, i = anchorLocs[isNeg].T
+	outValidBox[xVoxel, yVoxel, i] = 1
+
+	# a pos anchor regresses to the first box with its best IoU
+	posPairs = np.flatnonzero(isPosPair)
+	bestPairForLoc = posPairs[firstBest(anchorOfPair[posPairs], iou[posPairs])[1]]
+	xVoxel, yVoxel, i = anchorLocs[anchorOfPair[bestPairForLoc]].T
+	outValidBox[xVoxel, yVoxel, i] = 1
+	outRpnOverlap[xVoxel, yVoxel, i] = 1
+	# save into first 7 values if anchor 0, save into next  values if anchor 1, and so on.
+	outRegress.reshape(outX, outY, len(Constants.anchors), 7)[xVoxel, yVoxel, i] = \
+		regressionTargets(anchorBoxes[anchorOfPair[bestPairForLoc]], fixedData[boxOfPair[bestPairForLoc]])
+
+	# save the best IoU for a specific bounding box (the label), first anchor found wins ties
+	countAnchorsForBox = np.bincount(boxOfPair[isPosPair], minlength=len(fixedData))
+	byBox = np.argsort(boxOfPair, kind='stable')
+	boxes, bestPairForBox = firstBest(boxOfPair[byBox], iou[byBox])
+	bestAnchorIndex = np.zeros(len(fixedData), dtype=int)
+	bestAnchorIndex[boxes] = anchorOfPair[byBox[bestPairForBox]]
+	bestIouForBox = np.zeros(len(fixedData))
+	bestIouForBox[boxes] = np.maximum(iou[byBox[bestPairForBox]], 0)
 
 	# Now check to make sure that every bounding box has at least one positive anchor.
 	# If not, we need to get the best one and populate it into the regression map.
@@ -300,11 +272,12 @@ def preprocessLabels(data):
 			if bestIouForBox[labelBoxNum] == 0:
 				# all IoUs are 0 for some reason so pass over
 				continue
-			bestAnchor = bestAnchorForBox[labelBoxNum]
+			bestAnchor = anchorLocs[bestAnchorIndex[labelBoxNum]]
 			outValidBox[bestAnchor[0], bestAnchor[1], bestAnchor[2]] = 1
 			outRpnOverlap[bestAnchor[0], bestAnchor[1], bestAnchor[2]] = 1
 			outRegress[bestAnchor[0], bestAnchor[1],
-			bestAnchor[2] * 7: bestAnchor[2] * 7 + 7] = bestRegressionForBox[labelBoxNum]
+			bestAnchor[2] * 7: bestAnchor[2] * 7 + 7] = \
+				regressionTargets(anchorBoxes[bestAnchorIndex[labelBoxNum]], fixedData[labelBoxNum])
 
 	# Also want to remove some negative regions if there are a lot more negatives in the region than positives.
 	posLocs = np.where(np.logical_and(outValidBox[:, :, :] == 1, outRpnOverlap[:, :, :] == 1))
@@ -338,74 +311,133 @@ def preprocessLabels(data):
 	return [outClass, outRegress]
 
 
-def imageToRPN(sample):
+def getLabelsInRange(sample, level5Data):
+	'''
+	Gets the ground truth objects of a sample that are within -50 to 50 m in x and y of the car.
+	Reads them from the dataset's annotation index, see annotation_index.py.
+	:param sample: The sample JSON file to process.
+	:param level5Data: The Level 5 Dataset the sample is from.
+	:return: array of n,7 where each row is the x, y, z, length, width, height, yaw of an object in the car's frame,
+		and array of n with the Constants.catToNum id of each
+	'''
+	index = annotation_index.getAnnotationIndex(level5Data)
+	if sample['token'] in index:
+		labels, categories = index.sampleAnnotations(sample['token'])
+	else:
+		labels, categories = annotation_index.sampleAnnotations(sample, level5Data)
+
+	# Only adds objects within our range of -50 to 50 in x and y
+	inRange = (labels[:, 0] >= -50) & (labels[:, 0] <= 50) & (labels[:, 1] >= -50) & (labels[:, 1] <= 50)
+	return labels[inRange], categories[inRange]
+
+
+def getCarLabels(sample, level5Data):
+	'''
+	Gets the ground truth cars of a sample that are within -50 to 50 m in x and y of the car.
+	:param sample: The sample JSON file to process.
+	:param level5Data: The Level 5 Dataset the sample is from.
+	:return: array of n,7 where each row is the x, y, z, length, width, height, yaw of a car in the car's frame
+	'''
+	labels, categories = getLabelsInRange(sample, level5Data)
+	return labels[categories == Constants.catToNum['car']]
+
+
+def imageToRPN(sample, level5Data):
 	'''
 	Given a sample, retrieve the ground truth object in the scene and convert to RPN
 	:param sample: The sample JSON file to process.
+	:param level5Data: The Level 5 Dataset the sample is from.
 	:return: OutClass and OutRegress for training.
 	'''
-	# pre-process labels
-	labels = []
-	annsTokens = sample['anns']
-	my_sample_data = level5Data.get('sample_data', sample['data']['LIDAR_TOP'])
-	ego = level5Data.get('ego_pose', my_sample_data['ego_pose_token'])
-	for token in annsTokens:
-		ann = level5Data.get('sample_annotation', token)
-
-		# do a inverse transpose to get the annotation data from global coords to local
-		translation = np.array(ann['translation']).reshape((1, -1))
-		translation = translation - np.array(ego['translation'])
-		translation = rotate_points(translation, np.array(ego['rotation']), True)
-
-		row = []
-		row += [translation[0, 0]]
-		row += [translation[0, 1]]
-		row += [translation[0, 2]]
-		#     row = ann['translation']
-		#     row = [x / 100 for x in row]  # translate to m
-		row += ann['size']
-		quaternion = Quaternion(ann['rotation'])
-		row += [quaternion.yaw_pitch_roll[0]]
-		instance = level5Data.get('instance', ann['instance_token'])
-		category = level5Data.get('category', instance['category_token'])['name']
-		# row += [catToNum[category]]
-		# Only adds cars within our range of -50 to 50 in x and y
-		if Constants.catToNum[category] == 0 \
-				and row[0] >= -50 and row[0] <= 50 \
-				and row[1] >= -50 and row[1] <= 50:
-			labels.append(row)
-	labels = np.array(labels)
 	# for right now, only care about cars
+	labels = getCarLabels(sample, level5Data)
 
 	outClass, outRegress = preprocessLabels(labels)
 	return outClass, outRegress
 
 
-def saveLabelsForSample(samples, outPath):
+def getSampleLabels(sample, level5Data):
+	'''
+	Same as imageToRPN, but reuses the labels from the preprocessing cache if they were already made with the
+	current anchor and IoU settings. Labels are cached in the compact form, and returned as float32 maps.
+	'''
+	labels = preprocess_cache.loadLabels(sample['token'])
+	if labels is None:
+		labels = preprocess_cache.compactLabels(*imageToRPN(sample, level5Data))
+		preprocess_cache.saveLabels(sample['token'], *labels)
+	return preprocess_cache.expandLabels(*labels)
+
+
+# A job of parallel_preprocessing.mapJobs: a sample token, its car labels from getCarLabels and the directory to save
+# its labels to. New labels go into the label cache if the directory is None, or only into the directory otherwise.
+def labelJob(job):
+	sampleToken, carLabels, returnLabels, outPath = job
+	labels = preprocess_cache.loadLabels(sampleToken)
+	if labels is None:
+		labels = preprocess_cache.compactLabels(*preprocessLabels(carLabels))
+		if outPath is None:
+			preprocess_cache.saveLabels(sampleToken, *labels)
+	if outPath is not None:
+		preprocess_cache.saveArrays(outPath, sampleToken, preprocess_cache.labelNames, labels)
+	return tuple(labels) if returnLabels else ()
+
+
+def runLabelJobs(samples, level5Data, workers, returnLabels, chunksize=1, outPath=None):
+	jobs = ((sample['token'], getCarLabels(sample, level5Data), returnLabels, outPath) for sample in samples)
+	for i, (labels, seconds) in enumerate(parallel_preprocessing.mapJobs(labelJob, jobs, workers, chunksize)):
+		print('sample ' + str(i) + ' finished in ' + '%.2f' % seconds + 's')
+		yield labels
+
+
+def labelSamples(samples, level5Data, workers=Constants.preprocessWorkers, chunksize=1):
+	'''
+	Runs imageToRPN on samples in parallel. Same as calling getSampleLabels on every sample.
+	:param samples: List of samples to parse for cars
+	:param level5Data: The Level 5 Dataset the samples are from.
+	:param workers: number of worker processes
+	:param chunksize: number of samples a worker takes at a time
+	:return: generator of (outClass, outRegress) in the same order as samples
 	'''
-	Converts Lidar data from a sample into rpn form. Saves it as a npy file
+	# the workers send back the compact labels, which are much smaller than the maps
+	return (preprocess_cache.expandLabels(*labels)
+			for labels in runLabelJobs(samples, level5Data, workers, True, chunksize))
+
+
+def cacheLabels(samples, level5Data, workers=Constants.preprocessWorkers, chunksize=1):
+	'''
+	Same as labelSamples, but only fills the preprocessing cache and doesn't keep the labels in memory.
+	'''
+	for _ in runLabelJobs(samples, level5Data, workers, False, chunksize):
+		pass
+
+
+def saveLabelsForSample(samples, outPath, level5Data, workers=Constants.preprocessWorkers):
+	'''
+	Converts Lidar data from a sample into rpn form. Saves each sample as npy files as soon as it is done
+	(<token>_anchors.npy, <token>_class.npy and <token>_regress.npy from compactLabels) and adds its token to
+	manifest.txt, so a run that is stopped can be started again without redoing the finished samples.
+	New labels are only written to outPath, not to the label cache as well. Read the result with loadLabelsForSample.
 	:param samples: List of samples to parse for cars and save as input to network
 	:param outPath: Location to save npy files.
+	:param level5Data: The Level 5 Dataset the samples are from.
+	:param workers: number of processes used to make the labels
 	'''
+	finished = set(preprocess_cache.readManifest(outPath))
+	remaining = [sample for sample in samples if sample['token'] not in finished]
+	print(str(len(samples) - len(remaining)) + ' samples already finished')
+	# the workers save each sample straight into outPath, this process only lists it once it is saved
+	for sample, _ in zip(remaining, runLabelJobs(remaining, level5Data, workers, False, outPath=outPath)):
+		preprocess_cache.appendManifest(outPath, sample['token'])
 
-	classMap = []
-	regressMap = []
-	for i in range(len(samples)):
-		print('doing sample', str(i))
-		outClass, outRegress = imageToRPN(samples[i])
-		print('sample ' + str(i) + ' finished')
-		classMap.append(outClass)
-		regressMap.append(outRegress)
-	classMap = np.stack(classMap)
-	regressMap = np.stack(regressMap)
-
-	classShapeArray = np.array(classMap.shape)
-	regressShapeArray = np.array(regressMap.shape)
 
-	np.save(outPath + '\\labelsClass.npy', classMap)
-	np.save(outPath + '\\regressClass.npy', regressMap)
-	np.save(outPath + '\\labelsShape.npy', classShapeArray)
-	np.save(outPath + '\\regressShape.npy', regressShapeArray)
+def loadLabelsForSample(outPath):
+	'''
+	Reads the labels saved by saveLabelsForSample.
+	:param outPath: Location the npy files were saved to.
+	:return: sample tokens, and StackedLabels of every finished sample in that order
+	'''
+	tokens = preprocess_cache.readManifest(outPath)
+	return tokens, preprocess_cache.StackedLabels(outPath, tokens)
 
 
 def saveTrainDataForSample(samples):
@@ -413,7 +445,7 @@ def saveTrainDataForSample(samples):
 	tensors = []
 	for sample in samples:
 		# pre-process data
-		import time
+		from model_training import VFE_preprocessing
 		testSampleLidarPoints = combine_lidar_data(sample, Constants.dataDir)
 		startTime = time.time()
 		testVFEPoints = VFE_preprocessing(testSampleLidarPoints, Constants.voxelx, Constants.voxely, Constants.voxelz,
@@ -444,4 +476,5 @@ if __name__ == '__main__':
 	for scene in level5Data.scene:
 		samples.append(level5Data.get('sample', scene['first_sample_token']))
 	saveLabelsForSample(samples[0:1],
-						'C:\\Users\\Skyler\\Documents\\_CS539_ml\\project\\Lyft-Object-Detection\\labels3')
+						'C:\\Users\\Skyler\\Documents\\_CS539_ml\\project\\Lyft-Object-Detection\\labels3',
+						level5Data)
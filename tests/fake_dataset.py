@@ -0,0 +1,53 @@
+import numpy as np
+from pyquaternion import Quaternion
+
+
+class FakeDataset:
+	'''
+	The tables of a Level 5 Dataset that the annotation and transform code reads, with get like LyftDataset's.
+	'''
+
+	def __init__(self, tables):
+		self.tables = tables
+		self.sample = list(tables['sample'].values())
+		self.sample_annotation = list(tables['sample_annotation'].values())
+
+	def get(self, table, token):
+		return self.tables[table][token]
+
+
+def randomRotation(rng):
+	return list(Quaternion(axis=rng.normal(size=3), angle=rng.uniform(-np.pi, np.pi)).elements)
+
+
+# Yaw only rotation, like the rotations of the ego poses and annotations in the dataset.
+def yawRotation(rng):
+	return list(Quaternion(axis=[0, 0, 1], angle=rng.uniform(-np.pi, np.pi)).elements)
+
+
+def makeDataset(rng, sampleCount, annotationCounts, prefix=''):
+	'''
+	A FakeDataset of sampleCount samples with random ego poses, and annotationCounts[i] random annotations in sample i
+	of the categories in categoryNames.
+	'''
+	categoryNames = ['car', 'pedestrian', 'truck', 'unknown_thing']
+	tables = {name: {} for name in ['sample', 'sample_annotation', 'sample_data', 'ego_pose', 'instance', 'category']}
+	for name in categoryNames:
+		tables['category'][prefix + name] = {'token': prefix + name, 'name': name}
+	for i in range(sampleCount):
+		token = prefix + 'sample' + str(i)
+		tables['ego_pose'][token] = {'token': token, 'rotation': yawRotation(rng),
+									 'translation': list(rng.uniform(-500, 500, 3))}
+		tables['sample_data'][token] = {'token': token, 'ego_pose_token': token}
+		anns = []
+		for j in range(annotationCounts[i]):
+			annToken = token + '_ann' + str(j)
+			tables['instance'][annToken] = {'token': annToken,
+											'category_token': prefix + categoryNames[rng.integers(len(categoryNames))]}
+			egoTranslation = tables['ego_pose'][token]['translation']
+			tables['sample_annotation'][annToken] = {
+				'token': annToken, 'instance_token': annToken, 'size': list(rng.uniform(0.5, 5, 3)),
+				'translation': list(np.array(egoTranslation) + rng.uniform(-60, 60, 3)), 'rotation': yawRotation(rng)}
+			anns.append(annToken)
+		tables['sample'][token] = {'token': token, 'anns': anns, 'data': {'LIDAR_TOP': token}}
+	return FakeDataset(tables)
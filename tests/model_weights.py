@@ -0,0 +1,18 @@
+import numpy as np
+
+from model_training import weightKind, weightLayers
+
+
+def randomizeNormalization(model, rng):
+	# Keras starts every batch normalization as the identity, which would hide weights copied to the wrong place or
+	# leave folding unchanged
+	for layer in weightLayers(model):
+		values = []
+		for weight, value in zip(layer.weights, layer.get_weights()):
+			kind = weightKind(weight)
+			if kind in ['gamma', 'moving_variance']:
+				value = rng.uniform(0.5, 1.5, value.shape)
+			elif kind in ['beta', 'moving_mean']:
+				value = rng.normal(0, 0.1, value.shape)
+			values.append(value.astype(np.float32))
+		layer.set_weights(values)
@@ -0,0 +1,36 @@
+import gc
+import weakref
+
+import numpy as np
+
+import annotation_index
+import transforms
+from fake_dataset import makeDataset
+
+
+def test_index_matches_sample_annotations(tmp_path):
+	rng = np.random.default_rng(0)
+	level5Data = makeDataset(rng, 5, [3, 0, 1, 6, 2])
+	annotation_index.buildAnnotationIndex(level5Data, str(tmp_path))
+	index = annotation_index.getAnnotationIndex(level5Data, str(tmp_path), build=False)
+	assert index is annotation_index.getAnnotationIndex(level5Data, str(tmp_path), build=False)
+	for sample in level5Data.sample:
+		assert sample['token'] in index
+		boxes, categories = index.sampleAnnotations(sample['token'])
+		expectedBoxes, expectedCategories = annotation_index.sampleAnnotations(sample, level5Data)
+		assert len(boxes) == len(sample['anns'])
+		np.testing.assert_allclose(boxes, expectedBoxes, rtol=1e-12, atol=1e-9)
+		np.testing.assert_array_equal(categories, expectedCategories)
+	assert 'missing' not in index
+
+
+def test_cached_index_keeps_its_dataset(tmp_path):
+	level5Data = makeDataset(np.random.default_rng(1), 2, [1, 1])
+	annotation_index.getAnnotationIndex(level5Data, str(tmp_path))
+	dataset = weakref.ref(level5Data)
+	# the transform cache keeps the dataset too
+	transforms.transformCaches.clear()
+	del level5Data
+	gc.collect()
+	# so a new dataset can't get its id, and with it its index
+	assert dataset() is not None
@@ -0,0 +1,49 @@
+import numpy as np
+
+from box_iou import boxIoU, iouMatrix
+
+car = np.array([10., 20., 1., 4., 2., 1.5, 0.3])
+
+
+def shifted(box, along):
+	'''
+	Box moved by half its length along its own length axis, or half its height up.
+	'''
+	box = box.copy()
+	if along == 'length':
+		box[0] += np.sin(box[6]) * box[3] / 2
+		box[1] += np.cos(box[6]) * box[3] / 2
+	else:
+		box[2] += box[5] / 2
+	return box
+
+
+def test_identical_boxes():
+	assert np.isclose(boxIoU(car, car, halfHeight=False), 1.)
+
+
+def test_half_overlap_along_length():
+	# intersection is half a box, union one and a half
+	assert np.isclose(boxIoU(car, shifted(car, 'length'), halfHeight=False), 1 / 3)
+
+
+def test_half_overlap_along_height():
+	assert np.isclose(boxIoU(car, shifted(car, 'height'), halfHeight=False), 1 / 3)
+
+
+def test_no_overlap_in_height():
+	above = car.copy()
+	above[2] += car[5] * 1.5
+	assert boxIoU(car, above, halfHeight=False) == 0
+
+
+def test_matrix_matches_pairs():
+	boxes = np.stack((car, shifted(car, 'length'), shifted(car, 'height')))
+	expected = boxIoU(boxes[:, None], boxes[None, :], halfHeight=False)
+	assert np.allclose(iouMatrix(boxes, boxes, halfHeight=False), expected)
+	assert np.allclose(np.diag(expected), 1.)
+
+
+def test_label_iou_unchanged():
+	# the anchor labels still use h as a half height and the l * w * h volume, so identical boxes have no union
+	assert np.isinf(boxIoU(car, car))
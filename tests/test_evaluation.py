@@ -0,0 +1,31 @@
+import math
+
+import numpy as np
+
+import annotation_index
+import Constants
+from box_iou import iouMatrix
+from evaluation import regionsToCarFrame
+from rpnToRegion import rpnToRegion
+from serialize_data import getCarLabels, preprocessLabels
+
+
+def test_regions_to_car_frame_inverts_labels(monkeypatch):
+	# cars on every side of the car, away from the middle of the map where it wraps around, and one that isn't a car
+	boxes = np.array([[-10., 5.5, 0.9, 4.6, 1.9, 1.7, 0.1],
+					  [20.3, -30., 1.1, 4.2, 1.8, 1.5, math.pi / 2 - 0.05],
+					  [-35., -20.4, 1., 4.9, 2.1, 1.6, -0.15],
+					  [12.5, 40., 0.8, 3.8, 1.7, 1.4, math.pi / 2 + 0.2],
+					  [30., 30., 1., 10., 2.5, 3., 0.]])
+	categories = np.array([Constants.catToNum['car']] * 4 + [Constants.catToNum['car'] + 1])
+	monkeypatch.setattr(annotation_index, 'getAnnotationIndex', lambda level5Data: {})
+	monkeypatch.setattr(annotation_index, 'sampleAnnotations', lambda sample, level5Data: (boxes, categories))
+	carLabels = getCarLabels({'token': 'sample'}, None)
+	assert len(carLabels) == 4
+
+	outClass, outRegress = preprocessLabels(carLabels)
+	# only the anchors with a car. Each of them gives the whole box, which max suppression doesn't always drop.
+	regions, _ = rpnToRegion(outClass, outRegress, minScore=2)
+	iou = iouMatrix(regionsToCarFrame(regions), carLabels, halfHeight=False)
+	np.testing.assert_allclose(iou.max(axis=1), 1, atol=1e-6)
+	assert set(iou.argmax(axis=1)) == set(range(len(carLabels)))
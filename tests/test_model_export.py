@@ -0,0 +1,19 @@
+import numpy as np
+
+import Constants
+from model_export import foldBatchNorm
+from model_training import createModel
+from model_weights import randomizeNormalization
+
+
+def test_fold_batch_norm_matches_inference():
+	nx, ny = 8, 16
+	model = createModel(nx, ny, Constants.nz, Constants.maxPoints)
+	rng = np.random.default_rng(0)
+	randomizeNormalization(model, rng)
+	folded = foldBatchNorm(model)
+	assert not any(layer.__class__.__name__ == 'BatchNormalization' for layer in folded.layers)
+
+	inputs = rng.standard_normal((2, Constants.nz, nx, ny, Constants.maxPoints, 6)).astype(np.float32)
+	for output, foldedOutput in zip(model(inputs, training=False), folded(inputs, training=False)):
+		np.testing.assert_allclose(foldedOutput, output, rtol=1e-4, atol=1e-4 * np.abs(output).max())
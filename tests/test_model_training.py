@@ -0,0 +1,292 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+from tensorflow.keras.layers import Activation, BatchNormalization, Concatenate, Conv2D, Conv2DTranspose, Conv3D, \
+	Dense, Input, Permute, Reshape, ZeroPadding3D
+from tensorflow.keras.models import Model, load_model
+
+import Constants
+import parallel_preprocessing
+import preprocess_cache
+import serialize_data
+from model_training import MaxPoolingVFELayer, PointwiseDenseLayer, RepeatLayer, ScatterVoxelLayer, VFEBlockLayer, \
+	addRPNConvLayer, copyWeights, createModel, createSparseModel, createTrainingDataset, customLayers, \
+	getRPNInputShape, loadCurrentModel, setPrecisionPolicy, stackVoxelBatch, train, voxelsToDense, weightKind, \
+	weightLayers
+from model_weights import randomizeNormalization
+from serialize_data import preprocessLabels
+
+voxelShape = (2, 3, 4, Constants.maxPoints)
+
+
+def setRandomWeights(model, rng):
+	# kept positive so the variances are valid
+	for layer in weightLayers(model):
+		if layer.weights:
+			layer.set_weights([rng.uniform(0.5, 1.5, weight.shape).astype(np.float32) for weight in layer.get_weights()])
+
+
+def randomVoxels(rng, channels=6):
+	return rng.standard_normal((2,) + voxelShape + (channels,)).astype(np.float32)
+
+
+def vfeModel(concat):
+	'''
+	Two VFE blocks and the FCN after them, passing the blocks' [pooled, pointwise] output on as it is or concatenated
+	like the layers VFEBlockLayer replaced.
+	'''
+	inLayer = Input(shape=voxelShape + (6,))
+	layer = inLayer
+	for units in [16, 32]:
+		layer = VFEBlockLayer(units)(layer)
+		if concat:
+			pooling, layer = layer
+			layer = Concatenate()([RepeatLayer()(pooling), layer])
+	return Model(inLayer, PointwiseDenseLayer(64, 'relu', batchNorm='after')(layer))
+
+
+def test_vfe_block_matches_concat():
+	split = vfeModel(False)
+	concat = vfeModel(True)
+	setRandomWeights(split, np.random.default_rng(0))
+	setRandomWeights(concat, np.random.default_rng(0))
+	inputs = randomVoxels(np.random.default_rng(1))
+	for training in [False, True]:
+		with tf.GradientTape(persistent=True) as tape:
+			splitOut = split(inputs, training=training)
+			concatOut = concat(inputs, training=training)
+			splitLoss = tf.reduce_sum(splitOut ** 2)
+			concatLoss = tf.reduce_sum(concatOut ** 2)
+		np.testing.assert_allclose(splitOut, concatOut, rtol=1e-5, atol=1e-5)
+		for splitGrad, concatGrad in zip(tape.gradient(splitLoss, split.trainable_weights),
+										 tape.gradient(concatLoss, concat.trainable_weights)):
+			# sums of many terms, so entries near 0 are only close relative to the largest one
+			np.testing.assert_allclose(splitGrad, concatGrad, rtol=1e-4, atol=1e-4 * np.abs(concatGrad).max())
+
+
+def test_vfe_block_output_is_not_repeated():
+	pooling, layer = VFEBlockLayer(16)(randomVoxels(np.random.default_rng(0)))
+	assert pooling.shape[Constants.pointIndex] == 1
+	assert layer.shape[Constants.pointIndex] == Constants.maxPoints
+
+
+def oldDenseLayer(layer, units, act=None):
+	# Dense layer between two Reshape layers, like addDenseLayer before PointwiseDenseLayer
+	oldShape = layer.shape[1:]
+	layer = Reshape((int(np.prod(oldShape[:-2])),) + tuple(oldShape[-2:]))(layer)
+	layer = Dense(units, activation=act, use_bias=False)(layer)
+	return Reshape(tuple(oldShape[:-1]) + (units,))(layer)
+
+
+def oldFCN(layer, units):
+	layer = oldDenseLayer(layer, units)
+	layer = BatchNormalization()(layer)
+	return Activation('relu')(layer)
+
+
+def oldVFELayer(layer, units):
+	layer = oldFCN(layer, units)
+	pooling = RepeatLayer()(MaxPoolingVFELayer()(layer))
+	return Concatenate()([pooling, layer])
+
+
+def oldConv3DLayer(layer, cout, s, p):
+	layer = ZeroPadding3D(padding=p)(layer)
+	layer = Conv3D(cout, kernel_size=3, strides=s, padding='valid')(layer)
+	layer = BatchNormalization()(layer)
+	return oldDenseLayer(layer, cout, 'relu')
+
+
+def oldModel(nx, ny):
+	'''
+	createModel as it was built before PointwiseDenseLayer and VFEBlockLayer, like the fixedTheta checkpoints.
+	'''
+	inLayer = Input(shape=(Constants.nz, nx, ny, Constants.maxPoints, 6))
+	layer = oldVFELayer(inLayer, 16)
+	layer = oldVFELayer(layer, 32)
+	layer = oldFCN(layer, 64)
+	layer = MaxPoolingVFELayer(combine=True)(layer)
+	layer = oldConv3DLayer(layer, 64, (2, 1, 1), (1, 1, 1))
+	layer = oldConv3DLayer(layer, 64, (1, 1, 1), (0, 1, 1))
+	layer = oldConv3DLayer(layer, 64, (2, 1, 1), (1, 1, 1))
+	# the RPN hasn't changed
+	layer = Permute((2, 3, 4, 1))(layer)
+	layer = Reshape(getRPNInputShape(layer.shape))(layer)
+	rpnConv = addRPNConvLayer(layer, 128, 128, 3)
+	rpnConv1Out = Conv2DTranspose(256, strides=1, kernel_size=3, padding='same')(rpnConv)
+	rpnConv = addRPNConvLayer(rpnConv, 128, 128, 5)
+	rpnConv2Out = Conv2DTranspose(256, strides=2, kernel_size=2, padding='same')(rpnConv)
+	rpnConv = addRPNConvLayer(rpnConv, 128, 256, 5)
+	rpnConv3Out = Conv2DTranspose(256, strides=4, kernel_size=4, padding='same')(rpnConv)
+	layer = Concatenate()([rpnConv1Out, rpnConv2Out, rpnConv3Out])
+	probabilityLayer = Conv2D(2, kernel_size=1, strides=1, padding='same')(layer)
+	regressionMap = Conv2D(14, kernel_size=1, strides=1, padding='same')(layer)
+	return Model(inLayer, [probabilityLayer, regressionMap])
+
+
+def test_copy_weights_from_old_model():
+	nx, ny = 16, 32
+	# recomputing changes the order of model.weights but not the layers copyWeights goes over
+	for recomputeSegment in [0, 3]:
+		old = oldModel(nx, ny)
+		randomizeNormalization(old, np.random.default_rng(0))
+		new = createModel(nx, ny, Constants.nz, Constants.maxPoints, recomputeSegment)
+		copyWeights(old, new)
+		inputs = np.random.default_rng(1).standard_normal((2, Constants.nz, nx, ny, Constants.maxPoints, 6)) \
+			.astype(np.float32)
+		# training normalizes with the batch's statistics, then inference with the moving averages
+		for training in [False, True]:
+			for oldOutput, newOutput in zip(old(inputs, training=training), new(inputs, training=training)):
+				scale = np.abs(oldOutput).max()
+				np.testing.assert_allclose(newOutput, oldOutput, rtol=1e-4, atol=1e-4 * scale)
+		# training also moved the moving averages the same way
+		for oldOutput, newOutput in zip(old(inputs, training=False), new(inputs, training=False)):
+			np.testing.assert_allclose(newOutput, oldOutput, rtol=1e-4, atol=1e-4 * np.abs(oldOutput).max())
+
+
+def movingAverages(model):
+	return [weight.numpy() for layer in weightLayers(model) for weight in layer.weights
+			if weightKind(weight) in ['moving_mean', 'moving_variance']]
+
+
+def test_recompute_updates_moving_averages_once():
+	nx, ny = 8, 16
+	rng = np.random.default_rng(0)
+	inputs = rng.standard_normal((1, Constants.nz, nx, ny, Constants.maxPoints, 6)).astype(np.float32)
+	labels = [np.zeros((1, nx // 2, ny // 2, len(Constants.anchors)), dtype=np.float32),
+			  np.zeros((1, nx // 2, ny // 2, len(Constants.anchors) * 7), dtype=np.float32)]
+	expected = None
+	for recomputeSegment in [0, 1, 3]:
+		model = createModel(nx, ny, Constants.nz, Constants.maxPoints, recomputeSegment)
+		setRandomWeights(model, np.random.default_rng(1))
+		# an eager step, then a compiled one like model.fit makes
+		with tf.GradientTape() as tape:
+			loss = tf.reduce_sum(model(inputs, training=True)[0])
+		tape.gradient(loss, model.trainable_weights)
+		model.compile(optimizer=tf.keras.optimizers.SGD(0.), loss=['mse', 'mse'])
+		model.train_on_batch(inputs, labels)
+		averages = movingAverages(model)
+		if expected is None:
+			expected = averages
+		for average, expectedAverage in zip(averages, expected):
+			np.testing.assert_allclose(average, expectedAverage, rtol=1e-4, atol=1e-4 * np.abs(expectedAverage).max())
+
+
+# moving averages of the VFE layers, the ones before the voxels are scattered into the grid
+def vfeMovingAverages(model):
+	layers = weightLayers(model)
+	layers = layers[:[type(layer) for layer in layers].index(ScatterVoxelLayer)]
+	return [weight.numpy() for layer in layers for weight in layer.weights
+			if weightKind(weight) in ['moving_mean', 'moving_variance']]
+
+
+def test_sparse_model_statistics_ignore_padding():
+	nx, ny = 8, 16
+	rng = np.random.default_rng(0)
+	cells = rng.permutation(Constants.nz * nx * ny)[:9]
+	coords = np.stack(np.unravel_index(cells, (Constants.nz, nx, ny)), axis=1)
+	features = rng.standard_normal((len(coords), Constants.maxPoints, 6)).astype(np.float32)
+	# the same voxels as one sample, and split over two samples with padding
+	whole = stackVoxelBatch([(features, coords)])
+	split = list(stackVoxelBatch([(features[:3], coords[:3]), (features[3:], coords[3:])]))
+	# extra padding voxels, with features that would change the statistics if they were used
+	split[0] = np.concatenate((split[0], rng.standard_normal((2, 4, Constants.maxPoints, 6)).astype(np.float32)), 1)
+	split[1] = np.concatenate((split[1], np.full((2, 4, 3), -1, dtype=np.int32)), axis=1)
+	for recomputeSegment in [0, 1]:
+		averages = []
+		for inputs in [whole, split]:
+			model = createSparseModel(nx, ny, Constants.nz, Constants.maxPoints, recomputeSegment)
+			setRandomWeights(model, np.random.default_rng(1))
+			model([tf.constant(inputs[0]), tf.constant(inputs[1])], training=True)
+			averages.append(vfeMovingAverages(model))
+		for wholeAverage, splitAverage in zip(*averages):
+			np.testing.assert_allclose(splitAverage, wholeAverage, rtol=1e-4, atol=1e-4 * np.abs(wholeAverage).max())
+
+
+def test_sparse_model_saves_with_voxel_mask(tmp_path):
+	model = createSparseModel(8, 16, Constants.nz, Constants.maxPoints)
+	model.save(str(tmp_path / 'sparse.h5'))
+	loaded = load_model(str(tmp_path / 'sparse.h5'), custom_objects=customLayers)
+	inputs = stackVoxelBatch([(np.ones((2, Constants.maxPoints, 6), dtype=np.float32), np.array([[1, 2, 3], [4, 5, 6]]))])
+	for output, loadedOutput in zip(model.predict(list(inputs)), loaded.predict(list(inputs))):
+		np.testing.assert_allclose(loadedOutput, output, rtol=1e-5, atol=1e-5)
+
+
+@pytest.fixture
+def restorePrecision():
+	yield
+	setPrecisionPolicy('float32')
+
+
+@pytest.mark.parametrize('precision', ['mixed_bfloat16', 'mixed_float16'])
+def test_models_train_with_reduced_precision(precision, restorePrecision):
+	nx, ny = 8, 16
+	rng = np.random.default_rng(0)
+	dense = rng.standard_normal((1, Constants.nz, nx, ny, Constants.maxPoints, 6)).astype(np.float32)
+	cells = rng.permutation(Constants.nz * nx * ny)[:9]
+	coords = np.stack(np.unravel_index(cells, (Constants.nz, nx, ny)), axis=1)
+	sparse = list(stackVoxelBatch([(dense[0][tuple(coords.T)], coords)]))
+	labels = [np.zeros((1, nx // 2, ny // 2, len(Constants.anchors)), dtype=np.float32),
+			  np.zeros((1, nx // 2, ny // 2, len(Constants.anchors) * 7), dtype=np.float32)]
+	for create, inputs in [(createModel, dense), (createSparseModel, sparse)]:
+		for recomputeSegment in [0, 1]:
+			model = create(nx, ny, Constants.nz, Constants.maxPoints, recomputeSegment, precision)
+			model.compile(optimizer=tf.keras.optimizers.SGD(0.01), loss=['mse', 'mse'])
+			before = movingAverages(model)
+			losses = model.train_on_batch(inputs, labels)
+			assert np.all(np.isfinite(losses))
+			# the batch normalization statistics stay float32 and were moved
+			after = movingAverages(model)
+			assert all(average.dtype == np.float32 for average in after)
+			assert any(not np.array_equal(average, oldAverage) for average, oldAverage in zip(after, before))
+
+
+def test_training_dataset_makes_samples_on_demand(tmp_path, monkeypatch):
+	monkeypatch.setattr(Constants, 'nx', 16)
+	monkeypatch.setattr(Constants, 'ny', 32)
+	monkeypatch.setattr(Constants, 'cache_dir', str(tmp_path / 'cache'))
+	rng = np.random.default_rng(0)
+	points = {str(i): rng.uniform([-4, -4, 0.3], [4, 4, 1.7], (200, 3)).astype(np.float32) for i in range(4)}
+	cars = {token: np.array([[rng.uniform(-3, 3), rng.uniform(-3, 3), 1., 3.9, 1.6, 1.56, 0.1]]) for token in points}
+	# nothing is cached, the workers read each sample's points through its sensor frames, here just its token
+	monkeypatch.setattr(parallel_preprocessing, 'getLidarSensorFrames', lambda sample, level5Data: sample['token'])
+	monkeypatch.setattr(parallel_preprocessing, 'combineLidarFiles', lambda sensorFrames, dataDir: points[sensorFrames])
+	monkeypatch.setattr(serialize_data, 'getCarLabels', lambda sample, level5Data: cars[sample['token']])
+	samples = [{'token': token, 'scene_token': 'scene' + str(int(token) % 2)} for token in points]
+	for sparseInput in [False, True]:
+		dataset = createTrainingDataset(samples, None, sparseInput, batch_size=1, shuffle_buffer=0, workers=2)
+		for epoch in range(2):
+			batches = list(dataset)
+			assert len(batches) == len(samples)
+			for sample, (modelInput, (outClass, outRegress)) in zip(samples, batches):
+				features, coords = preprocess_cache.loadVoxels(sample['token'])
+				if sparseInput:
+					np.testing.assert_array_equal(modelInput[0][0], features)
+					np.testing.assert_array_equal(modelInput[1][0], coords)
+				else:
+					np.testing.assert_array_equal(modelInput[0], voxelsToDense(features, coords))
+				expectedClass, expectedRegress = preprocessLabels(cars[sample['token']])
+				# the negatives kept are picked at random
+				np.testing.assert_array_equal(outClass[0] == 2, expectedClass == 2)
+				assert (outClass[0] == 1).numpy().sum() == (expectedClass == 1).sum()
+				np.testing.assert_allclose(outRegress[0], expectedRegress, rtol=1e-6)
+
+
+def test_train_one_epoch(tmp_path, monkeypatch):
+	# a small grid and a handful of cached samples, so train() runs end to end without the dataset
+	monkeypatch.setattr(Constants, 'nx', 16)
+	monkeypatch.setattr(Constants, 'ny', 32)
+	monkeypatch.setattr(Constants, 'cache_dir', str(tmp_path / 'cache'))
+	monkeypatch.setattr(parallel_preprocessing, 'getLidarSensorFrames', lambda sample, level5Data: [])
+	rng = np.random.default_rng(0)
+	samples = [{'token': str(i), 'scene_token': 'scene'} for i in range(3)]
+	for sample in samples:
+		points = rng.uniform([-4, -4, 0.3], [4, 4, 1.7], (200, 3)).astype(np.float32)
+		preprocess_cache.saveVoxels(sample['token'], *parallel_preprocessing.voxelize(points))
+	cars = np.array([[2., -1.5, 1., 3.9, 1.6, 1.56, 0.1]])
+	monkeypatch.setattr(serialize_data, 'getCarLabels', lambda sample, level5Data: cars)
+	savePath = str(tmp_path / 'model.h5')
+	for sparseInput in [False, True]:
+		train(samples, None, savePath, sparse_input=sparseInput, batch_size=2, workers=2)
+		model = loadCurrentModel(savePath, sparseInput)
+		assert all(np.all(np.isfinite(weight)) for weight in model.get_weights())
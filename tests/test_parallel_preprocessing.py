@@ -0,0 +1,27 @@
+import os
+
+import numpy as np
+
+import parallel_preprocessing
+
+
+def arraysJob(job):
+	size, dtype = job
+	array = np.arange(size).astype(dtype)
+	return {'array': array, 'parts': [array[:1], (array[1:], 'label')], 'pid': os.getpid(), 'empty': np.zeros(0)}
+
+
+def test_map_jobs_returns_arrays_in_job_order():
+	jobs = [(size, dtype) for size in [5, 1000, 3] for dtype in ['float32', 'uint8', 'bool']]
+	results = list(parallel_preprocessing.mapJobs(arraysJob, iter(jobs), 2, chunksize=2))
+	assert len(results) == len(jobs)
+	for (size, dtype), (result, seconds) in zip(jobs, results):
+		expected = np.arange(size).astype(dtype)
+		assert seconds >= 0
+		assert result['pid'] != os.getpid()
+		np.testing.assert_array_equal(result['array'], expected)
+		assert result['array'].dtype == expected.dtype
+		np.testing.assert_array_equal(result['parts'][0], expected[:1])
+		np.testing.assert_array_equal(result['parts'][1][0], expected[1:])
+		assert result['parts'][1][1] == 'label'
+		assert result['empty'].shape == (0,)
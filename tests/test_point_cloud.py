@@ -0,0 +1,104 @@
+import numpy as np
+from tensorflow import SparseTensor
+
+from model_training import VFE_preprocessing, get_voxel
+from point_cloud import voxelizePoints
+
+xSize, ySize, zSize = 0.5, 0.25, 0.25
+maxVoxelX, maxVoxelY, maxVoxelZ = 4, 5, 6
+sampleSize = 35
+
+
+def oldVFEPreprocessing(points, xSize, ySize, zSize, sampleSize, maxVoxelX, maxVoxelY, maxVoxelZ):
+	'''
+	The per point dict grouping VFE_preprocessing used before voxelizePoints.
+	'''
+	clusteredPoints = {}
+	for idx, point in enumerate(points):
+		key = get_voxel(point, xSize, ySize, zSize)
+		if -maxVoxelX < key[0] and key[0] < maxVoxelX \
+				and -maxVoxelY < key[1] and key[1] < maxVoxelY \
+				and 0 < key[2] and key[2] < maxVoxelZ:
+			fixedKey = (key[0] + maxVoxelX, key[1] + maxVoxelY, key[2])
+			if fixedKey in clusteredPoints:
+				clusteredPoints[fixedKey].append(idx)
+			else:
+				clusteredPoints[fixedKey] = [idx]
+	appendedPoints = {}
+	for voxel in clusteredPoints:
+		s = sampleSize if len(clusteredPoints[voxel]) > sampleSize else len(clusteredPoints[voxel])
+		sampleIdx = np.random.choice(clusteredPoints[voxel], size=s, replace=False)
+		currPoints = points[sampleIdx]
+		centroid = np.mean(currPoints, axis=0)
+		centroidX = currPoints[:, 0:1] - centroid[0]
+		centroidY = currPoints[:, 1:2] - centroid[1]
+		centroidZ = currPoints[:, 2:3] - centroid[2]
+		concat = np.hstack((currPoints, centroidX, centroidY, centroidZ))
+		buffer = np.vstack((concat, np.zeros((sampleSize - s, 6))))
+		appendedPoints[voxel] = buffer
+	indices = []
+	values = []
+	for voxel in appendedPoints:
+		for i in range(len(appendedPoints[voxel])):
+			for j in range(len(appendedPoints[voxel][i])):
+				indices.append((voxel[2],) + voxel[:2] + (i, j))
+				values.append(appendedPoints[voxel][i][j])
+	return SparseTensor(indices=indices, values=values,
+						dense_shape=[maxVoxelZ, maxVoxelX * 2, maxVoxelY * 2, sampleSize, 6])
+
+
+def gridPoints(rng):
+	# spread over the grid and one voxel past it on every side
+	low = np.array([-(maxVoxelX + 1) * xSize, -(maxVoxelY + 1) * ySize, -zSize])
+	high = np.array([(maxVoxelX + 1) * xSize, (maxVoxelY + 1) * ySize, (maxVoxelZ + 1) * zSize])
+	points = rng.uniform(low, high, (400, 3))
+	# exactly on the lower corners of the excluded edge voxels, the z = 0 layer and the last voxels that are kept
+	edges = np.array([[-maxVoxelX * xSize, 0.1, 0.3],
+					  [maxVoxelX * xSize, 0.1, 0.3],
+					  [(maxVoxelX - 1) * xSize, 0.1, 0.3],
+					  [(-maxVoxelX + 1) * xSize, 0.1, 0.3],
+					  [0.1, -maxVoxelY * ySize, 0.3],
+					  [0.1, maxVoxelY * ySize, 0.3],
+					  [0.1, (maxVoxelY - 1) * ySize, 0.3],
+					  [0.1, 0.1, 0.],
+					  [0.1, 0.1, zSize],
+					  [0.1, 0.1, maxVoxelZ * zSize],
+					  [0.1, 0.1, (maxVoxelZ - 1) * zSize]])
+	return np.concatenate((points, edges)).astype(np.float32)
+
+
+# Rows of the (point, 6) slots of a voxel that hold a point, sorted so the order points were sampled in doesn't matter.
+def sortedPoints(voxelFeatures):
+	rows = voxelFeatures[np.any(voxelFeatures != 0, axis=1)]
+	return rows[np.lexsort(rows[:, :3].T[::-1])]
+
+
+def test_voxelize_points_matches_dict_grouping():
+	points = gridPoints(np.random.default_rng(0))
+	features, coords = voxelizePoints(points, xSize, ySize, zSize, sampleSize, maxVoxelX, maxVoxelY, maxVoxelZ)
+	old = oldVFEPreprocessing(points, xSize, ySize, zSize, sampleSize, maxVoxelX, maxVoxelY, maxVoxelZ)
+	oldIndices = old.indices.numpy()
+	oldDense = np.zeros(old.dense_shape.numpy(), dtype=np.float32)
+	oldDense[tuple(oldIndices.T)] = old.values.numpy()
+
+	# every voxel has fewer points than sampleSize, so both keep all of them
+	assert features[:, -1].max() == 0
+	oldCoords = np.unique(oldIndices[:, :3], axis=0)
+	np.testing.assert_array_equal(np.unique(coords, axis=0), oldCoords)
+	assert len(coords) == len(oldCoords)
+	for voxelFeatures, (z, x, y) in zip(features, coords):
+		np.testing.assert_allclose(sortedPoints(voxelFeatures), sortedPoints(oldDense[z, x, y]), atol=1e-6)
+
+	new = VFE_preprocessing(points, xSize, ySize, zSize, sampleSize, maxVoxelX, maxVoxelY, maxVoxelZ)
+	np.testing.assert_array_equal(new.dense_shape.numpy(), old.dense_shape.numpy())
+	np.testing.assert_array_equal(np.unique(new.indices.numpy(), axis=0), np.unique(oldIndices, axis=0))
+	assert len(new.indices.numpy()) == len(oldIndices)
+
+
+def test_voxelize_points_excludes_grid_edges():
+	points = gridPoints(np.random.default_rng(1))[-11:]
+	_, coords = voxelizePoints(points, xSize, ySize, zSize, sampleSize, maxVoxelX, maxVoxelY, maxVoxelZ)
+	# z, x, y of the kept edge points, with x and y moved by maxVoxel
+	expected = {(1, 2 * maxVoxelX - 1, maxVoxelY), (1, 1, maxVoxelY), (1, maxVoxelX, 2 * maxVoxelY - 1),
+				(1, maxVoxelX, maxVoxelY), (maxVoxelZ - 1, maxVoxelX, maxVoxelY)}
+	assert set(map(tuple, coords.tolist())) == expected
@@ -0,0 +1,73 @@
+import json
+
+import numpy as np
+
+import Constants
+import parallel_preprocessing
+import point_shards
+
+
+def writeShard(shardDir, sceneToken, samplePoints):
+	'''
+	Writes a shard the way writeSceneShard does, from a dict of sample token to points.
+	'''
+	binPath, indexPath = point_shards.shardPaths(sceneToken, str(shardDir))
+	index = {}
+	offset = 0
+	with open(binPath, 'wb') as f:
+		for sampleToken, points in samplePoints.items():
+			points.astype(np.float32).tofile(f)
+			index[sampleToken] = [offset, len(points)]
+			offset += len(points)
+	with open(indexPath, 'w') as f:
+		json.dump(index, f)
+
+
+def randomPoints(rng, count):
+	# inside the grid, with a few points per voxel
+	return rng.uniform([-5, -5, 0.3], [5, 5, 1.7], (count, 3)).astype(np.float32)
+
+
+def test_read_scene_matches_read_shard_points(tmp_path):
+	rng = np.random.default_rng(0)
+	samplePoints = {'a': randomPoints(rng, 50), 'b': rng.uniform(-80, 80, (70, 3)), 'c': randomPoints(rng, 0),
+					'd': randomPoints(rng, 30)}
+	writeShard(tmp_path, 'scene', samplePoints)
+	for sampleTokens in [None, ['b', 'd'], ['c'], ['missing']]:
+		for cropToRoi in [True, False]:
+			scenePoints = point_shards.readScene('scene', str(tmp_path), cropToRoi, sampleTokens)
+			expectedTokens = [token for token in (sampleTokens or samplePoints) if token in samplePoints]
+			assert sorted(scenePoints) == sorted(expectedTokens)
+			for sampleToken in expectedTokens:
+				location = point_shards.findSample({'token': sampleToken, 'scene_token': 'scene'}, str(tmp_path))
+				np.testing.assert_array_equal(scenePoints[sampleToken],
+											  point_shards.readShardPoints(location, cropToRoi))
+	assert point_shards.readScene('no shard', str(tmp_path)) == {}
+
+
+def test_run_jobs_groups_scenes_in_sample_order(tmp_path, monkeypatch):
+	rng = np.random.default_rng(1)
+	shardDir = tmp_path / 'shards'
+	shardDir.mkdir()
+	sceneA = {'a0': randomPoints(rng, 40), 'a1': randomPoints(rng, 60)}
+	writeShard(shardDir, 'A', sceneA)
+	monkeypatch.setattr(Constants, 'cache_dir', str(tmp_path / 'cache'))
+	# scene B has no shard, its samples have no lidar files either
+	monkeypatch.setattr(parallel_preprocessing, 'getLidarSensorFrames', lambda sample, level5Data: [])
+	samples = [{'token': 'a1', 'scene_token': 'A'}, {'token': 'b0', 'scene_token': 'B'},
+			   {'token': 'a0', 'scene_token': 'A'}]
+	voxels = list(parallel_preprocessing.runJobs(samples, None, 2, True, str(shardDir)))
+
+	expected = [sceneA['a1'], np.zeros((0, 3), dtype=np.float32), sceneA['a0']]
+	assert len(voxels) == len(expected)
+	for (features, coords), points in zip(voxels, expected):
+		expectedFeatures, expectedCoords = parallel_preprocessing.voxelize(points)
+		np.testing.assert_array_equal(coords, expectedCoords)
+		# the points of a voxel are in a random order, their sum isn't
+		np.testing.assert_allclose(features.astype(np.float32).sum(axis=1),
+								   expectedFeatures.astype(np.float32).sum(axis=1), rtol=1e-3, atol=1e-3)
+	# a second run reads the cache
+	cached = list(parallel_preprocessing.runJobs(samples, None, 2, True, str(tmp_path / 'no shards')))
+	for (features, coords), (cachedFeatures, cachedCoords) in zip(voxels, cached):
+		np.testing.assert_array_equal(cachedFeatures, features)
+		np.testing.assert_array_equal(cachedCoords, coords)
@@ -0,0 +1,76 @@
+import math
+
+import numpy as np
+import pytest
+
+import Constants
+import preprocess_cache
+
+
+@pytest.fixture
+def cacheDir(tmp_path, monkeypatch):
+	monkeypatch.setattr(Constants, 'cache_dir', str(tmp_path / 'cache'))
+
+
+def voxels():
+	rng = np.random.default_rng(0)
+	return preprocess_cache.narrowVoxels(rng.standard_normal((5, Constants.maxPoints, 6)),
+										 rng.integers(0, 10, (5, 3)))
+
+
+def labels():
+	outClass = np.zeros(preprocess_cache.labelShape(), dtype=np.float32)
+	outRegress = np.zeros(outClass.shape[:2] + (outClass.shape[2] * 7,), dtype=np.float32)
+	outClass[3, 4, 1] = 1
+	outRegress[3, 4, 7:] = 2
+	return preprocess_cache.compactLabels(outClass, outRegress)
+
+
+def test_unchanged_settings_use_the_same_dirs(cacheDir):
+	assert preprocess_cache.voxelCacheDir() == preprocess_cache.voxelCacheDir()
+	assert preprocess_cache.labelCacheDir() == preprocess_cache.labelCacheDir()
+	preprocess_cache.saveVoxels('sample', *voxels())
+	preprocess_cache.saveLabels('sample', *labels())
+	for expected, cached in zip(voxels(), preprocess_cache.loadVoxels('sample')):
+		np.testing.assert_array_equal(cached, expected)
+	for expected, cached in zip(labels(), preprocess_cache.loadLabels('sample')):
+		np.testing.assert_array_equal(cached, expected)
+
+
+def test_storage_dtype_starts_new_caches(cacheDir, monkeypatch):
+	voxelDir, labelDir = preprocess_cache.voxelCacheDir(), preprocess_cache.labelCacheDir()
+	preprocess_cache.saveVoxels('sample', *voxels())
+	preprocess_cache.saveLabels('sample', *labels())
+
+	monkeypatch.setattr(Constants, 'storageDtype', 'float16')
+	assert preprocess_cache.voxelCacheDir() != voxelDir
+	assert preprocess_cache.labelCacheDir() != labelDir
+	assert preprocess_cache.loadVoxels('sample') is None
+	assert preprocess_cache.loadLabels('sample') is None
+
+	# going back finds the old cache again
+	monkeypatch.setattr(Constants, 'storageDtype', 'float32')
+	assert preprocess_cache.voxelCacheDir() == voxelDir
+	assert preprocess_cache.loadVoxels('sample') is not None
+	assert preprocess_cache.loadLabels('sample') is not None
+
+
+def test_anchors_only_start_a_new_label_cache(cacheDir, monkeypatch):
+	voxelDir, labelDir = preprocess_cache.voxelCacheDir(), preprocess_cache.labelCacheDir()
+	preprocess_cache.saveVoxels('sample', *voxels())
+	preprocess_cache.saveLabels('sample', *labels())
+
+	monkeypatch.setattr(Constants, 'anchors', [[1.6, 3.9, 1.56, 0], [1.6, 3.9, 1.56, math.pi / 4]])
+	assert preprocess_cache.voxelCacheDir() == voxelDir
+	assert preprocess_cache.labelCacheDir() != labelDir
+	assert preprocess_cache.loadVoxels('sample') is not None
+	assert preprocess_cache.loadLabels('sample') is None
+
+
+def test_every_label_setting_starts_a_new_label_cache(cacheDir, monkeypatch):
+	labelDir = preprocess_cache.labelCacheDir()
+	for name in ['iouLowerBound', 'iouUpperBound', 'maxRegions']:
+		with monkeypatch.context() as patch:
+			patch.setattr(Constants, name, getattr(Constants, name) + 1)
+			assert preprocess_cache.labelCacheDir() != labelDir, name
+	assert preprocess_cache.labelCacheDir() == labelDir
@@ -0,0 +1,90 @@
+import numpy as np
+
+import Constants
+from box_iou import iouMatrix
+from rpnToRegion import nonMaxSuppressionFast
+
+
+def loopSuppression(boxInfo, probInfo, overlapThresh, maxBoxes):
+	'''
+	The old max suppression, one box at a time. Boxes that aren't the most probable one and are out of range are never
+	picked.
+	'''
+	idxs = list(np.argsort(probInfo, kind='stable')[::-1])
+	pick = []
+	while len(idxs) > 0 and len(pick) < maxBoxes:
+		currI = idxs.pop(0)
+		pick.append(currI)
+		kept = []
+		for other in idxs:
+			x, y = boxInfo[other, :2]
+			outOfRange = x - Constants.anchors[0][0] < 0 or x + Constants.anchors[0][0] > 100 \
+				or y - Constants.anchors[0][1] < 0 or y + Constants.anchors[0][1] > 100
+			if not outOfRange and iouMatrix(boxInfo[currI:currI + 1, :7], boxInfo[other:other + 1, :7])[0, 0] <= overlapThresh:
+				kept.append(other)
+		idxs = kept
+	return boxInfo[pick], probInfo[pick]
+
+
+def randomBoxes(rng, count):
+	'''
+	Cars spread over the map and a bit past its edges, with distinct probabilities.
+	'''
+	boxes = np.stack((rng.uniform(-5, 105, count),
+					  rng.uniform(-5, 105, count),
+					  rng.uniform(0.5, 1.5, count),
+					  rng.uniform(3.5, 5, count),
+					  rng.uniform(1.5, 2.2, count),
+					  rng.uniform(1.3, 1.8, count),
+					  rng.uniform(-np.pi, np.pi, count)), axis=1)
+	return boxes, rng.permutation(count) / count
+
+
+def outOfRange(boxes):
+	return (boxes[:, 0] - Constants.anchors[0][0] < 0) | (boxes[:, 0] + Constants.anchors[0][0] > 100) \
+		| (boxes[:, 1] - Constants.anchors[0][1] < 0) | (boxes[:, 1] + Constants.anchors[0][1] > 100)
+
+
+def test_matches_loop():
+	rng = np.random.default_rng(0)
+	for overlapThresh in [0., 0.1, 0.5]:
+		boxes, probs = randomBoxes(rng, 300)
+		expected = loopSuppression(boxes, probs, overlapThresh, 300)
+		result = nonMaxSuppressionFast(boxes, probs, overlapThresh, 300)
+		np.testing.assert_array_equal(result[0], expected[0])
+		np.testing.assert_array_equal(result[1], expected[1])
+
+
+def test_out_of_range_boxes_dont_take_top_k_places():
+	rng = np.random.default_rng(1)
+	boxes, probs = randomBoxes(rng, 200)
+	# the most probable boxes are out of range, apart from the very most probable one which is always picked
+	order = np.argsort(probs)[::-1]
+	boxes[order[1:20], 0] = -1.
+	inRange = ~outOfRange(boxes)
+	inRange[order[0]] = True
+	topK = int(inRange.sum())
+	expected = loopSuppression(boxes, probs, 0., 300)
+	result = nonMaxSuppressionFast(boxes, probs, 0., 300, topK=topK)
+	np.testing.assert_array_equal(result[0], expected[0])
+	assert not outOfRange(result[0][1:]).any()
+
+
+def test_max_boxes_cap():
+	rng = np.random.default_rng(2)
+	boxes, probs = randomBoxes(rng, 200)
+	expected = loopSuppression(boxes, probs, 0., 300)
+	assert len(expected[0]) > 20
+	result = nonMaxSuppressionFast(boxes, probs, 0., 20)
+	assert len(result[0]) == 20
+	np.testing.assert_array_equal(result[0], expected[0][:20])
+	np.testing.assert_array_equal(result[1], expected[1][:20])
+
+
+def test_min_score():
+	rng = np.random.default_rng(3)
+	boxes, probs = randomBoxes(rng, 200)
+	confident = probs >= 0.5
+	expected = loopSuppression(boxes[confident], probs[confident], 0.1, 300)
+	result = nonMaxSuppressionFast(boxes, probs, 0.1, 300, minScore=0.5)
+	np.testing.assert_array_equal(result[0], expected[0])
@@ -0,0 +1,198 @@
+import os
+import random
+
+import numpy as np
+import pytest
+
+import Constants
+import preprocess_cache
+import serialize_data
+from serialize_data import calculateIntersection, calculateUnion, fixBoxScaling, preprocessLabels
+
+
+def oldCalculateIoU(box1, box2):
+	intersect = calculateIntersection(box1, box2)
+	union = calculateUnion(box1, box2, intersect)
+	return intersect / union
+
+
+def oldPreprocessLabels(data):
+	'''
+	The per anchor shapely loop preprocessLabels used before it was vectorized.
+	'''
+	outX = Constants.nx // 2
+	outY = Constants.ny // 2
+	voxelXSize = Constants.voxelx * 2
+	voxelYSize = Constants.voxely * 2
+	outRegress = np.zeros((outX, outY, len(Constants.anchors) * 7))
+	outValidBox = np.zeros((outX, outY, len(Constants.anchors)))
+	outRpnOverlap = np.zeros((outX, outY, len(Constants.anchors)))
+
+	bestIouForBox = np.zeros(len(data))
+	bestAnchorForBox = np.ones((len(data), 3)).astype(int) * -1
+	countAnchorsForBox = np.zeros(len(data))
+	bestRegressionForBox = np.zeros((len(data), 7))
+
+	fixedData = data * fixBoxScaling(data.shape, outX, outY, Constants.nx, Constants.ny)
+
+	centerZ = 1.
+	for i in range(len(Constants.anchors)):
+		for xVoxel in range(int(-outX / 2), int(outX / 2)):
+			centerX = voxelXSize * xVoxel + (voxelXSize / 2)
+			if centerX - (Constants.anchors[i][0] / 2) < voxelXSize * int(-outX / 2) \
+					or centerX + (Constants.anchors[i][0] / 2) > voxelXSize * int(outX / 2):
+				continue
+			for yVoxel in range(int(-outY / 2), int(outY / 2)):
+				centerY = voxelYSize * yVoxel + (voxelYSize / 2)
+				if centerY - (Constants.anchors[i][1] / 2) < voxelYSize * int(-outY / 2) \
+						or centerY + (Constants.anchors[i][1] / 2) > voxelYSize * int(outY / 2):
+					continue
+				boxType = 'neg'
+				bestIouForLoc = 0
+				bestRegression = (0, 0, 0, 0, 0, 0, 0)
+				for labelBoxNum in range(len(fixedData)):
+					anchorBox = [centerX, centerY, centerZ] + Constants.anchors[i]
+					iou = oldCalculateIoU(anchorBox, fixedData[labelBoxNum])
+					tx = (fixedData[labelBoxNum][0] - centerX) / anchorBox[3]
+					ty = (fixedData[labelBoxNum][1] - centerY) / anchorBox[4]
+					tz = (fixedData[labelBoxNum][2] - centerZ) / anchorBox[5]
+					tl = np.log(fixedData[labelBoxNum][3] / anchorBox[3])
+					tw = np.log(fixedData[labelBoxNum][4] / anchorBox[4])
+					th = np.log(fixedData[labelBoxNum][5] / anchorBox[5])
+					tyaw = fixedData[labelBoxNum][6] - anchorBox[6]
+
+					if iou > bestIouForBox[labelBoxNum]:
+						bestIouForBox[labelBoxNum] = iou
+						bestAnchorForBox[labelBoxNum] = (xVoxel, yVoxel, i)
+						bestRegressionForBox[labelBoxNum] = (tx, ty, tz, tl, tw, th, tyaw)
+					if iou >= Constants.iouUpperBound:
+						boxType = 'pos'
+						countAnchorsForBox[labelBoxNum] += 1
+						if iou > bestIouForLoc:
+							bestIouForLoc = iou
+							bestRegression = (tx, ty, tz, tl, tw, th, tyaw)
+					if Constants.iouLowerBound < iou <= Constants.iouUpperBound and boxType != 'pos':
+						boxType = 'neutral'
+
+				if boxType == 'neg':
+					outValidBox[xVoxel, yVoxel, i] = 1
+					outRpnOverlap[xVoxel, yVoxel, i] = 0
+				elif boxType == 'neutral':
+					outValidBox[xVoxel, yVoxel, i] = 0
+					outRpnOverlap[xVoxel, yVoxel, i] = 0
+				elif boxType == 'pos':
+					outValidBox[xVoxel, yVoxel, i] = 1
+					outRpnOverlap[xVoxel, yVoxel, i] = 1
+					outRegress[xVoxel, yVoxel, i * 7:i * 7 + 7] = bestRegression
+
+	for labelBoxNum in range(len(countAnchorsForBox)):
+		if countAnchorsForBox[labelBoxNum] == 0:
+			if bestIouForBox[labelBoxNum] == 0:
+				continue
+			bestAnchor = bestAnchorForBox[labelBoxNum]
+			outValidBox[bestAnchor[0], bestAnchor[1], bestAnchor[2]] = 1
+			outRpnOverlap[bestAnchor[0], bestAnchor[1], bestAnchor[2]] = 1
+			outRegress[bestAnchor[0], bestAnchor[1],
+			bestAnchor[2] * 7: bestAnchor[2] * 7 + 7] = bestRegressionForBox[labelBoxNum]
+
+	posLocs = np.where(np.logical_and(outValidBox[:, :, :] == 1, outRpnOverlap[:, :, :] == 1))
+	negLocs = np.where(np.logical_and(outValidBox[:, :, :] == 1, outRpnOverlap[:, :, :] == 0))
+
+	posRegionCount = len(posLocs[0])
+	if posRegionCount > Constants.maxRegions / 2:
+		locs = random.sample(range(posRegionCount), int(posRegionCount - Constants.maxRegions / 2))
+		outValidBox[posLocs[0][locs], posLocs[1][locs], posLocs[2][locs]] = 0
+		posRegionCount = Constants.maxRegions / 2
+
+	if len(negLocs[0]) + posRegionCount > Constants.maxRegions:
+		locs = random.sample(range(len(negLocs[0])), len(negLocs[0]) - int(posRegionCount))
+		outValidBox[negLocs[0][locs], negLocs[1][locs], negLocs[2][locs]] = 0
+
+	outClass = outValidBox + outRpnOverlap
+	outRegress = outRegress + np.repeat(outRpnOverlap, 7, axis=2)
+
+	return [outClass, outRegress]
+
+
+@pytest.fixture
+def smallGrid(monkeypatch):
+	# 20 m by 20 m of labels, a 10 by 20 anchor map
+	monkeypatch.setattr(Constants, 'nx', 40)
+	monkeypatch.setattr(Constants, 'ny', 80)
+
+
+# Car box in the car's frame whose scaled down box (see fixBoxScaling) is the anchor at that location, moved and
+# turned a little. It is raised by rise so the union of the IoU calculateIoU uses (h counts as half the height in the
+# intersection, but not in the volumes) isn't close to 0, where the old and new IoU would only agree on round off.
+def anchorBox(xVoxel, yVoxel, anchor, shift=(0., 0.), yaw=0., rise=2.):
+	length, width, height, anchorYaw = Constants.anchors[anchor]
+	centerX = Constants.voxelx * 2 * xVoxel + Constants.voxelx + shift[0]
+	centerY = Constants.voxely * 2 * yVoxel + Constants.voxely + shift[1]
+	return np.array([centerX * 2, centerY * 2, 1. + rise, length * 2, width * 2, height, anchorYaw + yaw])
+
+
+def assertSameLabels(data, maxRegions, monkeypatch):
+	monkeypatch.setattr(Constants, 'maxRegions', maxRegions)
+	random.seed(0)
+	outClass, outRegress = preprocessLabels(data)
+	random.seed(0)
+	oldClass, oldRegress = oldPreprocessLabels(data)
+	np.testing.assert_array_equal(outClass, oldClass)
+	# the regression values are made the same way, only the IoU kernel differs
+	np.testing.assert_allclose(outRegress, oldRegress, rtol=1e-12, atol=1e-12)
+	return outClass
+
+
+def test_no_cars(smallGrid, monkeypatch):
+	outClass = assertSameLabels(np.zeros((0, 7)), 64, monkeypatch)
+	# as many negatives are kept as there are positives, so none
+	assert not outClass.any()
+
+
+def test_fallback_anchor_only(smallGrid, monkeypatch):
+	# too small to reach the upper bound with any anchor, and it sits inside both anchors at its voxel equally
+	# so the first of them wins the tie
+	small = np.array([[1., 1., 1., 1., 0.5, 1.56, 0.]])
+	outClass = assertSameLabels(small, 64, monkeypatch)
+	assert (outClass == 2).sum() == 1
+
+
+def test_matches_old_loop(smallGrid, monkeypatch):
+	rng = np.random.default_rng(0)
+	boxes = [anchorBox(0, 0, 0), anchorBox(2, -5, 1), anchorBox(-3, 4, 0, (0.3, -0.2), 0.1),
+			 anchorBox(1, 1, 1, (0.1, 0.4), -0.2, 2.3), anchorBox(-4, -8, 0, (0.5, 0.25), rise=1.6),
+			 # small boxes that only get the fallback anchor, and one outside the map
+			 np.array([6., -6., 1.2, 1., 0.6, 1.7, 0.4]), np.array([-9., 9., 0.8, 0.8, 0.8, 1.8, 0.]),
+			 np.array([30., 0., 1., 4., 2., 1.5, 0.])]
+	for _ in range(6):
+		boxes.append(anchorBox(rng.integers(-5, 5), rng.integers(-10, 10), rng.integers(0, 2),
+							   rng.uniform(-0.5, 0.5, 2), rng.uniform(-0.3, 0.3), rng.uniform(1.6, 2.6)))
+	data = np.array(boxes)
+	# 8 also drops some of the positives
+	for maxRegions in [256, 8]:
+		outClass = assertSameLabels(data, maxRegions, monkeypatch)
+		assert (outClass == 2).sum() > 0
+
+
+def test_save_labels_writes_each_sample_once(smallGrid, tmp_path, monkeypatch):
+	monkeypatch.setattr(Constants, 'cache_dir', str(tmp_path / 'cache'))
+	boxes = {'a': np.array([anchorBox(0, 0, 0)]), 'b': np.zeros((0, 7)), 'c': np.array([anchorBox(2, -5, 1)])}
+	monkeypatch.setattr(serialize_data, 'getCarLabels', lambda sample, level5Data: boxes[sample['token']])
+	samples = [{'token': token} for token in boxes]
+	outPath = str(tmp_path / 'labels')
+	serialize_data.saveLabelsForSample(samples[:2], outPath, None, workers=2)
+	# a stopped run picks up the rest
+	serialize_data.saveLabelsForSample(samples, outPath, None, workers=2)
+
+	assert not os.path.exists(preprocess_cache.labelCacheDir())
+	assert sorted(os.listdir(outPath)) == sorted(['manifest.txt'] + [token + '_' + name + '.npy' for token in boxes
+																	 for name in preprocess_cache.labelNames])
+	tokens, labels = serialize_data.loadLabelsForSample(outPath)
+	assert tokens == list(boxes)
+	for i, token in enumerate(tokens):
+		outClass, outRegress = preprocessLabels(boxes[token])
+		savedClass, savedRegress = labels[i]
+		# the negatives kept are picked at random
+		assert (savedClass == 1).sum() == (outClass == 1).sum()
+		np.testing.assert_array_equal(savedClass == 2, outClass == 2)
+		np.testing.assert_allclose(savedRegress, outRegress, rtol=1e-6)
@@ -0,0 +1,53 @@
+import numpy as np
+from pyquaternion import Quaternion
+
+import transforms
+from fake_dataset import makeDataset, randomRotation, yawRotation
+
+
+def test_quaternion_yaw_matches_pyquaternion():
+	rng = np.random.default_rng(0)
+	rotations = [randomRotation(rng) for _ in range(50)] + [yawRotation(rng) for _ in range(50)]
+	# not normalized, like some rotations read back from json
+	rotations.append([2., 0., 0., 2.])
+	expected = [Quaternion(rotation).yaw_pitch_roll[0] for rotation in rotations]
+	np.testing.assert_allclose(transforms.quaternionYaw(rotations), expected, atol=1e-12)
+	assert np.isclose(transforms.quaternionYaw(rotations[0])[0], expected[0])
+
+
+def test_transform_matrix_matches_pyquaternion():
+	rng = np.random.default_rng(1)
+	points = rng.uniform(-50, 50, (20, 3))
+	for _ in range(20):
+		rotation = randomRotation(rng)
+		translation = list(rng.uniform(-500, 500, 3))
+		quaternion = Quaternion(rotation)
+		expected = np.array([quaternion.rotate(point) for point in points]) + translation
+		matrix = transforms.transformMatrix(rotation, translation)
+		np.testing.assert_allclose(transforms.applyTransform(matrix, points), expected, atol=1e-9)
+
+		inverse = transforms.transformMatrix(rotation, translation, inverse=True)
+		expected = np.array([quaternion.inverse.rotate(point - translation) for point in points])
+		np.testing.assert_allclose(transforms.applyTransform(inverse, points), expected, atol=1e-9)
+		np.testing.assert_allclose(np.dot(inverse, matrix), np.eye(4), atol=1e-12)
+
+
+def test_transform_cache_reuses_matrices():
+	rng = np.random.default_rng(2)
+	level5Data = makeDataset(rng, 3, [0, 0, 0])
+	level5Data.tables['calibrated_sensor'] = {'lidar': {'token': 'lidar', 'rotation': randomRotation(rng),
+														'translation': [1., 0., 1.8]}}
+	cache = transforms.TransformCache(level5Data)
+	for sample in level5Data.sample:
+		egoPose = level5Data.get('ego_pose', sample['token'])
+		matrix = cache.sampleGlobalToEgo(sample)
+		np.testing.assert_array_equal(
+			matrix, transforms.transformMatrix(egoPose['rotation'], egoPose['translation'], inverse=True))
+		# the same sample again gets the same matrix without building it again
+		assert cache.sampleGlobalToEgo(sample) is matrix
+		assert cache.globalToEgo(egoPose['token']) is matrix
+		np.testing.assert_allclose(np.dot(cache.egoToGlobal(egoPose['token']), matrix), np.eye(4), atol=1e-12)
+	assert len(cache.globalToEgoMatrices) == len(level5Data.sample)
+	sensorToEgo = cache.sensorToEgo('lidar')
+	assert cache.sensorToEgo('lidar') is sensorToEgo
+	assert transforms.getTransformCache(level5Data) is transforms.getTransformCache(level5Data)
@@ -0,0 +1,88 @@
+from functools import lru_cache
+
+import numpy as np
+from pyquaternion import Quaternion
+
+
+# 3x3 rotation matrix of a quaternion, kept after the first call. rotation has to be a tuple so it can be a key.
+@lru_cache(maxsize=4096)
+def rotationMatrix(rotation, inverse=False):
+	matrix = Quaternion(rotation).rotation_matrix
+	return matrix.T if inverse else matrix
+
+
+# 4x4 homogeneous matrix that rotates by the quaternion, then translates.
+# With inverse set it undoes that instead (translate back, then rotate the other way).
+def transformMatrix(rotation, translation, inverse=False):
+	rotation = rotationMatrix(tuple(rotation))
+	translation = np.array(translation, dtype=np.float64)
+	matrix = np.eye(4)
+	if inverse:
+		matrix[:3, :3] = rotation.T
+		matrix[:3, 3] = -np.dot(rotation.T, translation)
+	else:
+		matrix[:3, :3] = rotation
+		matrix[:3, 3] = translation
+	return matrix
+
+
+# Applies a 4x4 transform to an array of n,3 points. out can be a preallocated n,3 array to write into.
+def applyTransform(matrix, points, out=None):
+	if out is None:
+		out = np.empty((len(points), 3), dtype=np.result_type(points.dtype, np.float32))
+	np.dot(points[:, :3], matrix[:3, :3].T.astype(out.dtype), out=out)
+	out += matrix[:3, 3].astype(out.dtype)
+	return out
+
+
+# Yaw of every quaternion in an array of n,4 (w, x, y, z) rotations. Same as Quaternion(q).yaw_pitch_roll[0].
+def quaternionYaw(rotations):
+	q = np.asarray(rotations, dtype=np.float64).reshape(-1, 4)
+	q = q / np.linalg.norm(q, axis=1, keepdims=True)
+	return np.arctan2(2 * (q[:, 0] * q[:, 3] - q[:, 1] * q[:, 2]), 1 - 2 * (q[:, 2] ** 2 + q[:, 3] ** 2))
+
+
+class TransformCache:
+	'''
+	Keeps the 4x4 transform of every calibrated sensor and ego pose that has been used, so each one is only built
+	from its quaternion once. Calibrations repeat across thousands of samples.
+	'''
+
+	def __init__(self, level5Data):
+		self.level5Data = level5Data
+		self.sensorToEgoMatrices = {}
+		self.egoToGlobalMatrices = {}
+		self.globalToEgoMatrices = {}
+
+	def lookup(self, matrices, table, token, inverse):
+		if token not in matrices:
+			record = self.level5Data.get(table, token)
+			matrices[token] = transformMatrix(record['rotation'], record['translation'], inverse)
+		return matrices[token]
+
+	# sensor frame to car frame, for a calibrated_sensor token
+	def sensorToEgo(self, calibratedSensorToken):
+		return self.lookup(self.sensorToEgoMatrices, 'calibrated_sensor', calibratedSensorToken, False)
+
+	# car frame to global frame, for an ego_pose token
+	def egoToGlobal(self, egoPoseToken):
+		return self.lookup(self.egoToGlobalMatrices, 'ego_pose', egoPoseToken, False)
+
+	# global frame to car frame, for an ego_pose token. Used to move annotations next to the lidar points.
+	def globalToEgo(self, egoPoseToken):
+		return self.lookup(self.globalToEgoMatrices, 'ego_pose', egoPoseToken, True)
+
+	# global frame to car frame at the time of the sample's top lidar sweep
+	def sampleGlobalToEgo(self, sample):
+		sampleData = self.level5Data.get('sample_data', sample['data']['LIDAR_TOP'])
+		return self.globalToEgo(sampleData['ego_pose_token'])
+
+
+transformCaches = {}
+
+
+# Returns the TransformCache for the dataset, so every caller shares one.
+def getTransformCache(level5Data):
+	if id(level5Data) not in transformCaches:
+		transformCaches[id(level5Data)] = TransformCache(level5Data)
+	return transformCaches[id(level5Data)]